@@ -0,0 +1,142 @@
+from typing import Iterable, Iterator
+
+
+class Bitset:
+    """
+    A fixed-size set of bits packed into a `bytearray` in the wire order of the Bitfield message: the first byte holds
+    bits 0-7 from high bit to low bit, the next byte holds bits 8-15 etc. Spare bits at the end are always zero.
+
+    Single bits are read and written in O(1). Whole-set operations (popcount, AND, AND NOT) are done on Python
+    integers built from the underlying bytes, so they never loop over the bits in Python.
+    """
+
+    __slots__ = ('size', '_data')
+
+    def __init__(self, size: int, data: bytes | bytearray | memoryview | None = None):
+        self.size = size
+        length = size // 8 + bool(size % 8)
+        if data is None:
+            self._data = bytearray(length)
+        else:
+            if len(data) < length:
+                raise ValueError(f"Expected at least {length} bytes for {size} bits, got {len(data)}")
+            self._data = bytearray(data[:length])
+            self._clear_spare_bits()
+
+    @classmethod
+    def from_bools(cls, bools: Iterable[bool]) -> 'Bitset':
+        bools = list(bools)
+        bitset = cls(len(bools))
+        for i, value in enumerate(bools):
+            if value:
+                bitset.set(i)
+        return bitset
+
+    @classmethod
+    def full(cls, size: int) -> 'Bitset':
+        bitset = cls(size)
+        bitset._data[:] = b'\xff' * len(bitset._data)
+        bitset._clear_spare_bits()
+        return bitset
+
+    def _clear_spare_bits(self):
+        if self.size % 8:
+            self._data[-1] &= (0xff << (8 - self.size % 8)) & 0xff
+
+    def _check_index(self, index: int):
+        if not 0 <= index < self.size:
+            raise IndexError(f"Bit index {index} is out of range for {self.size} bits")
+
+    def get(self, index: int) -> bool:
+        self._check_index(index)
+        return bool(self._data[index >> 3] & (0x80 >> (index & 7)))
+
+    def set(self, index: int, value: bool = True):
+        self._check_index(index)
+        if value:
+            self._data[index >> 3] |= 0x80 >> (index & 7)
+        else:
+            self._data[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+    def clear(self, index: int):
+        self.set(index, False)
+
+    def count(self) -> int:
+        """
+        :return: the number of set bits
+        """
+        return int.from_bytes(self._data).bit_count()
+
+    def all(self) -> bool:
+        return self.count() == self.size
+
+    def any(self) -> bool:
+        return any(self._data)
+
+    def _from_int(self, value: int) -> 'Bitset':
+        return Bitset(self.size, value.to_bytes(len(self._data)))
+
+    def _check_size(self, other: 'Bitset'):
+        if self.size != other.size:
+            raise ValueError(f"Bitsets have different sizes: {self.size} and {other.size}")
+
+    def __and__(self, other: 'Bitset') -> 'Bitset':
+        self._check_size(other)
+        return self._from_int(int.from_bytes(self._data) & int.from_bytes(other._data))
+
+    def __or__(self, other: 'Bitset') -> 'Bitset':
+        self._check_size(other)
+        return self._from_int(int.from_bytes(self._data) | int.from_bytes(other._data))
+
+    def and_not(self, other: 'Bitset') -> 'Bitset':
+        """
+        :return: the bits that are set in this bitset, but not in `other`
+        """
+        self._check_size(other)
+        return self._from_int(int.from_bytes(self._data) & ~int.from_bytes(other._data))
+
+    def indices(self) -> Iterator[int]:
+        """
+        Iterate over the indexes of the set bits (zero bytes are skipped without looking at their bits)
+        """
+        for byte_index, byte in enumerate(self._data):
+            if byte:
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield byte_index * 8 + bit
+
+    def to_bytes(self) -> bytes:
+        return bytes(self._data)
+
+    def view(self) -> memoryview:
+        """
+        :return: read-only view of the packed bits, ready to be written to the wire without copying
+        """
+        return memoryview(self._data).toreadonly()
+
+    def copy(self) -> 'Bitset':
+        return Bitset(self.size, self._data)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, index: int) -> bool:
+        return self.get(index)
+
+    def __setitem__(self, index: int, value: bool):
+        self.set(index, value)
+
+    def __iter__(self) -> Iterator[bool]:
+        for byte in self._data[:self.size // 8]:
+            for bit in range(8):
+                yield bool(byte & (0x80 >> bit))
+        for index in range(self.size - self.size % 8, self.size):
+            yield self.get(index)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Bitset):
+            return NotImplemented
+        return self.size == other.size and self._data == other._data
+
+    def __repr__(self) -> str:
+        return f"Bitset(size={self.size}, count={self.count()})"
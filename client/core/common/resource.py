@@ -1,5 +1,5 @@
 import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import hashlib
 
 
@@ -16,6 +16,9 @@ class Resource:
     creation_date: datetime.datetime
     name: str
     pieces: list[Piece]
+    # The tiers of the (host, port) of the trackers, the first tier is preferred. They are not a part of the info hash,
+    # so that the trackers of a resource may change
+    trackers: list[list[tuple[str, int]]] = field(default_factory=list)
 
     def get_info_hash(self) -> str:
         resource_repr = f"{self.tracker_ip};{self.tracker_port};{self.comment};{self.creation_date.isoformat()};{self.name};"
@@ -24,3 +27,11 @@ class Resource:
 
         info_hash = hashlib.sha256(resource_repr.encode(encoding='utf-8')).hexdigest()
         return info_hash
+
+    def get_tracker_tiers(self) -> list[list[tuple[str, int]]]:
+        """
+        :return: the tiers of the trackers, or the only tier of `tracker_ip` if the resource names no other trackers
+        """
+        if self.trackers:
+            return self.trackers
+        return [[(self.tracker_ip, int(self.tracker_port))]]
@@ -1,24 +1,80 @@
 import asyncio
+from collections import deque
 
 from core.common.peer_info import PeerInfo
 from core.p2p.connection_listener import ConnectionListener
-from core.p2p.message import Request, Piece, Handshake, Message, Bitfield
+from core.p2p.message import (
+    Request, Piece, Handshake, Message, Bitfield, Have, HaveAll, HaveNone, Choke, Unchoke, Interested, NotInterested,
+    Pex
+)
+from core.p2p.rate_limiter import RateLimiter
 from core.common.resource import Resource
 
+# The time given to the other side to send its handshake
+HANDSHAKE_TIMEOUT_SECONDS = 10
+
+# The time given to the TCP connection to be established
+CONNECT_TIMEOUT_SECONDS = 5
+
+# The longest accepted Piece message data
+MAX_BLOCK_LENGTH = 10 ** 6
+
+# The longest accepted message (the type and the data, the longest one is the Piece message). The length is checked
+# before the message is charged to the download limit, so that a bogus length cannot drive the limiter into a long debt
+MAX_MESSAGE_LENGTH = 1 + 12 + MAX_BLOCK_LENGTH
+
+# The longest accepted Pex message data (more than a thousand peers)
+MAX_PEX_LENGTH = 64 * 1024
+
+# The longest accepted body of a message of unknown type, the body is skipped
+MAX_UNKNOWN_MESSAGE_LENGTH = 10 ** 6
+
 
 class Connection:
     """
     Represents a resource-related connection between two peers.
     The class works with asyncio, therefore its methods must be called on a thread with running event loop
+
+    Receiving and sending are decoupled from the listeners: the Request messages are put into the inbound queue served
+    by a separate worker, and the outgoing messages are put into the send queue written by a separate task. Control
+    messages in the send queue always go before the Piece messages.
     """
 
+    # `send_message` waits once this many bytes are queued, until the queue shrinks to the low watermark
+    SEND_QUEUE_HIGH_WATERMARK = 4 * 1024 * 1024
+    SEND_QUEUE_LOW_WATERMARK = 1024 * 1024
+
+    # The send loop writes at most this many bytes of Piece messages with one call
+    SEND_BATCH_SIZE = 256 * 1024
+
+    # Reading from the peer is suspended while this many Request messages wait to be served
+    REQUEST_QUEUE_SIZE = 256
+
     def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, resource: Resource):
         self.reader = reader
         self.writer = writer
         self.listeners: list[ConnectionListener] = []
         self.resource = resource
 
+        # Limits the bandwidth of the connection (the owner usually replaces it with a child of its own limiter)
+        self.rate_limiter = RateLimiter()
+
         self._listen_on_reader_task: asyncio.Task | None = None
+        self._notifying_close = False  # The receive loop notifies the listeners about the closing and then ends
+
+        # Inbound Request messages
+        self._requests: asyncio.Queue[Request] = asyncio.Queue(maxsize=self.REQUEST_QUEUE_SIZE)
+        self._serve_requests_task: asyncio.Task | None = None
+
+        # Outbound messages (buffers of the message and their total length)
+        self._control_queue: deque[tuple[list[bytes | memoryview], int]] = deque()
+        self._data_queue: deque[tuple[list[bytes | memoryview], int]] = deque()
+        self._queued_bytes = 0
+        self._send_ready = asyncio.Event()
+        self._below_low_watermark = asyncio.Event()
+        self._below_low_watermark.set()
+        self._send_error: Exception | None = None
+        self._send_task: asyncio.Task | None = None
 
     def add_listener(self, listener: ConnectionListener):
         self.listeners.append(listener)
@@ -30,91 +86,258 @@ class Connection:
     async def _read_int_big_endian(self, length: int) -> int:
         return int.from_bytes(await self.reader.readexactly(length))
 
-    # Launch infinite loop to fetch messages from the reader and notify the listeners
-    async def _listen_on_reader(self):
-        try:
-            while True:
-                message_length = await self._read_int_big_endian(4)
-                message_type = await self._read_int_big_endian(1)
+    # Pass the received message to the matching callback of every listener
+    # (the Request messages are only queued, the listeners get them from the request worker)
+    async def _notify(self, message: Message):
+        if isinstance(message, Request):
+            await self._requests.put(message)
+            return
+        elif isinstance(message, Piece):
+            callbacks = (listener.on_piece(message) for listener in self.listeners)
+        elif isinstance(message, Bitfield):
+            callbacks = (listener.on_bitfield(message) for listener in self.listeners)
+        elif isinstance(message, Have):
+            callbacks = (listener.on_have(message) for listener in self.listeners)
+        elif isinstance(message, HaveAll):
+            callbacks = (listener.on_have_all(message) for listener in self.listeners)
+        elif isinstance(message, HaveNone):
+            callbacks = (listener.on_have_none(message) for listener in self.listeners)
+        elif isinstance(message, Choke):
+            callbacks = (listener.on_choke(message) for listener in self.listeners)
+        elif isinstance(message, Unchoke):
+            callbacks = (listener.on_unchoke(message) for listener in self.listeners)
+        elif isinstance(message, Interested):
+            callbacks = (listener.on_interested(message) for listener in self.listeners)
+        elif isinstance(message, NotInterested):
+            callbacks = (listener.on_not_interested(message) for listener in self.listeners)
+        elif isinstance(message, Pex):
+            callbacks = (listener.on_pex(message) for listener in self.listeners)
+        else:
+            return
+        await asyncio.gather(*callbacks, return_exceptions=True)
 
-                if message_type == 1:
-                    # Request message
+    async def _serve_requests(self):
+        while True:
+            request = await self._requests.get()
+            await asyncio.gather(
+                *(listener.on_request(request) for listener in self.listeners),
+                return_exceptions=True
+            )
 
-                    # Parse the message
-                    piece_index = await self._read_int_big_endian(4)
-                    piece_inner_offset = await self._read_int_big_endian(4)
-                    block_length = await self._read_int_big_endian(4)
+    async def _notify_close(self, cause):
+        self._notifying_close = True
+        await asyncio.gather(
+            *(listener.on_close(cause) for listener in self.listeners),
+            return_exceptions=True
+        )
 
-                    request = Request(piece_index, piece_inner_offset, block_length)
+    # Read the rest of the message with the given type from the reader (the resource defines the bitfield length)
+    async def _read_message(self, message_type: int, message_length: int, resource: Resource) -> Message | None:
+        if message_type == 1:
+            # Request message
 
-                    # Notify listeners
-                    await asyncio.gather(
-                        *(listener.on_request(request) for listener in self.listeners),
-                        return_exceptions=True
-                    )
-                elif message_type == 2:
-                    # Piece message
+            # Parse the message
+            piece_index = await self._read_int_big_endian(4)
+            piece_inner_offset = await self._read_int_big_endian(4)
+            block_length = await self._read_int_big_endian(4)
 
-                    # Parse the message
-                    piece_index = await self._read_int_big_endian(4)
-                    piece_inner_offset = await self._read_int_big_endian(4)
-                    block_length = await self._read_int_big_endian(4)
+            return Request(piece_index, piece_inner_offset, block_length)
+        elif message_type == 2:
+            # Piece message
 
-                    if block_length > 10 ** 6:
-                        raise RuntimeError("The length of data exceeded 1 MB")
+            # Parse the message
+            piece_index = await self._read_int_big_endian(4)
+            piece_inner_offset = await self._read_int_big_endian(4)
+            block_length = await self._read_int_big_endian(4)
 
-                    # Retrieve the data block
-                    data = await self.reader.readexactly(block_length)
+            if block_length > MAX_BLOCK_LENGTH:
+                raise RuntimeError("The length of data exceeded 1 MB")
 
-                    piece = Piece(piece_index, piece_inner_offset, block_length, data)
+            # Retrieve the data block
+            data = await self.reader.readexactly(block_length)
 
-                    # Notify the listeners
-                    await asyncio.gather(
-                        *(listener.on_piece(piece) for listener in self.listeners),
-                        return_exceptions=True
-                    )
-                elif message_type == 3:
-                    # Bitfield message
-
-                    # Parse the message
-                    bytes_parsed = await self.reader.readexactly(
-                        len(self.resource.pieces) // 8 + bool(len(self.resource.pieces) % 8)
-                    )
-
-                    bitfield = Bitfield(bitfield=[False] * len(self.resource.pieces))
-                    for i in range(0, len(self.resource.pieces)):
-                        has_piece_i = bool((bytes_parsed[i // 8] >> (7 - i % 8)) & 1)
-                        bitfield.bitfield[i] = has_piece_i
+            return Piece(piece_index, piece_inner_offset, block_length, data)
+        elif message_type == 3:
+            # Bitfield message
+
+            # Parse the message
+            bytes_parsed = await self.reader.readexactly(
+                len(resource.pieces) // 8 + bool(len(resource.pieces) % 8)
+            )
+
+            return Bitfield.from_bytes(bytes_parsed, len(resource.pieces))
+        elif message_type == 4:
+            # Have message
+            piece_index = await self._read_int_big_endian(4)
+            return Have(piece_index)
+        elif message_type == 5:
+            # Have-All message
+            return HaveAll()
+        elif message_type == 6:
+            # Have-None message
+            return HaveNone()
+        elif message_type == 7:
+            # Choke message
+            return Choke()
+        elif message_type == 8:
+            # Unchoke message
+            return Unchoke()
+        elif message_type == 9:
+            # Interested message
+            return Interested()
+        elif message_type == 10:
+            # Not-Interested message
+            return NotInterested()
+        elif message_type == 13:
+            # Pex message
+            if message_length - 1 > MAX_PEX_LENGTH:
+                raise RuntimeError("The length of Pex message exceeded the limit")
+            return Pex.from_bytes(await self.reader.readexactly(message_length - 1))
+        else:
+            # Skip the body of unknown message
+            if message_length - 1 > MAX_UNKNOWN_MESSAGE_LENGTH:
+                raise RuntimeError("The length of unknown message exceeded the limit")
+            await self.reader.readexactly(message_length - 1)
+            return None
 
+    # Launch infinite loop to fetch messages from the reader and notify the listeners
+    async def _listen_on_reader(self):
+        try:
+            while True:
+                message_length = await self._read_int_big_endian(4)
+                if message_length == 0:
+                    raise RuntimeError("The message has no type")
+                if message_length > MAX_MESSAGE_LENGTH:
+                    raise RuntimeError("The length of message exceeded the limit")
+                message_type = await self._read_int_big_endian(1)
+
+                # The rest of the message stays in the socket until the download limit allows it
+                await self.rate_limiter.download.consume(4 + message_length)
+
+                message = await self._read_message(message_type, message_length, self.resource)
+                if message is not None:
                     # Notify the listeners
-                    await asyncio.gather(
-                        *(listener.on_bitfield(bitfield) for listener in self.listeners),
-                        return_exceptions=True
-                    )
+                    await self._notify(message)
 
         except Exception as e:
             # For now close the connection in case of any exception
-            await asyncio.gather(
-                *(listener.on_close(e) for listener in self.listeners),
-                return_exceptions=True
-            )
+            await self._notify_close(e)
         finally:
+            self._stop_workers()
             self.writer.close()
-            await self.writer.wait_closed()
+            try:
+                # Shielded: the waited future is shared with close(), cancelling this loop must not cancel it
+                await asyncio.shield(self.writer.wait_closed())
+            except Exception:
+                pass  # The connection is already broken, nothing else to release
+
+    # Write the buffers to the peer with one call (the transport-specific part of the send loop)
+    def _writelines(self, buffers: list[bytes | memoryview]):
+        self.writer.writelines(buffers)
+
+    # Wait for the transport only when its write buffer has reached the high watermark
+    async def _drain(self):
+        transport = self.writer.transport
+        if transport.is_closing() or transport.get_write_buffer_size() >= transport.get_write_buffer_limits()[1]:
+            await self.writer.drain()
+
+    # Abort the connection after the failed write (the receiving side then notifies the listeners)
+    def _abort(self):
+        self.writer.close()
+
+    async def _send_loop(self):
+        try:
+            while True:
+                await self._send_ready.wait()
+                while self._control_queue or self._data_queue:
+                    # Everything queued since the last iteration goes in one batch: all the control messages,
+                    # then the Piece messages up to the batch size
+                    batch: list[bytes | memoryview] = []
+                    batch_bytes = 0
+                    while self._control_queue:
+                        buffers, length = self._control_queue.popleft()
+                        batch.extend(buffers)
+                        batch_bytes += length
+                    while self._data_queue and batch_bytes < self.SEND_BATCH_SIZE:
+                        buffers, length = self._data_queue.popleft()
+                        batch.extend(buffers)
+                        batch_bytes += length
+
+                    await self.rate_limiter.upload.consume(batch_bytes)
+                    self._queued_bytes -= batch_bytes
+                    self._writelines(batch)
+                    await self._drain()
+                    if self._queued_bytes <= self.SEND_QUEUE_LOW_WATERMARK:
+                        self._below_low_watermark.set()
+                self._send_ready.clear()
+        except Exception as e:
+            self._send_error = e
+            self._control_queue.clear()
+            self._data_queue.clear()
+            self._queued_bytes = 0
+            self._below_low_watermark.set()
+            self._abort()
 
     async def send_message(self, message: Message):
-        self.writer.write(message.to_bytes())
-        await self.writer.drain()
+        """
+        Put the message into the send queue. Waits while the queue is above the high watermark.
+        Raises the exception if the connection is already known to be broken.
+        """
+        buffers = message.to_buffers()
+        await self._enqueue(buffers, sum(len(buffer) for buffer in buffers), isinstance(message, Piece))
+
+    # Put the encoded message into the send queue (Piece data goes to the low priority queue)
+    async def _enqueue(self, buffers: list[bytes | memoryview], length: int, is_data: bool):
+        if self._send_error is not None:
+            raise ConnectionResetError("Cannot send message over the broken connection") from self._send_error
+
+        if is_data:
+            self._data_queue.append((buffers, length))
+        else:
+            self._control_queue.append((buffers, length))
+        self._queued_bytes += length
+        self._send_ready.set()
+
+        if self._send_task is None:
+            self._send_task = asyncio.get_running_loop().create_task(self._send_loop())
+
+        if self._queued_bytes >= self.SEND_QUEUE_HIGH_WATERMARK:
+            self._below_low_watermark.clear()
+            await self._below_low_watermark.wait()
+            if self._send_error is not None:
+                raise ConnectionResetError("The connection is broken while sending message") from self._send_error
 
     async def listen(self):
         if self._listen_on_reader_task is None:
             loop = asyncio.get_running_loop()
             self._listen_on_reader_task = loop.create_task(self._listen_on_reader())
+        if self._serve_requests_task is None:
+            loop = asyncio.get_running_loop()
+            self._serve_requests_task = loop.create_task(self._serve_requests())
+
+    def _stop_workers(self):
+        for task in (self._serve_requests_task, self._send_task):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        self._serve_requests_task = None
+        self._send_task = None
+        if self._send_error is None:
+            self._send_error = ConnectionResetError("The connection is closed")
+        self._below_low_watermark.set()
+
+    # Stop the receive loop. The listeners close the connection from on_close, which the receive loop runs in
+    # concurrent tasks: the loop is not cancelled then, so that the other listeners are notified to the end
+    # (the loop ends on its own once the notification is handled)
+    def _stop_listening(self):
+        task = self._listen_on_reader_task
+        if task is not None and task is not asyncio.current_task() and not self._notifying_close:
+            task.cancel()
+        self._listen_on_reader_task = None
 
     async def close(self):
+        self._stop_workers()
         if self._listen_on_reader_task is not None:
-            self._listen_on_reader_task.cancel()
-            self._listen_on_reader_task = None
+            self._stop_listening()
             self.writer.close()
             await self.writer.wait_closed()
 
@@ -123,15 +346,19 @@ class Connection:
 async def establish_connection(
         host_peer_id: str,
         destination_peer: PeerInfo,
-        resource: Resource
+        resource: Resource,
+        connection_class: type[Connection] = Connection
 ) -> Connection:
-    reader, writer = await asyncio.open_connection(destination_peer.public_ip, destination_peer.public_port)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(destination_peer.public_ip, destination_peer.public_port),
+        CONNECT_TIMEOUT_SECONDS
+    )
 
     info_hash = resource.get_info_hash()
     handshake = Handshake(host_peer_id, info_hash)
     try:
         writer.write(handshake.to_bytes())
-        response = await reader.readexactly(75)
+        response = await asyncio.wait_for(reader.readexactly(75), HANDSHAKE_TIMEOUT_SECONDS)
         assert response[0:11].decode() == 'TorrentInno'
         assert response[11:43].hex() == destination_peer.peer_id
         assert response[43:75].hex() == info_hash
@@ -140,4 +367,4 @@ async def establish_connection(
         await writer.wait_closed()
         raise  # re-raise the error
 
-    return Connection(reader, writer, resource)
\ No newline at end of file
+    return connection_class(reader, writer, resource)
\ No newline at end of file
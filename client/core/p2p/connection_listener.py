@@ -1,4 +1,6 @@
-from core.p2p.message import Request, Piece, Bitfield
+from core.p2p.message import (
+    Request, Piece, Bitfield, Have, HaveAll, HaveNone, Choke, Unchoke, Interested, NotInterested, Pex
+)
 
 
 class ConnectionListener:
@@ -11,5 +13,29 @@ class ConnectionListener:
     async def on_bitfield(self, bitfield: Bitfield):
         pass
 
+    async def on_have(self, have: Have):
+        pass
+
+    async def on_have_all(self, have_all: HaveAll):
+        pass
+
+    async def on_have_none(self, have_none: HaveNone):
+        pass
+
+    async def on_choke(self, choke: Choke):
+        pass
+
+    async def on_unchoke(self, unchoke: Unchoke):
+        pass
+
+    async def on_interested(self, interested: Interested):
+        pass
+
+    async def on_not_interested(self, not_interested: NotInterested):
+        pass
+
+    async def on_pex(self, pex: Pex):
+        pass
+
     def on_close(self, cause):
-        pass
\ No newline at end of file
+        pass
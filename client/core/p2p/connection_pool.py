@@ -0,0 +1,76 @@
+class ConnectionPool:
+    """
+    Counts the peer connections against the caps. Pools form a hierarchy (session -> resource) like the rate limiters:
+    a connection takes a slot in its pool and in all of the ancestors, so both the per-resource and the session-wide
+    caps hold. Inbound and outbound connections have separate quotas, hence the peers connecting to the host peer
+    cannot take the slots needed to reach the peers it wants, and vice versa.
+    """
+
+    def __init__(
+            self,
+            max_inbound: int | None = None,
+            max_outbound: int | None = None,
+            parent: 'ConnectionPool | None' = None
+    ):
+        """
+        :param max_inbound: the cap of the connections opened by other peers, None means unlimited
+        :param max_outbound: the cap of the connections opened by the host peer, None means unlimited
+        :param parent: the pool which also counts the connections of this pool
+        """
+        self.parent = parent
+        self.max_inbound = max_inbound
+        self.max_outbound = max_outbound
+        self.inbound = 0
+        self.outbound = 0
+
+    def child(self, max_inbound: int | None = None, max_outbound: int | None = None) -> 'ConnectionPool':
+        return ConnectionPool(max_inbound, max_outbound, parent=self)
+
+    def set_limits(self, max_inbound: int | None, max_outbound: int | None):
+        """
+        Change the caps. The connections above the new caps are kept, only the new ones are refused.
+        """
+        self.max_inbound = max_inbound
+        self.max_outbound = max_outbound
+
+    def _has_room_here(self, inbound: bool) -> bool:
+        if inbound:
+            return self.max_inbound is None or self.inbound < self.max_inbound
+        return self.max_outbound is None or self.outbound < self.max_outbound
+
+    def has_room(self, inbound: bool) -> bool:
+        """
+        :return: whether this pool and all of its ancestors have a free slot of the direction
+        """
+        pool = self
+        while pool is not None:
+            if not pool._has_room_here(inbound):
+                return False
+            pool = pool.parent
+        return True
+
+    def try_acquire(self, inbound: bool) -> bool:
+        """
+        Take the slot in this pool and all of its ancestors if all of them have room
+
+        :return: whether the slot is taken
+        """
+        if not self.has_room(inbound):
+            return False
+        pool = self
+        while pool is not None:
+            if inbound:
+                pool.inbound += 1
+            else:
+                pool.outbound += 1
+            pool = pool.parent
+        return True
+
+    def release(self, inbound: bool):
+        pool = self
+        while pool is not None:
+            if inbound:
+                pool.inbound -= 1
+            else:
+                pool.outbound -= 1
+            pool = pool.parent
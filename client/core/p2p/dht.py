@@ -0,0 +1,477 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from core.common.peer_info import PeerInfo
+from core.p2p.resource_manager import ResourceManager
+
+# The number of contacts in a k-bucket and the number of the closest nodes storing a record
+BUCKET_SIZE = 8
+
+# The number of the nodes queried at once during a lookup
+LOOKUP_CONCURRENCY = 3
+
+# A query not answered for this long is lost, the node is considered unreachable
+RPC_TIMEOUT_SECONDS = 2
+
+# The announce tokens are derived from a secret replaced this often, the tokens of the previous secret are accepted too
+TOKEN_ROTATION_SECONDS = 5 * 60
+
+# An announced peer is forgotten unless it announces itself again within this time
+PEER_TTL_SECONDS = 30 * 60
+
+# How often the registered resources are announced and their peers are looked up
+ANNOUNCE_INTERVAL_SECONDS = 5 * 60
+
+# Keep each datagram within a typical MTU
+MAX_PEERS_PER_RESPONSE = 30
+
+_ID_BITS = 256  # Node ids share the space of the info hashes (SHA-256)
+
+
+def distance(a: str, b: str) -> int:
+    """
+    The XOR distance of two node ids (or a node id and an info hash) given as hex strings
+    """
+    return int(a, 16) ^ int(b, 16)
+
+
+def _is_id(value) -> bool:
+    if not isinstance(value, str) or len(value) != _ID_BITS // 4:
+        return False
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def _is_port(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and 0 < value < 65536
+
+
+# The (node_id, host, port) of the nodes and the (host, port, peer_id) of the peers of the lookup response,
+# raises ValueError if any entry is malformed
+def _parse_lookup_result(result) -> tuple[list[tuple[str, str, int]], list[tuple[str, int, str]]]:
+    if not (
+            isinstance(result, dict) and
+            isinstance(result.get('nodes', []), list) and
+            isinstance(result.get('peers', []), list)
+    ):
+        raise ValueError("The lookup response is not a dict of lists")
+    nodes, peers = [], []
+    for entry in result.get('nodes', []):
+        if not isinstance(entry, list) or len(entry) != 3:
+            raise ValueError(f"Malformed node {entry!r}")
+        node_id, host, port = entry
+        if not _is_id(node_id) or not isinstance(host, str) or not _is_port(port):
+            raise ValueError(f"Malformed node {entry!r}")
+        nodes.append((node_id, host, port))
+    for entry in result.get('peers', []):
+        if not isinstance(entry, list) or len(entry) != 3:
+            raise ValueError(f"Malformed peer {entry!r}")
+        host, port, peer_id = entry
+        if not _is_id(peer_id) or not isinstance(host, str) or not _is_port(port):
+            raise ValueError(f"Malformed peer {entry!r}")
+        peers.append((host, port, peer_id))
+    return nodes, peers
+
+
+@dataclass
+class NodeContact:
+    node_id: str
+    host: str
+    port: int
+
+
+class RoutingTable:
+    """
+    The contacts of a node in k-buckets: the bucket `i` keeps at most `BUCKET_SIZE` contacts whose distance to the node
+    is in [2^i, 2^(i+1)), ordered from the least to the most recently seen. Long-lived contacts are preferred: when a
+    bucket is full, a new contact replaces the least recently seen one only if that one does not answer a ping.
+    """
+
+    def __init__(self, node_id: str, bucket_size: int = BUCKET_SIZE):
+        self.node_id = node_id
+        self.bucket_size = bucket_size
+        self._buckets: list[OrderedDict[str, NodeContact]] = [OrderedDict() for _ in range(_ID_BITS)]
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets)
+
+    def __contains__(self, node_id: str):
+        return node_id != self.node_id and node_id in self._bucket(node_id)
+
+    def add(self, contact: NodeContact) -> NodeContact | None:
+        """
+        Add the contact or mark it as the most recently seen
+
+        :return: None if the contact is in the table, otherwise the least recently seen contact of the full bucket,
+        which must be pinged before the new contact may replace it
+        """
+        if contact.node_id == self.node_id:
+            return None
+        bucket = self._bucket(contact.node_id)
+        if contact.node_id in bucket:
+            bucket[contact.node_id] = contact
+            bucket.move_to_end(contact.node_id)
+            return None
+        if len(bucket) < self.bucket_size:
+            bucket[contact.node_id] = contact
+            return None
+        return next(iter(bucket.values()))
+
+    def remove(self, node_id: str):
+        if node_id != self.node_id:
+            self._bucket(node_id).pop(node_id, None)
+
+    def closest(self, target: str, count: int | None = None) -> list[NodeContact]:
+        """
+        :return: at most `count` (`bucket_size` by default) contacts closest to the target, the closest first
+        """
+        contacts = [contact for bucket in self._buckets for contact in bucket.values()]
+        contacts.sort(key=lambda contact: distance(contact.node_id, target))
+        return contacts[:count or self.bucket_size]
+
+    def _bucket(self, node_id: str) -> OrderedDict[str, NodeContact]:
+        return self._buckets[distance(self.node_id, node_id).bit_length() - 1]
+
+
+class _DhtProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node: 'DhtNode'):
+        self.node = node
+
+    def datagram_received(self, data: bytes, addr):
+        self.node._on_datagram(data, addr)
+
+    def error_received(self, exc: Exception):
+        logging.debug(f"DHT socket error: {exc!r}")
+
+
+class DhtNode:
+    """
+    A node of the Kademlia-style distributed hash table storing (info hash -> peer address) records, so that the peers
+    find each other without the tracker. The nodes talk JSON over their own UDP port:
+
+        query:    {"t": transaction-id, "y": "q", "id": node-id, "q": method, "a": arguments}
+        response: {"t": transaction-id, "y": "r", "id": node-id, "r": result}
+        error:    {"t": transaction-id, "y": "e", "id": node-id, "e": message}
+
+    The methods are `ping`, `find_node` (the closest contacts to `target`), `get_peers` (the peers of `info_hash`
+    if the node stores any, the closest contacts and a token) and `announce_peer` (store the sender as a peer of
+    `info_hash`, it must pass the token it has received from this node, which proves that the sender owns its address).
+    A record is stored on the `BUCKET_SIZE` nodes closest to the info hash, which are found with the iterative lookup.
+    The class works with asyncio, therefore its methods must be called on a thread with running event loop
+    """
+
+    def __init__(
+            self,
+            host_peer_id: str,
+            port: int = 0,
+            bootstrap_nodes: list[tuple[str, int]] | None = None,
+            node_id: str | None = None
+    ):
+        """
+        :param port: the UDP port of the node, 0 means some random port
+        :param bootstrap_nodes: the addresses of the nodes known in advance, the rest of the network is found with them
+        :param node_id: the id of the node in the table, random by default
+        """
+        self.host_peer_id = host_peer_id
+        self.port = port
+        self.bootstrap_nodes = list(bootstrap_nodes or [])
+        self.node_id = node_id or os.urandom(_ID_BITS // 8).hex()
+        self.listen_port: int | None = None
+        self.table = RoutingTable(self.node_id)
+        self._resource_managers: dict[str, ResourceManager] = dict()  # info_hash <-> resource manager
+        # info_hash <-> address <-> peer_id and expiry time of the announced peers
+        self._peers: dict[str, dict[tuple[str, int], tuple[str, float]]] = dict()
+        self._pending: dict[int, tuple[asyncio.Future, tuple[str, int]]] = dict()  # transaction id <-> response, addr
+        self._pinging: set[str] = set()  # The contacts of the full buckets being checked
+        self._secrets = [os.urandom(16), os.urandom(16)]  # The current and the previous token secret
+        self._secret_rotated_at = time.monotonic()
+        self._transport: asyncio.DatagramTransport | None = None
+        self._announce_task: asyncio.Task | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def register(self, resource_manager: ResourceManager):
+        """
+        Announce the resource of `resource_manager` and pass it the peers found for this resource
+        """
+        self._resource_managers[resource_manager.info_hash] = resource_manager
+        if self._transport is not None:
+            self._run_in_background(self._announce_resource(resource_manager.info_hash))
+
+    def unregister(self, resource_manager: ResourceManager):
+        if self._resource_managers.get(resource_manager.info_hash) is resource_manager:
+            del self._resource_managers[resource_manager.info_hash]
+
+    async def start(self, listen_port: int, host: str = '0.0.0.0'):
+        """
+        Bind the UDP port, join the network through the bootstrap nodes and start announcing the resources.
+        Does nothing if the node is already started.
+
+        :param listen_port: the port on which the host peer accepts the connections
+        """
+        self.listen_port = listen_port
+        if self._transport is not None:
+            return
+        self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _DhtProtocol(self),
+            local_addr=(host, self.port)
+        )
+        self.port = self._transport.get_extra_info('sockname')[1]
+        self._announce_task = asyncio.create_task(self._announce_loop())
+
+    async def close(self):
+        if self._announce_task is not None:
+            self._announce_task.cancel()
+            self._announce_task = None
+        for task in list(self._tasks):
+            task.cancel()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        for future, _ in self._pending.values():
+            future.cancel()
+
+    async def bootstrap(self, nodes: list[tuple[str, int]] | None = None):
+        """
+        Contact the nodes (`bootstrap_nodes` by default) and fill the routing table with the lookup of the own id
+        """
+        await asyncio.gather(
+            *(self._query(addr, 'ping', {}) for addr in nodes or self.bootstrap_nodes),
+            return_exceptions=True
+        )
+        await self._lookup(self.node_id)
+
+    async def get_peers(self, info_hash: str) -> list[PeerInfo]:
+        """
+        :return: the peers of the resource stored on the nodes closest to the info hash
+        """
+        _, peers = await self._lookup(info_hash, get_peers=True)
+        return peers
+
+    async def announce(self, info_hash: str) -> list[PeerInfo]:
+        """
+        Store the host peer as a peer of the resource on the nodes closest to the info hash
+
+        :return: the peers of the resource found during the lookup
+        """
+        closest, peers = await self._lookup(info_hash, get_peers=True)
+        await asyncio.gather(*(
+            self._query((contact.host, contact.port), 'announce_peer', {
+                'info_hash': info_hash,
+                'port': self.listen_port,
+                'peer_id': self.host_peer_id,
+                'token': token
+            }) for contact, token in closest
+        ), return_exceptions=True)
+        return peers
+
+    # -----LOOKUPS-----
+
+    # The iterative lookup: query the closest known nodes, learn closer ones from their answers, and stop once
+    # the closest nodes have all answered. Return the closest answered contacts with their tokens and the found peers
+    async def _lookup(
+            self,
+            target: str,
+            get_peers: bool = False
+    ) -> tuple[list[tuple[NodeContact, str]], list[PeerInfo]]:
+        shortlist = {contact.node_id: contact for contact in self.table.closest(target)}
+        queried: set[str] = set()
+        answered: dict[str, tuple[NodeContact, str]] = dict()  # node_id <-> contact, token
+        peers: dict[str, PeerInfo] = dict()
+
+        async def query(contact: NodeContact):
+            queried.add(contact.node_id)
+            try:
+                if get_peers:
+                    result = await self._query((contact.host, contact.port), 'get_peers', {'info_hash': target})
+                else:
+                    result = await self._query((contact.host, contact.port), 'find_node', {'target': target})
+                nodes, found_peers = _parse_lookup_result(result)
+            except (asyncio.TimeoutError, OSError, RuntimeError, ValueError) as e:
+                # The node that does not answer or answers with malformed contacts is dropped
+                logging.debug(f"DHT lookup query to {contact.host}:{contact.port} failed: {e!r}")
+                shortlist.pop(contact.node_id, None)
+                if contact.node_id not in self._pinging:
+                    self.table.remove(contact.node_id)
+                return
+            answered[contact.node_id] = (contact, str(result.get('token', '')))
+            for node_id, host, port in nodes:
+                if node_id != self.node_id and node_id not in shortlist:
+                    shortlist[node_id] = NodeContact(node_id, host, port)
+            for host, port, peer_id in found_peers:
+                if peer_id != self.host_peer_id:
+                    peers[peer_id] = PeerInfo(host, port, peer_id)
+
+        while True:
+            closest = sorted(shortlist.values(), key=lambda contact: distance(contact.node_id, target))
+            closest = closest[:self.table.bucket_size]
+            candidates = [contact for contact in closest if contact.node_id not in queried][:LOOKUP_CONCURRENCY]
+            if not candidates:
+                break
+            await asyncio.gather(*(query(contact) for contact in candidates))
+
+        closest = sorted(answered.values(), key=lambda answer: distance(answer[0].node_id, target))
+        return closest[:self.table.bucket_size], list(peers.values())
+
+    async def _announce_resource(self, info_hash: str):
+        try:
+            peers = await self.announce(info_hash)
+        except Exception:
+            logging.exception("Failed to announce the resource in the DHT")
+            return
+        resource_manager = self._resource_managers.get(info_hash)
+        if resource_manager is not None and peers:
+            await resource_manager.submit_peers(peers)
+
+    async def _announce_loop(self):
+        while True:
+            try:
+                if len(self.table) == 0 and self.bootstrap_nodes:
+                    await self.bootstrap()
+                self._expire_peers()
+                await asyncio.gather(
+                    *(self._announce_resource(info_hash) for info_hash in list(self._resource_managers))
+                )
+            except Exception:
+                logging.exception("DHT maintenance failed")
+            await asyncio.sleep(ANNOUNCE_INTERVAL_SECONDS * random.uniform(0.9, 1.1))
+
+    def _expire_peers(self):
+        now = time.monotonic()
+        for info_hash in list(self._peers):
+            stored = self._peers[info_hash]
+            for addr in [addr for addr, (_, expires_at) in stored.items() if expires_at < now]:
+                del stored[addr]
+            if not stored:
+                del self._peers[info_hash]
+
+    # -----RPC-----
+
+    # Send the query and return the result of the response, raises asyncio.TimeoutError if there is no response
+    # and RuntimeError if the node answers with an error
+    async def _query(self, addr: tuple[str, int], method: str, arguments: dict) -> dict:
+        if self._transport is None:
+            raise RuntimeError("The DHT node is not started")
+        transaction_id = random.getrandbits(32)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[transaction_id] = (future, (addr[0], int(addr[1])))
+        try:
+            self._send(addr, {'t': transaction_id, 'y': 'q', 'q': method, 'a': arguments})
+            message = await asyncio.wait_for(future, RPC_TIMEOUT_SECONDS)
+        finally:
+            self._pending.pop(transaction_id, None)
+        if message.get('y') == 'e':
+            raise RuntimeError(f"DHT node error: {message.get('e')}")
+        return message.get('r') or {}
+
+    def _send(self, addr: tuple[str, int], message: dict):
+        self._transport.sendto(json.dumps({**message, 'id': self.node_id}).encode(), addr)
+
+    def _on_datagram(self, data: bytes, addr: tuple[str, int]):
+        try:
+            message = json.loads(data)
+            node_id = message['id']
+            kind = message['y']
+        except (ValueError, KeyError, TypeError):
+            return
+        if not _is_id(node_id) or node_id == self.node_id:
+            return
+
+        if kind == 'q':
+            self._on_contact(NodeContact(node_id, addr[0], addr[1]))
+            try:
+                response = {'t': message.get('t'), 'y': 'r', 'r': self._answer(message['q'], message['a'], addr)}
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'t': message.get('t'), 'y': 'e', 'e': str(e)}
+            self._send(addr, response)
+        elif kind in ('r', 'e') and isinstance(message.get('t'), int):
+            pending = self._pending.get(message['t'])
+            # The response must come from the address the query was sent to
+            if pending is not None and pending[1] == (addr[0], addr[1]) and not pending[0].done():
+                pending[0].set_result(message)
+                self._on_contact(NodeContact(node_id, addr[0], addr[1]))
+
+    # Answer the query, raises ValueError if it is malformed or not allowed
+    def _answer(self, method: str, arguments: dict, addr: tuple[str, int]) -> dict:
+        if method == 'ping':
+            return {}
+        if method == 'find_node':
+            return {'nodes': self._nodes_near(arguments['target'])}
+        if method == 'get_peers':
+            info_hash = arguments['info_hash']
+            result = {'nodes': self._nodes_near(info_hash), 'token': self._token(addr[0])}
+            stored = self._peers.get(info_hash, dict())
+            now = time.monotonic()
+            peers = [
+                [host, port, peer_id] for (host, port), (peer_id, expires_at) in stored.items() if expires_at >= now
+            ]
+            if peers:
+                result['peers'] = random.sample(peers, min(len(peers), MAX_PEERS_PER_RESPONSE))
+            return result
+        if method == 'announce_peer':
+            info_hash, peer_id, port = arguments['info_hash'], arguments['peer_id'], int(arguments['port'])
+            if not _is_id(info_hash) or not _is_id(peer_id) or not 0 < port < 65536:
+                raise ValueError("Malformed announce")
+            if not self._check_token(arguments['token'], addr[0]):
+                raise ValueError("Bad token")
+            # The address of the sender is stored, not the one it reports, so that nobody announces other hosts
+            self._peers.setdefault(info_hash, dict())[(addr[0], port)] = (peer_id, time.monotonic() + PEER_TTL_SECONDS)
+            return {}
+        raise ValueError(f"Unknown method {method}")
+
+    def _nodes_near(self, target: str) -> list[list]:
+        if not _is_id(target):
+            raise ValueError("Malformed target")
+        return [[contact.node_id, contact.host, contact.port] for contact in self.table.closest(target)]
+
+    # -----TOKENS-----
+
+    def _token(self, host: str) -> str:
+        self._rotate_secrets()
+        return hmac.new(self._secrets[0], host.encode(), hashlib.sha256).hexdigest()[:16]
+
+    def _check_token(self, token, host: str) -> bool:
+        self._rotate_secrets()
+        return isinstance(token, str) and any(
+            hmac.compare_digest(token, hmac.new(secret, host.encode(), hashlib.sha256).hexdigest()[:16])
+            for secret in self._secrets
+        )
+
+    def _rotate_secrets(self):
+        now = time.monotonic()
+        if now - self._secret_rotated_at >= TOKEN_ROTATION_SECONDS:
+            self._secrets = [os.urandom(16), self._secrets[0]]
+            self._secret_rotated_at = now
+
+    # -----ROUTING TABLE-----
+
+    def _on_contact(self, contact: NodeContact):
+        oldest = self.table.add(contact)
+        if oldest is not None and oldest.node_id not in self._pinging:
+            self._pinging.add(oldest.node_id)
+            self._run_in_background(self._ping_or_replace(oldest, contact))
+
+    # The least recently seen contact of the full bucket stays if it answers, otherwise the new contact replaces it
+    async def _ping_or_replace(self, oldest: NodeContact, contact: NodeContact):
+        try:
+            await self._query((oldest.host, oldest.port), 'ping', {})
+        except (asyncio.TimeoutError, OSError, RuntimeError):
+            self.table.remove(oldest.node_id)
+            self.table.add(contact)
+        finally:
+            self._pinging.discard(oldest.node_id)
+
+    def _run_in_background(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,35 @@
+import time
+
+
+class DialBackoff:
+    """
+    Remembers the failed connection attempts per peer address. After `n` failures in a row the address is not dialed
+    for `initial_delay_seconds * 2^(n-1)` seconds (but at most `max_delay_seconds`), so that dead or blackholed
+    addresses repeated in every tracker response do not take the dialing capacity from the live ones.
+    """
+
+    def __init__(self, initial_delay_seconds: float = 5.0, max_delay_seconds: float = 300.0):
+        self.initial_delay_seconds = initial_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self._failures: dict[tuple[str, int], int] = dict()  # address <-> failures in a row
+        self._retry_at: dict[tuple[str, int], float] = dict()  # address <-> the time it may be dialed again
+
+    def can_dial(self, address: tuple[str, int], now: float | None = None) -> bool:
+        """
+        :param address: (ip, port) of the peer
+        :param now: the current `time.monotonic()`, taken automatically if not given
+        """
+        retry_at = self._retry_at.get(address)
+        if retry_at is None:
+            return True
+        return (now if now is not None else time.monotonic()) >= retry_at
+
+    def on_failure(self, address: tuple[str, int], now: float | None = None):
+        failures = self._failures.get(address, 0) + 1
+        self._failures[address] = failures
+        delay = min(self.initial_delay_seconds * 2 ** (failures - 1), self.max_delay_seconds)
+        self._retry_at[address] = (now if now is not None else time.monotonic()) + delay
+
+    def on_success(self, address: tuple[str, int]):
+        self._failures.pop(address, None)
+        self._retry_at.pop(address, None)
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import socket
+import struct
+
+from core.common.peer_info import PeerInfo
+from core.p2p.resource_manager import ResourceManager
+
+# The same multicast group as in the BitTorrent local service discovery, but the packets have our own format
+MULTICAST_GROUP = '239.192.152.143'
+MULTICAST_PORT = 6771
+
+# How often the info hashes of the registered resources are announced
+ANNOUNCE_INTERVAL_SECONDS = 30
+
+# The announcement: TorrentInno[peer-id (32 bytes)][listen-port (2 bytes)][count (2 bytes)][info-hash (32 bytes)]...
+_HEADER = struct.Struct('>11s32sHH')
+_PREFIX = 'TorrentInno'.encode()
+
+# Keep each datagram within a typical MTU
+MAX_INFO_HASHES_PER_PACKET = 40
+
+
+def encode_announcement(peer_id: str, listen_port: int, info_hashes: list[str]) -> bytes:
+    return _HEADER.pack(_PREFIX, bytes.fromhex(peer_id), listen_port, len(info_hashes)) + \
+        b''.join(bytes.fromhex(info_hash) for info_hash in info_hashes)
+
+
+def decode_announcement(data: bytes) -> tuple[str, int, list[str]]:
+    """
+    :return: peer_id, listen port and the info hashes of the announcement, raises ValueError if it is malformed
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("The announcement is too short")
+    prefix, peer_id, listen_port, count = _HEADER.unpack_from(data)
+    if prefix != _PREFIX or len(data) != _HEADER.size + 32 * count:
+        raise ValueError("Not a TorrentInno announcement")
+    info_hashes = [
+        data[offset:offset + 32].hex() for offset in range(_HEADER.size, len(data), 32)
+    ]
+    return peer_id.hex(), listen_port, info_hashes
+
+
+class _DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, discovery: 'LocalPeerDiscovery'):
+        self.discovery = discovery
+
+    def datagram_received(self, data: bytes, addr):
+        self.discovery._on_announcement(data, addr[0])
+
+    def error_received(self, exc: Exception):
+        logging.debug(f"Local discovery socket error: {exc!r}")
+
+
+class LocalPeerDiscovery:
+    """
+    Finds the peers of the same local network without the tracker: every peer periodically multicasts the info hashes
+    of its resources together with its listening port, and the peers having the same resources connect to it.
+    The class works with asyncio, therefore its methods must be called on a thread with running event loop
+    """
+
+    def __init__(self, host_peer_id: str, group: str = MULTICAST_GROUP, port: int = MULTICAST_PORT):
+        self.host_peer_id = host_peer_id
+        self.group = group
+        self.port = port
+        self.listen_port: int | None = None
+        self._resource_managers: dict[str, ResourceManager] = dict()  # info_hash <-> resource manager
+        self._transport: asyncio.DatagramTransport | None = None
+        self._announce_task: asyncio.Task | None = None
+        self._submit_tasks: set[asyncio.Task] = set()
+
+    def register(self, resource_manager: ResourceManager):
+        """
+        Announce the resource of `resource_manager` and pass it the peers found for this resource
+        """
+        self._resource_managers[resource_manager.info_hash] = resource_manager
+        if self._transport is not None:
+            self._announce([resource_manager.info_hash])
+
+    def unregister(self, resource_manager: ResourceManager):
+        if self._resource_managers.get(resource_manager.info_hash) is resource_manager:
+            del self._resource_managers[resource_manager.info_hash]
+
+    async def start(self, listen_port: int):
+        """
+        Start announcing and listening for the announcements. Does nothing if the discovery is already started.
+
+        :param listen_port: the port on which the host peer accepts the connections
+        """
+        self.listen_port = listen_port
+        if self._transport is not None:
+            return
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self.port))
+        membership = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton('0.0.0.0'))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)  # Never leave the local network
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)  # Other peers may run on the same machine
+        sock.setblocking(False)
+
+        self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _DiscoveryProtocol(self),
+            sock=sock
+        )
+        self._announce_task = asyncio.create_task(self._announce_loop())
+
+    async def close(self):
+        if self._announce_task is not None:
+            self._announce_task.cancel()
+            self._announce_task = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        for task in list(self._submit_tasks):
+            task.cancel()
+
+    def _announce(self, info_hashes: list[str]):
+        for start in range(0, len(info_hashes), MAX_INFO_HASHES_PER_PACKET):
+            packet = encode_announcement(
+                self.host_peer_id,
+                self.listen_port,
+                info_hashes[start:start + MAX_INFO_HASHES_PER_PACKET]
+            )
+            self._transport.sendto(packet, (self.group, self.port))
+
+    async def _announce_loop(self):
+        while True:
+            try:
+                self._announce(list(self._resource_managers))
+            except Exception:
+                logging.exception("Failed to send the local discovery announcement")
+            await asyncio.sleep(ANNOUNCE_INTERVAL_SECONDS)
+
+    def _on_announcement(self, data: bytes, host: str):
+        try:
+            peer_id, listen_port, info_hashes = decode_announcement(data)
+        except ValueError:
+            return
+        if peer_id == self.host_peer_id:
+            return  # Our own announcement
+
+        peer = PeerInfo(public_ip=host, public_port=listen_port, peer_id=peer_id)
+        for info_hash in info_hashes:
+            resource_manager = self._resource_managers.get(info_hash)
+            if resource_manager is not None:
+                task = asyncio.create_task(resource_manager.submit_peers([peer]))
+                self._submit_tasks.add(task)
+                task.add_done_callback(self._submit_tasks.discard)
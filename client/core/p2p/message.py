@@ -1,5 +1,16 @@
 import asyncio
-from dataclasses import dataclass
+import ipaddress
+import struct
+from dataclasses import dataclass, field
+
+from core.common.bitset import Bitset
+from core.common.peer_info import PeerInfo
+
+# The Piece message up to its data: [body-length][message-type][piece-index][piece-inner-offset][block-length]
+_PIECE_HEADER = struct.Struct('>IBIII')
+
+# One peer of the Pex message: [peer-id (32 bytes)][ipv4 (4 bytes)][port (2 bytes)]
+_PEX_PEER = struct.Struct('>32s4sH')
 
 
 class Message:
@@ -11,6 +22,10 @@ class Message:
     def to_bytes(self) -> bytes:
         pass
 
+    # The same bytes as `to_bytes` split into several buffers, so that large payloads are sent without copying
+    def to_buffers(self) -> list[bytes | memoryview]:
+        return [self.to_bytes()]
+
 
 @dataclass
 class Handshake(Message):
@@ -20,6 +35,15 @@ class Handshake(Message):
     peer_id: str
     info_hash: str
 
+    @staticmethod
+    def from_bytes(data: bytes) -> 'Handshake':
+        """
+        Decode the 75 bytes of the handshake, raises ValueError if they are not a handshake
+        """
+        if len(data) != 75 or data[0:11] != "TorrentInno".encode():
+            raise ValueError("Not a TorrentInno handshake")
+        return Handshake(peer_id=data[11:43].hex(), info_hash=data[43:75].hex())
+
     def to_bytes(self) -> bytes:
         return "TorrentInno".encode() + bytes.fromhex(self.peer_id) + bytes.fromhex(self.info_hash)
 
@@ -57,14 +81,17 @@ class Piece(Message):
         assert len(self.data) == self.block_length
 
     def to_bytes(self) -> bytes:
-        return (
-                (13 + len(self.data)).to_bytes(length=4, byteorder='big') +
-                (2).to_bytes(length=1, byteorder='big') +
-                self.piece_index.to_bytes(4, byteorder='big') +
-                self.piece_inner_offset.to_bytes(4, byteorder='big') +
-                self.block_length.to_bytes(4, byteorder='big') +
-                self.data
+        return b''.join(self.to_buffers())
+
+    def to_buffers(self) -> list[bytes | memoryview]:
+        header = _PIECE_HEADER.pack(
+            13 + len(self.data),
+            2,
+            self.piece_index,
+            self.piece_inner_offset,
+            self.block_length
         )
+        return [header, self.data]
 
 
 @dataclass
@@ -72,15 +99,176 @@ class Bitfield(Message):
     """
     A dataclass for Bitfield (type 3) message
     """
-    bitfield: list[bool]
+    bitfield: Bitset
+
+    def __post_init__(self):
+        if not isinstance(self.bitfield, Bitset):
+            self.bitfield = Bitset.from_bools(self.bitfield)
+
+    @staticmethod
+    def from_bytes(data: bytes | bytearray | memoryview, pieces_count: int) -> 'Bitfield':
+        """
+        Decode the `[bitfield]` part of the message for the resource with `pieces_count` pieces
+        """
+        return Bitfield(Bitset(pieces_count, data))
+
+    def to_bytes(self) -> bytes:
+        return b''.join(self.to_buffers())
+
+    def to_buffers(self) -> list[bytes | memoryview]:
+        packed = self.bitfield.view()
+        return [(1 + len(packed)).to_bytes(length=4) + (3).to_bytes(length=1), packed]
+
+
+@dataclass
+class Have(Message):
+    """
+    A dataclass for Have (type 4) message
+    """
+    piece_index: int
+
+    def to_bytes(self) -> bytes:
+        return (
+                (5).to_bytes(length=4, byteorder='big') +
+                (4).to_bytes(length=1, byteorder='big') +
+                self.piece_index.to_bytes(4, byteorder='big')
+        )
+
+
+@dataclass
+class HaveAll(Message):
+    """
+    A dataclass for Have-All (type 5) message
+    """
+
+    def to_bytes(self) -> bytes:
+        return (1).to_bytes(length=4, byteorder='big') + (5).to_bytes(length=1, byteorder='big')
+
+
+@dataclass
+class HaveNone(Message):
+    """
+    A dataclass for Have-None (type 6) message
+    """
+
+    def to_bytes(self) -> bytes:
+        return (1).to_bytes(length=4, byteorder='big') + (6).to_bytes(length=1, byteorder='big')
+
+
+@dataclass
+class Choke(Message):
+    """
+    A dataclass for Choke (type 7) message
+    """
+
+    def to_bytes(self) -> bytes:
+        return (1).to_bytes(length=4, byteorder='big') + (7).to_bytes(length=1, byteorder='big')
+
+
+@dataclass
+class Unchoke(Message):
+    """
+    A dataclass for Unchoke (type 8) message
+    """
+
+    def to_bytes(self) -> bytes:
+        return (1).to_bytes(length=4, byteorder='big') + (8).to_bytes(length=1, byteorder='big')
+
+
+@dataclass
+class Interested(Message):
+    """
+    A dataclass for Interested (type 9) message
+    """
+
+    def to_bytes(self) -> bytes:
+        return (1).to_bytes(length=4, byteorder='big') + (9).to_bytes(length=1, byteorder='big')
+
+
+@dataclass
+class NotInterested(Message):
+    """
+    A dataclass for Not-Interested (type 10) message
+    """
+
+    def to_bytes(self) -> bytes:
+        return (1).to_bytes(length=4, byteorder='big') + (10).to_bytes(length=1, byteorder='big')
+
+
+@dataclass
+class Attach(Message):
+    """
+    A dataclass for Attach (type 11) message. It is sent only over the control channel of a multiplexed connection
+    """
+    channel_id: int
+    info_hash: str
+
+    def to_bytes(self) -> bytes:
+        return (
+                (37).to_bytes(length=4, byteorder='big') +
+                (11).to_bytes(length=1, byteorder='big') +
+                self.channel_id.to_bytes(4, byteorder='big') +
+                bytes.fromhex(self.info_hash)
+        )
+
+
+@dataclass
+class Detach(Message):
+    """
+    A dataclass for Detach (type 12) message. It is sent only over the control channel of a multiplexed connection
+    """
+    channel_id: int
+
+    def to_bytes(self) -> bytes:
+        return (
+                (5).to_bytes(length=4, byteorder='big') +
+                (12).to_bytes(length=1, byteorder='big') +
+                self.channel_id.to_bytes(4, byteorder='big')
+        )
+
+
+@dataclass
+class Pex(Message):
+    """
+    A dataclass for Pex (type 13) message: the peers the sender has connected to and disconnected from since its
+    previous Pex message. Only the peers with IPv4 addresses are transferred
+    """
+    added: list[PeerInfo] = field(default_factory=list)
+    dropped: list[PeerInfo] = field(default_factory=list)
+
+    @staticmethod
+    def _encode_peers(peers: list[PeerInfo]) -> bytes:
+        encoded = []
+        for peer in peers:
+            try:
+                ip = ipaddress.IPv4Address(peer.public_ip).packed
+            except ValueError:
+                continue
+            encoded.append(_PEX_PEER.pack(bytes.fromhex(peer.peer_id), ip, peer.public_port))
+        return len(encoded).to_bytes(2, byteorder='big') + b''.join(encoded)
+
+    @staticmethod
+    def _decode_peers(data: bytes, offset: int) -> tuple[list[PeerInfo], int]:
+        count = int.from_bytes(data[offset:offset + 2], byteorder='big')
+        offset += 2
+        if len(data) < offset + count * _PEX_PEER.size:
+            raise RuntimeError("The Pex message is shorter than its peer count requires")
+        peers = []
+        for _ in range(count):
+            peer_id, ip, port = _PEX_PEER.unpack_from(data, offset)
+            peers.append(PeerInfo(public_ip=str(ipaddress.IPv4Address(ip)), public_port=port, peer_id=peer_id.hex()))
+            offset += _PEX_PEER.size
+        return peers, offset
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'Pex':
+        """
+        Decode the `[message-data]` part of the message
+        """
+        added, offset = Pex._decode_peers(data, 0)
+        dropped, _ = Pex._decode_peers(data, offset)
+        return Pex(added, dropped)
 
     def to_bytes(self) -> bytes:
-        result: list[int] = []
-        for i in range(0, len(self.bitfield), 8):
-            current_byte = 0
-            for j in range(i, min(len(self.bitfield), i + 8)):
-                if self.bitfield[j]:
-                    current_byte += 1 << (i + 7 - j)
-            result.append(current_byte)
-
-        return (1 + len(result)).to_bytes(length=4) + (3).to_bytes(length=1) + bytes(result)
+        data = self._encode_peers(self.added) + self._encode_peers(self.dropped)
+        return (1 + len(data)).to_bytes(length=4, byteorder='big') + (13).to_bytes(length=1, byteorder='big') + data
@@ -0,0 +1,388 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from core.common.peer_info import PeerInfo
+from core.common.resource import Resource
+from core.p2p.connection import (
+    Connection, CONNECT_TIMEOUT_SECONDS, HANDSHAKE_TIMEOUT_SECONDS, MAX_MESSAGE_LENGTH, MAX_UNKNOWN_MESSAGE_LENGTH
+)
+from core.p2p.message import Message, Piece, Handshake, Attach, Detach
+
+# The info hash in the handshake that opens a multiplexed connection instead of a single-resource one
+SESSION_INFO_HASH = '00' * 32
+
+# The channel that carries Attach/Detach messages
+CONTROL_CHANNEL_ID = 0
+
+ATTACH_TIMEOUT_SECONDS = 10
+
+# The channel whose listeners leave this many messages waiting is closed (the shared connection is never suspended
+# for one channel, that would hold up the channels of all the other resources)
+_CHANNEL_QUEUE_SIZE = 64
+
+
+# Insert the channel id into the encoded message: [body-length][message-body] -> [body-length][channel-id][message-body]
+def _frame(message: Message, channel_id: int) -> tuple[list[bytes | memoryview], int]:
+    buffers = message.to_buffers()
+    length = sum(len(buffer) for buffer in buffers) + 4
+    header = (length - 4).to_bytes(4) + channel_id.to_bytes(4) + bytes(buffers[0][4:])
+    return [header] + buffers[1:], length
+
+
+class ChannelConnection(Connection):
+    """
+    The connection of one resource carried by a `SessionConnection` together with the connections of the other
+    resources shared by the same two peers. For the listeners it behaves exactly as an ordinary `Connection`.
+    """
+
+    def __init__(self, session: 'SessionConnection', channel_id: int, resource: Resource):
+        super().__init__(session.reader, session.writer, resource)
+        self.session = session
+        self.channel_id = channel_id
+        self._messages: asyncio.Queue[Message | BaseException] = asyncio.Queue(maxsize=_CHANNEL_QUEUE_SIZE)
+        self._closed = False
+
+    # Called by the session for each message of the channel, returns False if the listeners fell too far behind
+    def _receive(self, message: Message) -> bool:
+        try:
+            self._messages.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    # Called by the session once the channel can no longer be used
+    def _lose(self, cause: BaseException):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._messages.put_nowait(cause)
+        except asyncio.QueueFull:
+            # Nobody reads the queue anymore, drop the pending messages
+            while not self._messages.empty():
+                self._messages.get_nowait()
+            self._messages.put_nowait(cause)
+
+    async def _listen_on_reader(self):
+        try:
+            while True:
+                message = await self._messages.get()
+                if isinstance(message, BaseException):
+                    await self._notify_close(message)
+                    return
+                await self._notify(message)
+        finally:
+            self._stop_workers()
+
+    async def accept(self):
+        """
+        Confirm the channel opened by the remote peer. The messages can be sent over the channel only after that.
+        """
+        await self.session._send_control(Attach(self.channel_id, self.resource.get_info_hash()))
+
+    async def send_message(self, message: Message):
+        if self._closed:
+            raise ConnectionResetError("Cannot send message over the closed channel")
+        buffers, length = _frame(message, self.channel_id)
+        await self.rate_limiter.upload.consume(length)
+        await self.session._enqueue(buffers, length, isinstance(message, Piece))
+
+    async def close(self):
+        self._stop_listening()
+        self._stop_workers()
+        if not self._closed:
+            self._closed = True
+            await self.session._detach(self.channel_id)
+
+
+class SessionConnection(Connection):
+    """
+    The TCP connection between two peers shared by all resources they both have. Each frame carries the channel id:
+    `[body-length (4 bytes)][channel-id (4 bytes)][message-type (1 byte)][message-data]`, where `body-length` counts
+    everything after itself. The channel 0 carries only the Attach/Detach messages opening and closing the channels.
+
+    A slow channel does not hold up the others: the messages are queued for the listeners of each channel, and the
+    channel whose queue is full is closed. The download limit of a resource is still waited for by the shared
+    reader, so a limited resource slows down the resources sharing the connection with it.
+    """
+
+    def __init__(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            multiplexer: 'Multiplexer',
+            peer_id: str,
+            initiator: bool
+    ):
+        super().__init__(reader, writer, resource=None)
+        self.multiplexer = multiplexer
+        self.peer_id = peer_id
+        self.channels: dict[int, ChannelConnection] = dict()  # channel_id <-> channel
+
+        # Channel ids of the two sides never collide: the initiator of the connection uses odd ids, the other side even
+        self._next_channel_id = 1 if initiator else 2
+        self._pending_attach: dict[int, asyncio.Future] = dict()  # channel_id <-> acknowledgement of our Attach
+
+    async def _send_control(self, message: Message):
+        buffers, length = _frame(message, CONTROL_CHANNEL_ID)
+        await self._enqueue(buffers, length, False)
+
+    async def _read_control(self, message_type: int, message_length: int):
+        if message_type == 11:
+            # Attach message: either the peer opens a new channel or acknowledges the channel opened by us
+            channel_id = await self._read_int_big_endian(4)
+            info_hash = (await self.reader.readexactly(32)).hex()
+
+            acknowledgement = self._pending_attach.pop(channel_id, None)
+            if acknowledgement is not None:
+                if not acknowledgement.done():
+                    acknowledgement.set_result(True)
+                return
+
+            resource = self.multiplexer._get_resource(info_hash)
+            if resource is None or channel_id in self.channels:
+                await self._send_control(Detach(channel_id))
+                return
+            # Register the channel right away, the peer starts sending over it right after the acknowledgement
+            channel = ChannelConnection(self, channel_id, resource)
+            self.channels[channel_id] = channel
+            asyncio.create_task(self._attach_incoming(channel, info_hash))
+        elif message_type == 12:
+            # Detach message
+            channel_id = await self._read_int_big_endian(4)
+
+            acknowledgement = self._pending_attach.pop(channel_id, None)
+            if acknowledgement is not None and not acknowledgement.done():
+                acknowledgement.set_result(False)
+
+            channel = self.channels.pop(channel_id, None)
+            if channel is not None:
+                channel._lose(ConnectionResetError("The channel is closed by the peer"))
+        else:
+            # Skip the body of unknown control message
+            if message_length - 1 > MAX_UNKNOWN_MESSAGE_LENGTH:
+                raise RuntimeError("The length of unknown message exceeded the limit")
+            await self.reader.readexactly(message_length - 1)
+
+    async def _attach_incoming(self, channel: ChannelConnection, info_hash: str):
+        try:
+            accepted = await self.multiplexer._accept_channel(self.peer_id, channel, info_hash)
+        except Exception:
+            logging.exception(f"Failed to accept channel {channel.channel_id} from {self.peer_id[:6]}")
+            accepted = False
+        if not accepted and self.channels.get(channel.channel_id) is channel:
+            self.channels.pop(channel.channel_id)
+            channel._closed = True
+            try:
+                await self._send_control(Detach(channel.channel_id))
+            except Exception:
+                pass
+
+    async def _detach(self, channel_id: int):
+        self.channels.pop(channel_id, None)
+        try:
+            await self._send_control(Detach(channel_id))
+        except Exception:
+            pass  # The whole connection is already broken
+        if not self.channels:
+            await self.close()
+
+    async def open_channel(self, resource: Resource) -> ChannelConnection:
+        """
+        Open the channel for the resource. Raises the exception if the peer does not accept it.
+        """
+        channel_id = self._next_channel_id
+        self._next_channel_id += 2
+
+        channel = ChannelConnection(self, channel_id, resource)
+        self.channels[channel_id] = channel
+        acknowledgement = asyncio.get_running_loop().create_future()
+        self._pending_attach[channel_id] = acknowledgement
+        try:
+            await self._send_control(Attach(channel_id, resource.get_info_hash()))
+            accepted = await asyncio.wait_for(acknowledgement, ATTACH_TIMEOUT_SECONDS)
+        except BaseException:
+            self._pending_attach.pop(channel_id, None)
+            self.channels.pop(channel_id, None)
+            raise
+
+        if not accepted:
+            self.channels.pop(channel_id, None)
+            raise RuntimeError(f"Peer {self.peer_id[:6]} refused the channel for {resource.get_info_hash()[:6]}")
+        return channel
+
+    async def _listen_on_reader(self):
+        cause: BaseException = ConnectionResetError("The connection is closed")
+        try:
+            while True:
+                body_length = await self._read_int_big_endian(4)
+                if body_length < 5:
+                    raise RuntimeError("The frame has no channel id or message type")
+                if body_length - 4 > MAX_MESSAGE_LENGTH:
+                    raise RuntimeError("The length of message exceeded the limit")
+                channel_id = await self._read_int_big_endian(4)
+                message_type = await self._read_int_big_endian(1)
+                message_length = body_length - 4
+
+                if channel_id == CONTROL_CHANNEL_ID:
+                    await self._read_control(message_type, message_length)
+                    continue
+
+                channel = self.channels.get(channel_id)
+                if channel is None:
+                    # The channel is already closed on our side (the skipped length is within MAX_MESSAGE_LENGTH:
+                    # the messages sent before the peer learns about the closing may be Pieces)
+                    await self.reader.readexactly(message_length - 1)
+                    continue
+
+                await channel.rate_limiter.download.consume(4 + message_length)
+                message = await self._read_message(message_type, message_length, channel.resource)
+                if message is not None and not channel._receive(message):
+                    logging.info(f"Close channel {channel_id} to {self.peer_id[:6]}: the listeners fell behind")
+                    channel._lose(RuntimeError("The listeners of the channel fell behind the connection"))
+                    await self._detach(channel_id)
+        except Exception as e:
+            cause = e
+        finally:
+            for channel in self.channels.values():
+                channel._lose(cause)
+            self.channels.clear()
+            for acknowledgement in self._pending_attach.values():
+                if not acknowledgement.done():
+                    acknowledgement.set_result(False)
+            self._pending_attach.clear()
+
+            self.multiplexer._remove_session(self)
+            self._stop_workers()
+            self.writer.close()
+
+    async def close(self):
+        self._stop_workers()
+        self._stop_listening()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+class Multiplexer:
+    """
+    Keeps a single `SessionConnection` with every remote peer and opens the channels of resources over it,
+    so that two peers sharing many resources keep one TCP connection and one receive loop.
+    The class works with asyncio, therefore its methods must be called on a thread with running event loop
+    """
+
+    def __init__(self, host_peer_id: str):
+        self.host_peer_id = host_peer_id
+        self.sessions: dict[str, SessionConnection] = dict()  # peer_id <-> session connection
+
+        # info_hash <-> (resource, callback deciding whether to accept the channel opened by remote peer)
+        self._resources: dict[str, tuple[Resource, Callable[[str, ChannelConnection], Awaitable[bool]]]] = dict()
+        self._dialing: dict[str, asyncio.Future] = dict()  # peer_id <-> session being established
+
+    def register(
+            self,
+            resource: Resource,
+            on_channel: Callable[[str, ChannelConnection], Awaitable[bool]]
+    ):
+        """
+        Accept the channels for the resource. `on_channel(peer_id, channel)` is called for every channel opened
+        by a remote peer; it must call `channel.accept()` and return True, or return False to refuse the channel.
+        """
+        self._resources[resource.get_info_hash()] = (resource, on_channel)
+
+    def unregister(self, resource: Resource):
+        self._resources.pop(resource.get_info_hash(), None)
+
+    def _get_resource(self, info_hash: str) -> Resource | None:
+        entry = self._resources.get(info_hash)
+        return entry[0] if entry is not None else None
+
+    async def _accept_channel(self, peer_id: str, channel: ChannelConnection, info_hash: str) -> bool:
+        entry = self._resources.get(info_hash)
+        if entry is None:
+            return False
+        return await entry[1](peer_id, channel)
+
+    def _remove_session(self, session: SessionConnection):
+        if self.sessions.get(session.peer_id) is session:
+            del self.sessions[session.peer_id]
+
+    async def _get_session(self, peer: PeerInfo) -> SessionConnection:
+        session = self.sessions.get(peer.peer_id)
+        if session is not None:
+            return session
+
+        # Somebody is already connecting to this peer
+        dialing = self._dialing.get(peer.peer_id)
+        if dialing is not None:
+            return await asyncio.shield(dialing)
+
+        dialing = asyncio.get_running_loop().create_future()
+        self._dialing[peer.peer_id] = dialing
+        try:
+            session = await establish_session(self.host_peer_id, peer, self)
+            self.sessions[peer.peer_id] = session
+            await session.listen()
+            dialing.set_result(session)
+            return session
+        except Exception as e:
+            dialing.set_exception(e)
+            dialing.exception()  # Mark the exception as retrieved if nobody else waits for it
+            raise
+        finally:
+            self._dialing.pop(peer.peer_id, None)
+
+    async def open_channel(self, peer: PeerInfo, resource: Resource) -> ChannelConnection:
+        """
+        Open the channel for the resource to the peer, establishing the shared connection if there is none yet.
+        """
+        session = await self._get_session(peer)
+        return await session.open_channel(resource)
+
+    async def accept_session(self, peer_id: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Take the incoming multiplexed connection whose handshake has already been read, and answer the handshake.
+        """
+        if self.host_peer_id < peer_id or peer_id in self.sessions:
+            writer.close()
+            return
+        writer.write(Handshake(self.host_peer_id, SESSION_INFO_HASH).to_bytes())
+        await writer.drain()
+        session = SessionConnection(reader, writer, self, peer_id, initiator=False)
+        self.sessions[peer_id] = session
+        await session.listen()
+
+    async def close(self):
+        await asyncio.gather(
+            *(session.close() for session in list(self.sessions.values())),
+            return_exceptions=True
+        )
+
+
+# Create the multiplexed connection with some peer
+async def establish_session(
+        host_peer_id: str,
+        destination_peer: PeerInfo,
+        multiplexer: Multiplexer
+) -> SessionConnection:
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(destination_peer.public_ip, destination_peer.public_port),
+        CONNECT_TIMEOUT_SECONDS
+    )
+
+    handshake = Handshake(host_peer_id, SESSION_INFO_HASH)
+    try:
+        writer.write(handshake.to_bytes())
+        response = await asyncio.wait_for(reader.readexactly(75), HANDSHAKE_TIMEOUT_SECONDS)
+        assert response[0:11].decode() == 'TorrentInno'
+        assert response[11:43].hex() == destination_peer.peer_id
+        assert response[43:75].hex() == SESSION_INFO_HASH
+    except Exception:
+        writer.close()
+        await writer.wait_closed()
+        raise  # re-raise the error
+
+    return SessionConnection(reader, writer, multiplexer, destination_peer.peer_id, initiator=True)
@@ -0,0 +1,131 @@
+import json
+import logging
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import aiofiles
+
+from core.common.peer_info import PeerInfo
+from core.common.resource import Resource
+
+# At most this many peers are remembered, the ones with the best history
+MAX_CACHED_PEERS = 50
+
+# A peer that has not been connected for this long is forgotten
+MAX_PEER_AGE_SECONDS = 7 * 24 * 60 * 60
+
+# A peer that could not be connected this many times in a row is forgotten
+MAX_PEER_FAILURES = 3
+
+# The weight of the last connection in the smoothed download speed of a peer
+THROUGHPUT_SMOOTHING = 0.5
+
+
+@dataclass
+class CachedPeer:
+    public_ip: str
+    public_port: int
+    successes: int = 0  # The connections established with the peer
+    failures: int = 0  # The failed connection attempts since the last established connection
+    last_seen: float = 0.0  # time.time() of the last established connection
+    bytes_downloaded: int = 0  # Bytes received from the peer over all connections
+    throughput: float = 0.0  # The smoothed download speed of the connections with the peer (bytes per second)
+
+    def rank(self) -> tuple[float, int]:
+        return -self.throughput, -self.successes
+
+
+class PeerCache:
+    """
+    The peers the host peer has recently connected to for the resource, with the history of the connections. The
+    cache is stored next to the destination (like the save file), so that after a restart the download resumes with
+    the peers that worked before instead of waiting for the tracker. The peers failing to connect again and again
+    or not connected for long are forgotten.
+    """
+
+    def __init__(self, destination: Path, resource: Resource):
+        self.cache_file = \
+            destination.parent.joinpath(f".torrentinno_peers_{destination.name}_{resource.get_info_hash()}")
+        self.changed = False  # The entries have changed since the last load or save
+        self._peers: dict[str, CachedPeer] = dict()  # peer_id <-> entry
+
+    async def load(self, now: float | None = None):
+        """
+        Read the cache file (a missing or corrupted file means no peers)
+
+        :param now: the current `time.time()`, taken automatically if not given
+        """
+        try:
+            async with aiofiles.open(self.cache_file, mode='rb') as f:
+                content = json.loads(await f.read())
+            self._peers = {peer_id: CachedPeer(**entry) for peer_id, entry in content.items()}
+        except FileNotFoundError:
+            self._peers = dict()
+        except (ValueError, TypeError, AttributeError) as e:
+            logging.info(f"Failed to read the peer cache {self.cache_file}: {e!r}")
+            self._peers = dict()
+        self.changed = False
+        self._age_out(now)
+
+    async def save(self, now: float | None = None):
+        self._age_out(now)
+        content = json.dumps({peer_id: asdict(entry) for peer_id, entry in self._peers.items()})
+        async with aiofiles.open(self.cache_file, mode='w') as f:
+            await f.write(content)
+        self.changed = False
+
+    async def remove(self):
+        self._peers = dict()
+        self.changed = False
+        self.cache_file.unlink(missing_ok=True)
+
+    def peers(self) -> list[PeerInfo]:
+        """
+        :return: the cached peers, the fastest and most reliable ones first
+        """
+        entries = sorted(self._peers.items(), key=lambda item: item[1].rank())
+        return [PeerInfo(entry.public_ip, entry.public_port, peer_id) for peer_id, entry in entries]
+
+    def on_connected(self, peer: PeerInfo, now: float | None = None):
+        entry = self._peers.get(peer.peer_id)
+        if entry is None:
+            entry = self._peers[peer.peer_id] = CachedPeer(peer.public_ip, peer.public_port)
+        entry.public_ip, entry.public_port = peer.public_ip, peer.public_port
+        entry.successes += 1
+        entry.failures = 0
+        entry.last_seen = now if now is not None else time.time()
+        self.changed = True
+
+    def on_failure(self, peer_id: str):
+        entry = self._peers.get(peer_id)
+        if entry is None:
+            return
+        entry.failures += 1
+        if entry.failures >= MAX_PEER_FAILURES:
+            del self._peers[peer_id]
+        self.changed = True
+
+    def on_disconnected(self, peer_id: str, bytes_downloaded: int, connected_seconds: float):
+        """
+        Add the transfer of the closed connection to the history of the peer (the peers not in the cache are ignored)
+        """
+        entry = self._peers.get(peer_id)
+        if entry is None:
+            return
+        entry.bytes_downloaded += bytes_downloaded
+        if connected_seconds > 0:
+            throughput = bytes_downloaded / connected_seconds
+            entry.throughput += THROUGHPUT_SMOOTHING * (throughput - entry.throughput)
+        self.changed = True
+
+    # Forget the peers not connected for long, and the worst peers over the limit
+    def _age_out(self, now: float | None = None):
+        oldest = (now if now is not None else time.time()) - MAX_PEER_AGE_SECONDS
+        entries = sorted(
+            ((peer_id, entry) for peer_id, entry in self._peers.items() if entry.last_seen >= oldest),
+            key=lambda item: item[1].rank()
+        )[:MAX_CACHED_PEERS]
+        if len(entries) != len(self._peers):
+            self.changed = True
+        self._peers = dict(entries)
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+
+from core.p2p.connection import HANDSHAKE_TIMEOUT_SECONDS
+from core.p2p.message import Handshake
+from core.p2p.multiplexer import Multiplexer, SESSION_INFO_HASH
+from core.p2p.resource_manager import ResourceManager
+
+
+class PeerListener:
+    """
+    The single listening socket shared by all resources of the session. It reads the handshake of every incoming
+    connection and hands the connection over to the `ResourceManager` of the resource from the handshake
+    (or to the multiplexer, if the peer opens the connection shared by all resources).
+    The class works with asyncio, therefore its methods must be called on a thread with running event loop
+    """
+
+    def __init__(self, multiplexer: Multiplexer | None = None):
+        self.multiplexer = multiplexer
+        self.port: int | None = None
+        self._resource_managers: dict[str, ResourceManager] = dict()  # info_hash <-> resource manager
+        self._server: asyncio.Server | None = None
+
+    def register(self, resource_manager: ResourceManager):
+        """
+        Route the incoming connections for the resource of `resource_manager` to it
+        """
+        self._resource_managers[resource_manager.info_hash] = resource_manager
+
+    def unregister(self, resource_manager: ResourceManager):
+        if self._resource_managers.get(resource_manager.info_hash) is resource_manager:
+            del self._resource_managers[resource_manager.info_hash]
+
+    async def start(self, host: str = '0.0.0.0', port: int = 0) -> int:
+        """
+        Start accepting the connections. Does nothing if the listener is already started.
+
+        :param port: the port to listen on, 0 means some random port chosen by the OS
+        :return: the port on which the connections are accepted
+        """
+        if self._server is None:
+            self._server = await asyncio.start_server(self._handle_incoming_connection, host=host, port=port)
+            self.port = self._server.sockets[0].getsockname()[1]
+            logging.info(f"Listen for peers on port {self.port}")
+        return self.port
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            self.port = None
+
+    async def _handle_incoming_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            handshake = Handshake.from_bytes(await asyncio.wait_for(reader.readexactly(75), HANDSHAKE_TIMEOUT_SECONDS))
+        except Exception:
+            logging.exception("Failed to read the handshake of incoming connection")
+            writer.close()
+            return
+
+        if handshake.info_hash == SESSION_INFO_HASH and self.multiplexer is not None:
+            await self.multiplexer.accept_session(handshake.peer_id, reader, writer)
+            return
+
+        resource_manager = self._resource_managers.get(handshake.info_hash)
+        if resource_manager is None:
+            logging.info(f"Peer {handshake.peer_id[:6]} asks for unknown resource {handshake.info_hash[:6]}")
+            writer.close()
+            return
+        await resource_manager.accept_connection(handshake.peer_id, handshake.info_hash, reader, writer)
@@ -0,0 +1,334 @@
+import asyncio
+import struct
+
+from core.p2p.connection import Connection, MAX_BLOCK_LENGTH, MAX_PEX_LENGTH
+from core.p2p.message import (
+    Request, Piece, Bitfield, Message, Have, HaveAll, HaveNone, Choke, Unchoke, Interested, NotInterested, Pex
+)
+from core.common.resource import Resource
+
+# [body-length (4 bytes)][message-type (1 byte)]
+_FRAME_HEADER = struct.Struct('>IB')
+# [piece-index (4 bytes)][piece-inner-offset (4 bytes)][block-length (4 bytes)]
+_BLOCK_HEADER = struct.Struct('>III')
+# [piece-index (4 bytes)]
+_PIECE_INDEX = struct.Struct('>I')
+
+DEFAULT_RECEIVE_BUFFER_SIZE = 64 * 1024
+
+# Stop reading from the socket while this many parsed messages wait for the listeners
+_PAUSE_READING_QUEUE_SIZE = 64
+
+
+class _PeerProtocol(asyncio.BufferedProtocol):
+    """
+    Receives the length-prefixed peer messages straight into a preallocated buffer. Small messages are parsed in place,
+    the data of the Piece messages is received directly into the buffer that is later handed to the listeners.
+    """
+
+    def __init__(self, connection: 'ProtocolConnection', buffer_size: int):
+        self.connection = connection
+        self.transport: asyncio.Transport | None = None
+
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # The first byte that is not parsed yet
+        self._end = 0  # The end of the received data
+
+        # The Piece message whose data is being received at the moment
+        self._piece: Piece | None = None
+        self._piece_view: memoryview | None = None
+        self._piece_filled = 0
+
+        self._paused_writing = False
+        self._drain_waiters: list[asyncio.Future] = []
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._piece is not None:
+            return self._piece_view[self._piece_filled:]
+
+        if self._end == len(self._buffer):
+            self._compact()
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        try:
+            self.connection._account_received(nbytes)
+            if self._piece is not None:
+                self._piece_filled += nbytes
+                if self._piece_filled == self._piece.block_length:
+                    self._complete_piece()
+                return
+
+            self._end += nbytes
+            self._parse_frames()
+        except Exception as e:
+            self.connection._lose(e)
+
+    def eof_received(self) -> bool:
+        self.connection._lose(EOFError("The connection is closed by the peer"))
+        return False
+
+    def connection_lost(self, exc: Exception | None):
+        self.connection._lose(exc or ConnectionResetError("The connection is lost"))
+
+        self._paused_writing = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError("The connection is lost"))
+        self._drain_waiters.clear()
+
+    def pause_writing(self):
+        self._paused_writing = True
+
+    def resume_writing(self):
+        self._paused_writing = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._drain_waiters.clear()
+
+    async def drain(self):
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionResetError("The connection is closed")
+        if not self._paused_writing:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    # Feed the bytes received before the protocol has been attached to the transport
+    def feed(self, data: bytes):
+        offset = 0
+        while offset < len(data):
+            buffer = self.get_buffer(len(data) - offset)
+            nbytes = min(len(buffer), len(data) - offset)
+            buffer[:nbytes] = data[offset:offset + nbytes]
+            self.buffer_updated(nbytes)
+            offset += nbytes
+
+    # Move the unparsed bytes to the beginning of the buffer (or grow the buffer if it is full with one frame)
+    def _compact(self):
+        pending = self._end - self._start
+        if self._start == 0:
+            buffer = bytearray(2 * len(self._buffer))
+            buffer[:pending] = self._view[:pending]
+            self._view.release()
+            self._buffer = buffer
+            self._view = memoryview(self._buffer)
+        else:
+            self._buffer[:pending] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+    def _parse_frames(self):
+        while self._piece is None and self._end - self._start >= _FRAME_HEADER.size:
+            available = self._end - self._start
+            message_length, message_type = _FRAME_HEADER.unpack_from(self._buffer, self._start)
+            if message_length == 0:
+                raise RuntimeError("The message has no type")
+            body_start = self._start + _FRAME_HEADER.size
+
+            if message_type == 2:
+                # Piece message: only the block header is parsed here, the data goes to its own buffer
+                if available < _FRAME_HEADER.size + _BLOCK_HEADER.size:
+                    break
+                piece_index, piece_inner_offset, block_length = _BLOCK_HEADER.unpack_from(self._buffer, body_start)
+                if block_length > MAX_BLOCK_LENGTH:
+                    raise RuntimeError("The length of data exceeded 1 MB")
+                if message_length != 1 + _BLOCK_HEADER.size + block_length:
+                    raise RuntimeError("The length of Piece message does not match its block length")
+
+                data_start = body_start + _BLOCK_HEADER.size
+                received = min(block_length, self._end - data_start)
+                data = bytearray(block_length)
+                data[:received] = self._view[data_start:data_start + received]
+                self._start = data_start + received
+
+                self._piece = Piece(piece_index, piece_inner_offset, block_length, data)
+                self._piece_view = memoryview(data)
+                self._piece_filled = received
+                if received == block_length:
+                    self._complete_piece()
+                continue
+
+            if message_length > MAX_BLOCK_LENGTH:
+                raise RuntimeError("The length of message exceeded 1 MB")
+            frame_length = 4 + message_length
+            if available < frame_length:
+                break
+
+            message = self._parse_message(message_type, body_start, self._start + frame_length)
+            self._start += frame_length
+            if message is not None:
+                self.connection._receive(message)
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _parse_message(self, message_type: int, body_start: int, body_end: int) -> Message | None:
+        if message_type == 1:
+            # Request message
+            self._check_body_length(body_start, body_end, _BLOCK_HEADER.size)
+            return Request(*_BLOCK_HEADER.unpack_from(self._buffer, body_start))
+        elif message_type == 3:
+            # Bitfield message
+            return Bitfield.from_bytes(self._view[body_start:body_end], len(self.connection.resource.pieces))
+        elif message_type == 4:
+            # Have message
+            self._check_body_length(body_start, body_end, _PIECE_INDEX.size)
+            return Have(*_PIECE_INDEX.unpack_from(self._buffer, body_start))
+        elif message_type == 5:
+            # Have-All message
+            return HaveAll()
+        elif message_type == 6:
+            # Have-None message
+            return HaveNone()
+        elif message_type == 7:
+            # Choke message
+            return Choke()
+        elif message_type == 8:
+            # Unchoke message
+            return Unchoke()
+        elif message_type == 9:
+            # Interested message
+            return Interested()
+        elif message_type == 10:
+            # Not-Interested message
+            return NotInterested()
+        elif message_type == 13:
+            # Pex message
+            if body_end - body_start > MAX_PEX_LENGTH:
+                raise RuntimeError("The length of Pex message exceeded the limit")
+            return Pex.from_bytes(bytes(self._view[body_start:body_end]))
+        # Unknown message types are skipped
+        return None
+
+    @staticmethod
+    def _check_body_length(body_start: int, body_end: int, expected: int):
+        if body_end - body_start < expected:
+            raise RuntimeError("The message is shorter than its type requires")
+
+    def _complete_piece(self):
+        piece = self._piece
+        self._piece_view.release()
+        self._piece = None
+        self._piece_view = None
+        self._piece_filled = 0
+        self.connection._receive(piece)
+
+
+class ProtocolConnection(Connection):
+    """
+    The `Connection` implementation built on top of `asyncio.BufferedProtocol`. It is constructed from the stream pair
+    used for the handshake and then takes over its transport, so that the received bytes no longer go through
+    the internal buffers of `asyncio.StreamReader`. The listeners are notified in the same order and with the same
+    callbacks as in `Connection`.
+    """
+
+    def __init__(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            resource: Resource,
+            buffer_size: int = DEFAULT_RECEIVE_BUFFER_SIZE
+    ):
+        super().__init__(reader, writer, resource)
+        self._messages: asyncio.Queue[Message | BaseException] = asyncio.Queue()
+        self._lost = False
+
+        # Received bytes not yet taken from the download limiter (reading is paused meanwhile)
+        self._throttled_bytes = 0
+        self._throttle_task: asyncio.Task | None = None
+
+        self.transport: asyncio.Transport = writer.transport
+        self._protocol = _PeerProtocol(self, buffer_size)
+        self.transport.set_protocol(self._protocol)
+        self._protocol.connection_made(self.transport)
+
+        # The stream reader may already hold the messages that came right after the handshake
+        leftover = bytes(reader._buffer)
+        reader._buffer.clear()
+        self._protocol.feed(leftover)
+
+        if self.transport.is_closing():
+            self._lose(ConnectionResetError("The connection is lost"))
+        else:
+            self.transport.resume_reading()
+            self._update_reading()
+
+    # Read from the socket only while the listeners keep up and the download limit is not exceeded
+    def _update_reading(self):
+        if self.transport.is_closing():
+            return
+        if self._throttle_task is not None or self._messages.qsize() >= _PAUSE_READING_QUEUE_SIZE:
+            self.transport.pause_reading()
+        elif self._messages.qsize() < _PAUSE_READING_QUEUE_SIZE // 2:
+            self.transport.resume_reading()
+
+    # Called by the protocol for each received chunk of bytes
+    def _account_received(self, nbytes: int):
+        if self._throttle_task is None and not self.rate_limiter.download.is_limited():
+            return
+        self._throttled_bytes += nbytes
+        if self._throttle_task is None:
+            self._throttle_task = asyncio.get_running_loop().create_task(self._throttle())
+            self._update_reading()
+
+    async def _throttle(self):
+        while self._throttled_bytes:
+            nbytes, self._throttled_bytes = self._throttled_bytes, 0
+            await self.rate_limiter.download.consume(nbytes)
+        self._throttle_task = None
+        self._update_reading()
+
+    # Called by the protocol for each parsed message
+    def _receive(self, message: Message):
+        self._messages.put_nowait(message)
+        self._update_reading()
+
+    # Called by the protocol once the connection can no longer be used
+    def _lose(self, cause: BaseException):
+        if self._lost:
+            return
+        self._lost = True
+        self._messages.put_nowait(cause)
+        self.transport.close()
+
+    # Notify the listeners about the received messages one by one (just like `Connection` does)
+    async def _listen_on_reader(self):
+        try:
+            while True:
+                message = await self._messages.get()
+                if isinstance(message, BaseException):
+                    await self._notify_close(message)
+                    return
+
+                self._update_reading()
+                await self._notify(message)
+        finally:
+            self._stop_workers()
+
+    def _writelines(self, buffers: list[bytes | memoryview]):
+        self.transport.writelines(buffers)
+
+    async def _drain(self):
+        await self._protocol.drain()
+
+    def _abort(self):
+        self._lose(ConnectionResetError("Failed to send message"))
+
+    def _stop_workers(self):
+        super()._stop_workers()
+        if self._throttle_task is not None:
+            self._throttle_task.cancel()
+            self._throttle_task = None
+
+    async def close(self):
+        self._stop_listening()
+        self._stop_workers()
+        self._lost = True
+        self.transport.close()
@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+# A waiting consumer re-checks the bucket at least this often, so that the changed rate is picked up quickly
+_MAX_WAIT_SECONDS = 0.25
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the number of bytes per second. The bucket may have a parent: then the bytes are taken
+    from this bucket and from all of its ancestors.
+
+    Consumers of one bucket are served one at a time, and a bucket waits in its parent's queue with at most one
+    request. Hence, the parent serves its children in turns, and a child with many busy consumers (a big seed with many
+    connections, for example) gets the same share of the parent's rate as a child with a single consumer.
+    """
+
+    def __init__(self, rate_bytes_per_sec: int | None = None, parent: 'TokenBucket | None' = None):
+        """
+        :param rate_bytes_per_sec: the limit of the bucket, None means unlimited
+        :param parent: the bucket which also limits the bytes passed through this bucket
+        """
+        self.parent = parent
+        self.rate_bytes_per_sec = rate_bytes_per_sec
+        self._tokens = float(self._burst())
+        self._last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    # The bucket can accumulate one second worth of tokens
+    def _burst(self) -> int:
+        return self.rate_bytes_per_sec or 0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate_bytes_per_sec is not None:
+            self._tokens = min(
+                float(self._burst()),
+                self._tokens + (now - self._last_refill) * self.rate_bytes_per_sec
+            )
+        self._last_refill = now
+
+    def set_rate(self, rate_bytes_per_sec: int | None):
+        """
+        Change the limit of the bucket (takes effect for the consumers that are already waiting too)
+        """
+        self._refill()
+        self.rate_bytes_per_sec = rate_bytes_per_sec
+        self._tokens = min(self._tokens, float(self._burst()))
+
+    def is_limited(self) -> bool:
+        """
+        :return: whether this bucket or any of its ancestors has a limit
+        """
+        bucket = self
+        while bucket is not None:
+            if bucket.rate_bytes_per_sec is not None:
+                return True
+            bucket = bucket.parent
+        return False
+
+    async def _take(self, nbytes: int):
+        self._refill()
+        # A request bigger than the burst only waits for the full bucket and leaves it in debt
+        while self.rate_bytes_per_sec is not None and self._tokens < min(nbytes, self._burst()):
+            deficit = min(nbytes, self._burst()) - self._tokens
+            await asyncio.sleep(min(deficit / self.rate_bytes_per_sec, _MAX_WAIT_SECONDS))
+            self._refill()
+        if self.rate_bytes_per_sec is not None:
+            self._tokens -= nbytes
+
+    async def consume(self, nbytes: int):
+        """
+        Wait until `nbytes` bytes may be passed through this bucket and its ancestors
+        """
+        if not self.is_limited():
+            return
+        async with self._lock:
+            await self._take(nbytes)
+            if self.parent is not None:
+                await self.parent.consume(nbytes)
+
+
+class RateLimiter:
+    """
+    The pair of upload and download token buckets. Limiters form a hierarchy (session -> resource -> peer),
+    every level can be limited separately and the limits can be changed at any time.
+    """
+
+    def __init__(
+            self,
+            upload_bytes_per_sec: int | None = None,
+            download_bytes_per_sec: int | None = None,
+            parent: 'RateLimiter | None' = None
+    ):
+        self.parent = parent
+        self.upload = TokenBucket(upload_bytes_per_sec, parent.upload if parent is not None else None)
+        self.download = TokenBucket(download_bytes_per_sec, parent.download if parent is not None else None)
+
+    def child(
+            self,
+            upload_bytes_per_sec: int | None = None,
+            download_bytes_per_sec: int | None = None
+    ) -> 'RateLimiter':
+        return RateLimiter(upload_bytes_per_sec, download_bytes_per_sec, parent=self)
+
+    def set_limits(self, upload_bytes_per_sec: int | None, download_bytes_per_sec: int | None):
+        """
+        :param upload_bytes_per_sec: the new upload limit, None means unlimited
+        :param download_bytes_per_sec: the new download limit, None means unlimited
+        """
+        self.upload.set_rate(upload_bytes_per_sec)
+        self.download.set_rate(download_bytes_per_sec)
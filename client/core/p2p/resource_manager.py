@@ -1,20 +1,59 @@
 import asyncio
 import hashlib
+import ipaddress
 import time
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import random
 
+from core.common.bitset import Bitset
 from core.common.peer_info import PeerInfo
-from core.p2p.connection import Connection, establish_connection
-from core.p2p.message import Handshake, Request, Bitfield, Piece
+from core.p2p.connection import Connection, establish_connection, HANDSHAKE_TIMEOUT_SECONDS
+from core.p2p.multiplexer import Multiplexer, ChannelConnection, SESSION_INFO_HASH
+from core.p2p.message import (
+    Handshake, Request, Bitfield, Piece, Have, HaveAll, HaveNone, Choke, Unchoke, Interested, NotInterested, Pex
+)
 from core.p2p.resource_file import ResourceFile
 from core.common.resource import Resource
 from core.p2p.connection_listener import ConnectionListener
+from core.p2p.connection_pool import ConnectionPool
+from core.p2p.dial_backoff import DialBackoff
+from core.p2p.peer_cache import PeerCache
 from enum import Enum
 import logging
 
+from core.p2p.rate_limiter import RateLimiter
 from core.p2p.resource_save import ResourceSave
+from core.p2p.upload_slot_manager import UploadSlotManager
+
+# How often the upload slots are reassigned
+RECHOKE_INTERVAL_SECONDS = 10
+
+# How many peers are dialed at the same time by default
+MAX_CONCURRENT_DIALS = 32
+
+# The default caps of the connections of one resource
+MAX_INBOUND_CONNECTIONS = 40
+MAX_OUTBOUND_CONNECTIONS = 40
+
+# A peer is considered snubbing the host peer if it sends no pieces for this long while the host peer is interested
+SNUB_TIMEOUT_SECONDS = 60
+
+# The new connections are not evicted during this time: the peers first exchange the bitfields and the interest
+EVICTION_GRACE_SECONDS = 30
+
+# How often the connected peers are told about the peers added and dropped since the previous Pex message
+PEX_INTERVAL_SECONDS = 60
+
+# How often the Pex messages are checked: a new peer gets its first Pex message within this time
+PEX_CHECK_SECONDS = 5
+
+# How often the history of the connected peers is written to the peer cache (while the download is not complete)
+PEER_CACHE_SAVE_SECONDS = 60
+
+# At most this many added (and dropped) peers are sent in one Pex message,
+# and at most this many peers are taken from one peer's Pex messages per PEX_INTERVAL_SECONDS
+MAX_PEX_PEERS = 50
 
 
 class ResourceManager:
@@ -26,7 +65,7 @@ class ResourceManager:
 
     @dataclass
     class State:
-        piece_status: list[bool]
+        piece_status: Bitset
         upload_speed_bytes_per_sec: int
         download_speed_bytes_per_sec: int
 
@@ -38,65 +77,336 @@ class ResourceManager:
         bytes_uploaded_since_last_drop: int = 0
         prev_download_bytes_per_sec: int = 0
         prev_upload_bytes_per_sec: int = 0
+        # Bytes exchanged with all peers since the start (reported to the tracker)
+        total_bytes_downloaded: int = 0
+        total_bytes_uploaded: int = 0
+
+    @dataclass
+    class TransferStats:
+        uploaded: int  # Bytes uploaded since the start
+        downloaded: int  # Bytes downloaded since the start
+        left: int  # Bytes of the pieces not saved yet, 0 means the resource is complete
+        peers: int = 0  # The peers connected now (not reported, a resource with few peers is announced sooner)
+
+    @dataclass
+    class PeerState:
+        am_choking: bool = True  # The host peer does not serve the requests of the peer
+        peer_choking: bool = True  # The peer does not serve the requests of the host peer
+        am_interested: bool = False  # The peer has pieces the host peer does not have
+        peer_interested: bool = False  # The host peer has pieces the peer does not have
+        # Bytes exchanged with the peer since the last rechoke
+        bytes_downloaded: int = 0
+        bytes_uploaded: int = 0
+        total_bytes_downloaded: int = 0  # Bytes received from the peer since the connection
+        local: bool = False  # The peer is in the same local network, so it is preferred for downloading
+        connected_at: float = field(default_factory=time.monotonic)
+        last_piece_at: float = field(default_factory=time.monotonic)  # The last time the peer sent a valid piece
+        # The peers the peer knows about from our Pex messages (peer_id <-> address)
+        pex_sent: dict[str, PeerInfo] = field(default_factory=dict)
+        last_pex_sent_at: float | None = None
+        # The peers taken from the Pex messages of the peer since `pex_window_start`
+        pex_window_start: float = field(default_factory=time.monotonic)
+        pex_peers_taken: int = 0
 
     def _log_prefix(self, msg: str) -> str:
         return f"[ResourceManager peer_id={self.host_peer_id[:6]} info_hash={self.info_hash[:6]}] {msg}"
 
     # Some new peer wants to connect to this peer
     async def _handle_incoming_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        host, port = writer.get_extra_info('peername')
-        logging.info(self._log_prefix(f"{host}:{port} is trying to connect"))
         try:
-            response = await reader.readexactly(75)
-            assert response[0:11].decode() == 'TorrentInno'
-            info_hash = response[43:75].hex()
-            assert info_hash == self.info_hash
-
-            peer_id: str = response[11:43].hex()
-
-            if self.host_peer_id < peer_id:
-                raise RuntimeError(f"Peer {peer_id} has greater id and is trying to establish connection")
-
-            # If we already have connection with this peer id -> abort the incoming connection
-            if peer_id in self._connections:
-                return
-
-            # If everything is correct, then send the response handshake message
-            writer.write(Handshake(peer_id=self.host_peer_id, info_hash=self.info_hash).to_bytes())
-            await writer.drain()
-
-            # Create the connection object
-            connection = Connection(reader, writer, self.resource)
-            await self._add_peer(peer_id, connection)
+            handshake = Handshake.from_bytes(await asyncio.wait_for(reader.readexactly(75), HANDSHAKE_TIMEOUT_SECONDS))
+        except Exception:
+            logging.exception(self._log_prefix("Failed to read the handshake of incoming connection"))
+            writer.close()
+            return
+        await self.accept_connection(handshake.peer_id, handshake.info_hash, reader, writer)
+
+    # The peer opens the channel for the resource over the shared connection
+    async def _accept_channel(self, peer_id: str, channel: ChannelConnection) -> bool:
+        if self.host_peer_id < peer_id or peer_id in self._connections:
+            return False
+        if not await self._take_slot(peer_id, inbound=True):
+            return False
+        try:
+            await channel.accept()
+        except Exception:
+            self._release_slot(peer_id)
+            raise
+        await self._add_peer(peer_id, channel)
+        logging.info(self._log_prefix(f"Establish channel with {peer_id[:6]}"))
+        return True
+
+    # Start connecting to the peers worth dialing, the peers are deduplicated
+    def _start_dials(self, peers: list[PeerInfo]) -> list[asyncio.Task]:
+        tasks = []
+        for peer in peers:
+            if peer.peer_id == self.host_peer_id:
+                logging.warning(self._log_prefix("host_peer_id is passed in submit_peers"))
+                continue
 
-            logging.info(self._log_prefix(f"Establish connection with {peer_id[:6]}"))
+            # IMPORTANT RULE: The initiator of connection is always peer with the smaller id
+            if (
+                    self.host_peer_id < peer.peer_id and
+                    peer.peer_id not in self._connections and  # We do not want repeating connections
+                    peer.peer_id not in self._dialing and
+                    self._dial_backoff.can_dial((peer.public_ip, peer.public_port))
+            ):
+                self._dialing.add(peer.peer_id)
+                task = asyncio.create_task(self._dial(peer))
+                self._dial_tasks.add(task)
+                task.add_done_callback(self._dial_tasks.discard)
+                tasks.append(task)
+        return tasks
+
+    # Connect to the peer passed to submit_peers
+    async def _dial(self, peer: PeerInfo):
+        address = (peer.public_ip, peer.public_port)
+        if not await self._take_slot(peer.peer_id, inbound=False):
+            self._dialing.discard(peer.peer_id)
+            return
+        try:
+            async with self._dial_semaphore:
+                if self.multiplexer is not None:
+                    connection = await self.multiplexer.open_channel(peer, self.resource)
+                else:
+                    connection = await establish_connection(
+                        self.host_peer_id,
+                        peer,
+                        self.resource,
+                        self.connection_class
+                    )
+            self._dial_backoff.on_success(address)
+            self._peer_cache.on_connected(peer)
+            self._peer_addresses[peer.peer_id] = peer
+            await self._add_peer(peer.peer_id, connection)
+            logging.info(self._log_prefix(f"Establish connection with {peer.peer_id[:6]}"))
         except Exception as e:
-            logging.exception(self._log_prefix(f"Failed to handle incoming connection with {host}"))
-            writer.close()
-            await writer.wait_closed()
+            self._release_slot(peer.peer_id)
+            self._dial_backoff.on_failure(address)
+            self._peer_cache.on_failure(peer.peer_id)
+            logging.info(self._log_prefix(f"Failed to connect to {peer.peer_id[:6]}: {e!r}"))
+        finally:
+            self._dialing.discard(peer.peer_id)
 
     def _create_connection_listener(self, peer_id: str) -> ConnectionListener:
         return ConnectionListenerImpl(peer_id, self)
 
     async def _add_peer(self, peer_id: str, connection: Connection):
         self._connections[peer_id] = connection
-        self._bitfields[peer_id] = [False] * len(self.resource.pieces)
+        connection.rate_limiter = self.rate_limiter.child(self._peer_upload_limit, self._peer_download_limit)
+        self._bitfields[peer_id] = Bitset(len(self.resource.pieces))
+        self._peer_states[peer_id] = ResourceManager.PeerState(local=self._is_local_connection(connection))
         self._free_peers.add(peer_id)
 
         connection.add_listener(self._create_connection_listener(peer_id))
         await connection.listen()
-        # Send the message about the stored pieces
+        # Send the message about the stored pieces (later updates are sent with Have messages)
         await self._send_bitfield(peer_id)
 
+    @staticmethod
+    def _is_local_connection(connection: Connection) -> bool:
+        peername = connection.writer.get_extra_info('peername')
+        if not peername:
+            return False
+        try:
+            address = ipaddress.ip_address(peername[0])
+        except ValueError:
+            return False
+        return address.is_private or address.is_loopback or address.is_link_local
+
     async def _remove_peer(self, peer_id: str):
+        # The bookkeeping runs even if the closing is interrupted, otherwise the pool slot of the peer leaks
+        connection = self._connections.pop(peer_id, None)
         try:
-            await self._connections[peer_id].close()
-        except Exception as e:
-            # Ignore any exception with closing (probably peer_id either is not in list or connection is already closed
-            pass
-        self._connections.pop(peer_id, None)
-        self._bitfields.pop(peer_id, None)
-        self._free_peers.discard(peer_id)
+            if connection is not None:
+                await connection.close()
+        except Exception:
+            pass  # Ignore any exception with closing (the connection is probably already broken)
+        finally:
+            peer_state = self._peer_states.pop(peer_id, None)
+            if peer_state is not None:
+                self._peer_cache.on_disconnected(
+                    peer_id,
+                    peer_state.total_bytes_downloaded,
+                    time.monotonic() - peer_state.connected_at
+                )
+            self._bitfields.pop(peer_id, None)
+            self._free_peers.discard(peer_id)
+            self._release_pieces_of(peer_id)
+            self._release_slot(peer_id)
+            self._peer_addresses.pop(peer_id, None)
+
+    # -----CONNECTION CAPS LOGIC-----
+
+    # Take the pool slot for the connection with the peer, evicting the worst peer if there is no room
+    async def _take_slot(self, peer_id: str, inbound: bool) -> bool:
+        if self.connection_pool.try_acquire(inbound):
+            self._pool_slots[peer_id] = inbound
+            return True
+
+        worst_peer_id = self._worst_peer(inbound)
+        if worst_peer_id is None:
+            logging.debug(self._log_prefix(f"No free slot for connection with {peer_id[:6]}"))
+            return False
+        logging.info(self._log_prefix(f"Evict peer {worst_peer_id[:6]} to connect with {peer_id[:6]}"))
+        await self._remove_peer(worst_peer_id)
+
+        if self.connection_pool.try_acquire(inbound):
+            self._pool_slots[peer_id] = inbound
+            return True
+        return False
+
+    def _release_slot(self, peer_id: str):
+        inbound = self._pool_slots.pop(peer_id, None)
+        if inbound is not None:
+            self.connection_pool.release(inbound)
+
+    # The connected peer (of the direction) that is least worth keeping, None if every peer is useful
+    def _worst_peer(self, inbound: bool) -> str | None:
+        seeding = self._saved_pieces.all()
+        now = time.monotonic()
+        busy_peers = {
+            peer_id for piece_index, peer_id in enumerate(self._peer_in_charge)
+            if self.piece_status[piece_index] == ResourceManager.PieceStatus.IN_PROGRESS
+        }
+        candidates = []
+        for peer_id, peer_state in self._peer_states.items():
+            if self._pool_slots.get(peer_id) != inbound or now - peer_state.connected_at < EVICTION_GRACE_SECONDS:
+                continue
+            if peer_id in busy_peers:
+                continue  # Some piece is being downloaded from the peer
+
+            if seeding and self._bitfields[peer_id].all():
+                badness = 3  # Both peers are seeds, nothing to exchange at all
+            elif peer_state.am_interested and now - peer_state.last_piece_at > SNUB_TIMEOUT_SECONDS:
+                badness = 2  # Snubbed: the peer has what the host peer needs, but does not send it
+            elif not peer_state.am_interested and not peer_state.peer_interested:
+                badness = 1  # Neither peer needs anything from the other one right now
+            else:
+                continue
+            # Among the equally bad peers, the remote one with the least recent traffic goes first
+            candidates.append((
+                badness,
+                not peer_state.local,
+                -(peer_state.bytes_downloaded + peer_state.bytes_uploaded),
+                peer_id
+            ))
+        return max(candidates)[-1] if candidates else None
+
+    # -----END OF CONNECTION CAPS LOGIC-----
+
+    # -----PEER EXCHANGE LOGIC-----
+
+    # Tell the peer about the connected peers added and dropped since the previous Pex message
+    async def _send_pex(self, peer_id: str):
+        peer_state = self._peer_states.get(peer_id)
+        if peer_state is None:
+            return
+        current = {other_id for other_id in self._peer_addresses if other_id != peer_id}
+        added = [self._peer_addresses[other_id] for other_id in current - peer_state.pex_sent.keys()][:MAX_PEX_PEERS]
+        dropped = [peer_state.pex_sent[other_id] for other_id in peer_state.pex_sent.keys() - current][:MAX_PEX_PEERS]
+        if not added and not dropped:
+            return
+
+        peer_state.last_pex_sent_at = time.monotonic()
+        for peer in added:
+            peer_state.pex_sent[peer.peer_id] = peer
+        for peer in dropped:
+            del peer_state.pex_sent[peer.peer_id]
+        await self._connections[peer_id].send_message(Pex(added, dropped))
+
+    # The new peers learn the rest of the swarm right away instead of waiting for the tracker,
+    # the others get the updates once per PEX_INTERVAL_SECONDS
+    async def _pex_loop(self):
+        while True:
+            await asyncio.sleep(PEX_CHECK_SECONDS)
+            now = time.monotonic()
+            for peer_id, peer_state in list(self._peer_states.items()):
+                if peer_state.last_pex_sent_at is not None and \
+                        now - peer_state.last_pex_sent_at < PEX_INTERVAL_SECONDS:
+                    continue
+                try:
+                    await self._send_pex(peer_id)
+                except Exception:
+                    logging.exception(self._log_prefix(f"Failed to send Pex message to {peer_id[:6]}"))
+
+    # Dial the peers learned from the Pex message of some connected peer
+    def _on_pex(self, peer_id: str, pex: Pex):
+        peer_state = self._peer_states.get(peer_id)
+        if peer_state is None:
+            return
+        # A peer flooding us with Pex messages does not make us dial more
+        now = time.monotonic()
+        if now - peer_state.pex_window_start >= PEX_INTERVAL_SECONDS:
+            peer_state.pex_window_start = now
+            peer_state.pex_peers_taken = 0
+        allowed = MAX_PEX_PEERS - peer_state.pex_peers_taken
+        if len(pex.added) > allowed:
+            logging.debug(self._log_prefix(f"Ignore {len(pex.added) - allowed} Pex peers from {peer_id[:6]}"))
+        peers = pex.added[:max(allowed, 0)]
+        peer_state.pex_peers_taken += len(peers)
+        self._start_dials(peers)
+
+    # -----END OF PEER EXCHANGE LOGIC-----
+
+    # Make the pieces requested from the peer free for the other peers
+    def _release_pieces_of(self, peer_id: str):
+        for piece_index, peer_in_charge in enumerate(self._peer_in_charge):
+            if peer_in_charge == peer_id and self.piece_status[piece_index] == ResourceManager.PieceStatus.IN_PROGRESS:
+                self._peer_in_charge[piece_index] = ''
+                self.piece_status[piece_index] = ResourceManager.PieceStatus.FREE
+
+    # -----UPLOAD SLOTS (CHOKING) LOGIC-----
+
+    async def _set_choking(self, peer_id: str, choking: bool):
+        peer_state = self._peer_states.get(peer_id)
+        if peer_state is None or peer_state.am_choking == choking:
+            return
+        peer_state.am_choking = choking
+        await self._connections[peer_id].send_message(Choke() if choking else Unchoke())
+
+    def _unchoked_peers_count(self) -> int:
+        return sum(not peer_state.am_choking for peer_state in self._peer_states.values())
+
+    async def _rechoke(self):
+        # While seeding the peers are ranked by how fast they download from the host peer,
+        # otherwise by how fast they upload to it
+        seeding = self._saved_pieces.all()
+        interested_rates = {
+            peer_id: peer_state.bytes_uploaded if seeding else peer_state.bytes_downloaded
+            for peer_id, peer_state in self._peer_states.items()
+            if peer_state.peer_interested
+        }
+        unchoked = self._upload_slot_manager.rechoke(interested_rates) if self.share_file else set()
+
+        for peer_state in self._peer_states.values():
+            peer_state.bytes_downloaded = 0
+            peer_state.bytes_uploaded = 0
+
+        await asyncio.gather(
+            *(self._set_choking(peer_id, peer_id not in unchoked) for peer_id in list(self._peer_states)),
+            return_exceptions=True
+        )
+
+    async def _rechoke_loop(self):
+        while True:
+            await asyncio.sleep(RECHOKE_INTERVAL_SECONDS)
+            try:
+                await self._rechoke()
+            except Exception:
+                logging.exception(self._log_prefix("Failed to rechoke peers"))
+
+    # Tell the peer whether the host peer wants any of its pieces
+    async def _update_interest(self, peer_id: str):
+        peer_state = self._peer_states.get(peer_id)
+        if peer_state is None:
+            return
+        interested = self._bitfields[peer_id].and_not(self._saved_pieces).any()
+        if interested != peer_state.am_interested:
+            peer_state.am_interested = interested
+            await self._connections[peer_id].send_message(Interested() if interested else NotInterested())
+
+    # -----END OF UPLOAD SLOTS LOGIC-----
 
     # -----MAIN DOWNLOAD LOGIC BEGINS HERE-----
 
@@ -111,7 +421,10 @@ class ResourceManager:
             )
         )
         await asyncio.sleep(60)  # Sleep 1 minute
-        if self.piece_status[piece_index] == ResourceManager.PieceStatus.IN_PROGRESS:
+        if (
+                self.piece_status[piece_index] == ResourceManager.PieceStatus.IN_PROGRESS and
+                self._peer_in_charge[piece_index] == peer_id
+        ):
             # If after one minute, the piece is still in progress,
             # then something is wrong with peer (slow download speed or smth)
             self._peer_in_charge[piece_index] = ''  # This peer is no more responsible for this piece
@@ -119,35 +432,34 @@ class ResourceManager:
 
     async def _download_loop(self):
         logging.info(self._log_prefix("Start download loop"))
-        works = set()
         while True:
-            # Find free pieces
-            free_pieces: list[int] = []
-            saved_pieces = 0
-            for i, status in enumerate(self.piece_status):
-                if status == ResourceManager.PieceStatus.FREE:
-                    free_pieces.append(i)
-                if status == ResourceManager.PieceStatus.SAVED:
-                    saved_pieces += 1
-
-            if saved_pieces == len(self.resource.pieces):
+            if self._saved_pieces.all():
                 break
 
+            # Find free pieces
+            free_pieces: list[int] = [
+                i for i, status in enumerate(self.piece_status) if status == ResourceManager.PieceStatus.FREE
+            ]
+
             # Shuffle the pieces
             random.shuffle(free_pieces)
 
+            # The peers of the local network are asked first
+            free_peers = sorted(self._free_peers, key=lambda peer_id: not self._peer_states[peer_id].local)
+
             # Try to find piece and peer that has this piece
             found_work = False
             for piece_index in free_pieces:
-                for peer_id in self._free_peers:
-                    if self._peer_has_piece(peer_id, piece_index):  # Peer has this piece -> run the work
+                for peer_id in free_peers:
+                    # Peer has this piece and serves our requests -> run the work
+                    if not self._peer_states[peer_id].peer_choking and self._peer_has_piece(peer_id, piece_index):
                         # Update the status and related peer
                         self.piece_status[piece_index] = ResourceManager.PieceStatus.IN_PROGRESS
                         self._peer_in_charge[piece_index] = peer_id
 
                         task = asyncio.create_task(self._download_work(peer_id, piece_index))
-                        task.add_done_callback(lambda t: works.discard(t))
-                        works.add(task)
+                        task.add_done_callback(self._download_works.discard)
+                        self._download_works.add(task)
 
                         found_work = True
                         break
@@ -156,56 +468,69 @@ class ResourceManager:
             await asyncio.sleep(0.2)
 
     async def _confirm_download_complete(self):
-        saved_pieces = sum(
-            piece_status == ResourceManager.PieceStatus.SAVED
-            for piece_status in self.piece_status
-        )
-        assert saved_pieces == len(self.resource.pieces)
+        assert self._saved_pieces.all()
 
         await self.resource_file.accept_download()
         await self.stop_download()
         await self.resource_save.remove_save()
+        await self._peer_cache.remove()
         logging.info(self._log_prefix("Download is completed"))
 
     # -----END OF DOWNLOAD LOGIC-----
 
     def _peer_has_piece(self, peer_id: str, piece_index: int) -> bool:
-        return self._bitfields[peer_id][piece_index] == True
+        return self._bitfields[peer_id][piece_index]
 
-    def _get_bitfield(self) -> list[bool]:
-        return list(
-            piece_status == ResourceManager.PieceStatus.SAVED for piece_status in self.piece_status
-        )
+    def _get_bitfield(self) -> Bitset:
+        return self._saved_pieces
+
+    def _mark_saved(self, piece_index: int):
+        self.piece_status[piece_index] = ResourceManager.PieceStatus.SAVED
+        self._saved_pieces.set(piece_index)
 
     async def _save_loading_state(self):
         try:
-            await self.resource_save.write_bitfield(self._get_bitfield())
+            await self.resource_save.write_bitfield(self._get_bitfield().copy())
         except Exception:
             logging.exception(self._log_prefix("Can't save bitfield"))
 
     async def _send_bitfield(self, peer_id: str):
         connection = self._connections[peer_id]
-        bitfield = Bitfield(self._get_bitfield())
-        await connection.send_message(bitfield)
-
-    async def _send_bitfield_to_all_peers(self):
-        bitfield = Bitfield(self._get_bitfield())
+        saved_pieces = self._get_bitfield()
+        if saved_pieces.all():
+            message = HaveAll()
+        elif not saved_pieces.any():
+            message = HaveNone()
+        else:
+            message = Bitfield(saved_pieces.copy())
+        await connection.send_message(message)
+
+    async def _send_have_to_all_peers(self, piece_index: int):
+        have = Have(piece_index)
         await asyncio.gather(
-            *(connection.send_message(bitfield)
+            *(connection.send_message(have)
               for connection in self._connections.values()),
             return_exceptions=True
         )
 
-    # Periodic broadcast with bitfield to compensate possible exceptions in the Piece message
-    async def _periodic_broadcast(self):
-        while True:
-            await self._send_bitfield_to_all_peers()
-            await asyncio.sleep(30)  # Sleep for 30 seconds
-
     async def _serve_forever(self, server: asyncio.Server):
         async with server:
             await server.serve_forever()
 
+    # Write the history of the peers, the cache is kept only until the download is complete
+    async def _save_peer_cache(self):
+        if not self._peer_cache.changed or self._saved_pieces.all():
+            return
+        try:
+            await self._peer_cache.save()
+        except OSError as e:
+            logging.info(self._log_prefix(f"Failed to save the peer cache: {e!r}"))
+
+    async def _peer_cache_loop(self):
+        while True:
+            await asyncio.sleep(PEER_CACHE_SAVE_SECONDS)
+            await self._save_peer_cache()
+
     async def _calc_network_stats(self):
         while True:
             delta = time.time() - self._network_stats.last_drop_timestamp_seconds
@@ -224,6 +549,11 @@ class ResourceManager:
             host_peer_id: str,
             destination: Path,
             resource: Resource,
+            connection_class: type[Connection] = Connection,
+            rate_limiter: RateLimiter | None = None,
+            multiplexer: Multiplexer | None = None,
+            max_concurrent_dials: int = MAX_CONCURRENT_DIALS,
+            connection_pool: ConnectionPool | None = None
     ):
         """
         Create a new ResourceManager instance.
@@ -235,10 +565,26 @@ class ResourceManager:
         on the moment the class is instantiated, then it's assumed that the caller has the `destination` file
         and therefore the file will only be shared (and not downloaded)
         :param resource: the resource class representing the class to be uploaded/downloaded
+        :param connection_class: the `Connection` implementation used for the peer connections
+        (for example, `ProtocolConnection` to receive the data through `asyncio.BufferedProtocol`)
+        :param rate_limiter: the limiter shared by the session, the bandwidth of the resource is also limited by it
+        :param multiplexer: if given, the connections with peers are opened as channels of the connections shared
+        with the other resources of the session (`connection_class` is not used then)
+        :param max_concurrent_dials: how many peers passed to `submit_peers` are being connected at the same time
+        :param connection_pool: the pool shared by the session, the connections of the resource are also counted in it
         """
         self.host_peer_id = host_peer_id
         self.destination = destination
         self.resource = resource
+        self.connection_class = connection_class
+        self.multiplexer = multiplexer
+        if multiplexer is not None:
+            multiplexer.register(resource, self._accept_channel)
+
+        # Bandwidth limits of the resource and of every its connection (None = unlimited)
+        self.rate_limiter = rate_limiter.child() if rate_limiter is not None else RateLimiter()
+        self._peer_upload_limit: int | None = None
+        self._peer_download_limit: int | None = None
 
         self.info_hash = resource.get_info_hash()
 
@@ -250,10 +596,32 @@ class ResourceManager:
 
         # Peer dictionaries
         self._connections: dict[str, Connection] = dict()  # peer_id <-> Connection
-        self._bitfields: dict[str, list[bool]] = dict()  # peer_id <-> bitfield (owned chunks)
+        self._bitfields: dict[str, Bitset] = dict()  # peer_id <-> bitfield (owned chunks)
         self._free_peers: set[str] = set()  # set of peer ids that are not involved in any work
+        self._peer_states: dict[str, ResourceManager.PeerState] = dict()  # peer_id <-> choking/interest state
+
+        # Decides which interested peers are allowed to download from the host peer
+        self._upload_slot_manager = UploadSlotManager()
+
+        # Outgoing connection attempts
+        self._dial_semaphore = asyncio.Semaphore(max_concurrent_dials)
+        self._dialing: set[str] = set()  # peer ids being connected
+        self._dial_tasks: set[asyncio.Task] = set()
+        self._dial_backoff = DialBackoff()  # delays the repeated attempts to the unreachable addresses
+        # The peers connected in the previous runs, dialed right at the start
+        self._peer_cache = PeerCache(destination, resource)
+
+        # Caps of the connections of the resource (the slots are taken before the handshake)
+        self.connection_pool = (connection_pool.child if connection_pool is not None else ConnectionPool)(
+            MAX_INBOUND_CONNECTIONS, MAX_OUTBOUND_CONNECTIONS
+        )
+        self._pool_slots: dict[str, bool] = dict()  # peer_id <-> whether the slot is inbound
+
+        # The listening addresses of the connected peers, as far as they are known (they are exchanged in Pex messages)
+        self._peer_addresses: dict[str, PeerInfo] = dict()  # peer_id <-> address
 
         self.piece_status: list[ResourceManager.PieceStatus] = []
+        self._saved_pieces: Bitset  # Pieces with SAVED status (the bitfield of the host peer)
 
         has_file = destination.exists()
 
@@ -265,6 +633,7 @@ class ResourceManager:
                 initial_state=ResourceFile.State.DOWNLOADED
             )
             self.piece_status = [ResourceManager.PieceStatus.SAVED] * len(self.resource.pieces)
+            self._saved_pieces = Bitset.full(len(self.resource.pieces))
         else:  # The caller does not the complete downloaded file
             self.resource_file = ResourceFile(
                 destination,
@@ -273,6 +642,7 @@ class ResourceManager:
                 initial_state=ResourceFile.State.DOWNLOADING
             )
             self.piece_status = [ResourceManager.PieceStatus.FREE] * len(self.resource.pieces)
+            self._saved_pieces = Bitset(len(self.resource.pieces))
 
         # Current peer id that handles the piece (empty string=no peer)
         self._peer_in_charge: list[str] = [''] * len(self.resource.pieces)
@@ -282,10 +652,13 @@ class ResourceManager:
 
         # Various asyncio background tasks
         self._download_task: asyncio.Task | None = None
+        self._download_works: set[asyncio.Task] = set()  # The pending requests of the download loop
         self._server_task: asyncio.Task | None = None
-        self._broadcast_task: asyncio.Task | None = None
 
         self._calc_network_stats_task = asyncio.create_task(self._calc_network_stats())
+        self._rechoke_task = asyncio.create_task(self._rechoke_loop())
+        self._pex_task = asyncio.create_task(self._pex_loop())
+        self._peer_cache_task = asyncio.create_task(self._peer_cache_loop())
 
     # PUBLIC METHODS:
     async def open_public_port(self) -> int:
@@ -306,10 +679,6 @@ class ResourceManager:
         host, port = public_server.sockets[0].getsockname()
         self._server_task = asyncio.create_task(self._serve_forever(public_server))
 
-        # Also run the bitfield broadcast task
-        if self._broadcast_task is None:
-            self._broadcast_task = asyncio.create_task(self._periodic_broadcast())
-
         logging.info(self._log_prefix(f'Open public port {port}'))
         # Return port on which connection has been opened
         return port
@@ -324,9 +693,57 @@ class ResourceManager:
             self._server_task.cancel()
             self._server_task = None
 
-        if self._broadcast_task is not None:
-            self._broadcast_task.cancel()
-            self._broadcast_task = None
+    async def accept_connection(
+            self,
+            peer_id: str,
+            info_hash: str,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter
+    ):
+        """
+        Take the incoming connection whose handshake has already been read (for example, by the listener shared by
+        all resources of the session). The connection is closed if it cannot be accepted.
+
+        :param peer_id: the peer id from the handshake
+        :param info_hash: the info hash from the handshake, either the info hash of the resource or
+        `SESSION_INFO_HASH` for the connection shared by all resources
+        """
+        host, port = writer.get_extra_info('peername')
+        logging.info(self._log_prefix(f"{host}:{port} is trying to connect"))
+        try:
+            if info_hash == SESSION_INFO_HASH and self.multiplexer is not None:
+                # The peer opens the connection shared by all resources
+                await self.multiplexer.accept_session(peer_id, reader, writer)
+                return
+
+            if self.host_peer_id < peer_id:
+                raise RuntimeError(f"Peer {peer_id} has greater id and is trying to establish connection")
+            assert info_hash == self.info_hash
+
+            # If we already have connection with this peer id -> abort the incoming connection
+            if peer_id in self._connections:
+                writer.close()
+                return
+
+            if not await self._take_slot(peer_id, inbound=True):
+                writer.close()
+                return
+
+            # If everything is correct, then send the response handshake message
+            writer.write(Handshake(peer_id=self.host_peer_id, info_hash=self.info_hash).to_bytes())
+            await writer.drain()
+
+            # Create the connection object
+            connection = self.connection_class(reader, writer, self.resource)
+            await self._add_peer(peer_id, connection)
+
+            logging.info(self._log_prefix(f"Establish connection with {peer_id[:6]}"))
+        except Exception as e:
+            logging.exception(self._log_prefix(f"Failed to handle incoming connection with {host}"))
+            if peer_id not in self._connections:
+                self._release_slot(peer_id)
+            writer.close()
+            await writer.wait_closed()
 
     async def restore_previous(self):
         """
@@ -339,19 +756,33 @@ class ResourceManager:
         """
         if self.destination.exists():
             self.piece_status = [ResourceManager.PieceStatus.SAVED] * len(self.resource.pieces)
+            self._saved_pieces = Bitset.full(len(self.resource.pieces))
             self._peer_in_charge = [''] * len(self.resource.pieces)
             return
 
         try:
             bitfield = await self.resource_save.read_bitfield()
-            for i in range(len(self.piece_status)):
-                if bitfield[i]:
-                    self.piece_status[i] = ResourceManager.PieceStatus.SAVED
-                    self._peer_in_charge[i] = ''
+            for i in bitfield.indices():
+                self._mark_saved(i)
+                self._peer_in_charge[i] = ''
             logging.info(self._log_prefix(f"Restored bitfield: {bitfield}"))
         except Exception as e:
             logging.info(self._log_prefix(f"Failed to read bitfield: {e}"))
 
+    async def dial_cached_peers(self):
+        """
+        Start connecting to the peers the previous runs have connected to for the resource (they are remembered
+        on disk, with their history, until the download is complete), the fastest ones first. The method does not
+        wait for the connections, so that the peers from the tracker are dialed at the same time.
+        """
+        if self._saved_pieces.all():
+            return
+        await self._peer_cache.load()
+        peers = self._peer_cache.peers()
+        if peers:
+            logging.info(self._log_prefix(f"Dial {len(peers)} cached peers"))
+        self._start_dials(peers)
+
     async def start_download(self):
         """
         Start downloading the file. If the destination file already exists, then this method does nothing. The file
@@ -378,6 +809,10 @@ class ResourceManager:
             # Stop downloading the resource
             self._download_task.cancel()
             self._download_task = None
+        works = list(self._download_works)
+        for task in works:
+            task.cancel()
+        await asyncio.gather(*works, return_exceptions=True)
 
     async def start_sharing_file(self):
         """
@@ -392,12 +827,45 @@ class ResourceManager:
         """
         self.share_file = False
 
+    async def set_rate_limits(self, upload_bytes_per_sec: int | None, download_bytes_per_sec: int | None):
+        """
+        Limit the bandwidth used by the resource (in total over all connections). Can be called at any time.
+
+        :param upload_bytes_per_sec: the upload limit, None means unlimited
+        :param download_bytes_per_sec: the download limit, None means unlimited
+        """
+        self.rate_limiter.set_limits(upload_bytes_per_sec, download_bytes_per_sec)
+
+    async def set_peer_rate_limits(self, upload_bytes_per_sec: int | None, download_bytes_per_sec: int | None):
+        """
+        Limit the bandwidth of every single connection of the resource (the existing connections included).
+
+        :param upload_bytes_per_sec: the upload limit, None means unlimited
+        :param download_bytes_per_sec: the download limit, None means unlimited
+        """
+        self._peer_upload_limit = upload_bytes_per_sec
+        self._peer_download_limit = download_bytes_per_sec
+        for connection in self._connections.values():
+            connection.rate_limiter.set_limits(upload_bytes_per_sec, download_bytes_per_sec)
+
+    async def set_connection_limits(self, max_inbound: int | None, max_outbound: int | None):
+        """
+        Change the caps of the connections of the resource. When the cap is reached, a new peer replaces the least
+        useful connected peer (a seed while the host peer seeds too, a snubbing peer or a peer with nothing to
+        exchange), if there is any.
+
+        :param max_inbound: the cap of the connections opened by other peers, None means unlimited
+        :param max_outbound: the cap of the connections opened by the host peer, None means unlimited
+        """
+        self.connection_pool.set_limits(max_inbound, max_outbound)
+
     async def full_start(
             self,
             restore_previous=True,
             start_sharing_file=True,
             start_download=True,
-            open_public_port=True
+            open_public_port=True,
+            dial_cached_peers=True
     ) -> int | None:
         """
         A method to start the `ResourceManager`. Clients MUST call this method in order to fully start the `ResourceManager`.
@@ -414,6 +882,7 @@ class ResourceManager:
         if start_download: await self.start_download()
         listen_port = None
         if open_public_port: listen_port = await self.open_public_port()
+        if dial_cached_peers: await self.dial_cached_peers()
 
         if self._calc_network_stats_task is None:
             self._calc_network_stats_task = asyncio.create_task(self._calc_network_stats())
@@ -427,14 +896,22 @@ class ResourceManager:
         The method is idempotent (repeating calls do not cause any errors/exception)
         """
         await self.close_public_port()
+        for task in list(self._dial_tasks):
+            task.cancel()
         await asyncio.gather(
-            *(connection.close() for connection in self._connections.values()),
+            *(self._remove_peer(peer_id) for peer_id in list(self._connections)),
             return_exceptions=True
         )
+        await self._save_peer_cache()
         await self.stop_download()
         await self.stop_sharing_file()
         if self._calc_network_stats_task is not None:
             self._calc_network_stats_task.cancel()
+        self._rechoke_task.cancel()
+        self._pex_task.cancel()
+        self._peer_cache_task.cancel()
+        if self.multiplexer is not None:
+            self.multiplexer.unregister(self.resource)
 
     async def submit_peers(self, peers: list[PeerInfo]):
         """
@@ -442,22 +919,12 @@ class ResourceManager:
         from the tracker response on announce request with the *same* info hash as the RequestManager was created with.
 
         :param peers: The list of peers known to be related with the resource
-        """
-        for peer in peers:
-            if peer.peer_id == self.host_peer_id:
-                logging.warning(self._log_prefix("host_peer_id is passed in submit_peers"))
-                continue
 
-            # IMPORTANT RULE: The initiator of connection is always peer with the smaller id
-            if self.host_peer_id < peer.peer_id:
-                try:
-                    if peer.peer_id not in self._connections:  # We do not want repeating connections
-                        connection = await establish_connection(self.host_peer_id, peer, self.resource)
-                        await self._add_peer(peer.peer_id, connection)
-                        logging.info(self._log_prefix(f"Establish connection with {peer.peer_id[:6]}"))
-                except Exception:
-                    logging.exception(
-                        self._log_prefix(f"Exception while establishing connection with {peer.peer_id[:6]}"))
+        The peers are dialed concurrently (at most `max_concurrent_dials` at a time), the method returns once all
+        the started attempts are finished. The peers that are already connected or being dialed are skipped,
+        as well as the addresses that failed recently.
+        """
+        await asyncio.gather(*self._start_dials(peers), return_exceptions=True)
 
     async def get_state(self) -> 'ResourceManager.State':
         """
@@ -466,11 +933,28 @@ class ResourceManager:
         """
         delta_sec = time.time() - self._network_stats.last_drop_timestamp_seconds
         return ResourceManager.State(
-            self._get_bitfield(),
+            self._get_bitfield().copy(),
             upload_speed_bytes_per_sec=self._network_stats.prev_upload_bytes_per_sec,
             download_speed_bytes_per_sec=self._network_stats.prev_download_bytes_per_sec
         )
 
+    async def get_transfer_stats(self) -> 'ResourceManager.TransferStats':
+        """
+        Get the transfer statistics of the resource, which are reported to the tracker with each announce
+        :return: The bytes uploaded and downloaded since the start, the bytes left to download and the number
+        of the connected peers
+        """
+        return ResourceManager.TransferStats(
+            uploaded=self._network_stats.total_bytes_uploaded,
+            downloaded=self._network_stats.total_bytes_downloaded,
+            left=sum(
+                piece.size_bytes
+                for index, piece in enumerate(self.resource.pieces)
+                if not self._saved_pieces[index]
+            ),
+            peers=len(self._connections)
+        )
+
 
 class ConnectionListenerImpl(ConnectionListener):
     def __init__(self, connected_peer_id: str, resource_manager: ResourceManager):
@@ -486,6 +970,12 @@ class ConnectionListenerImpl(ConnectionListener):
                       f"Ignore Request message from peer {self.connected_peer_id[:6]} as sharing is disabled")
             return
 
+        peer_state = self.resource_manager._peer_states.get(self.connected_peer_id)
+        if peer_state is None or peer_state.am_choking:
+            self._log(logging.DEBUG,
+                      f"Ignore Request message from peer {self.connected_peer_id[:6]} as the peer is choked")
+            return
+
         try:
             data = await self.resource_manager.resource_file.get_block(
                 request.piece_index,
@@ -504,6 +994,8 @@ class ConnectionListenerImpl(ConnectionListener):
 
             # Update the network stats
             self.resource_manager._network_stats.bytes_uploaded_since_last_drop += request.block_length
+            self.resource_manager._network_stats.total_bytes_uploaded += request.block_length
+            peer_state.bytes_uploaded += request.block_length
 
             self._log(logging.DEBUG,
                       f"Send piece {request.piece_index} on Request message to peer {self.connected_peer_id[:6]}")
@@ -546,14 +1038,17 @@ class ConnectionListenerImpl(ConnectionListener):
 
             # Update the network stats
             self.resource_manager._network_stats.bytes_downloaded_since_last_drop += len(piece.data)
+            self.resource_manager._network_stats.total_bytes_downloaded += len(piece.data)
+            peer_state = self.resource_manager._peer_states.get(self.connected_peer_id)
+            if peer_state is not None:
+                peer_state.bytes_downloaded += len(piece.data)
+                peer_state.total_bytes_downloaded += len(piece.data)
+                peer_state.last_piece_at = time.monotonic()
 
-            # If the piece is saved, then broadcast the bitfield to all connections and change the status
-            self.resource_manager.piece_status[piece.piece_index] = ResourceManager.PieceStatus.SAVED
+            # If the piece is saved, then change the status and announce the piece to all connections
+            self.resource_manager._mark_saved(piece.piece_index)
 
-            saved_pieces = sum(
-                piece_status == ResourceManager.PieceStatus.SAVED
-                for piece_status in self.resource_manager.piece_status
-            )
+            saved_pieces = self.resource_manager._saved_pieces.count()
             self._log(
                 logging.INFO,
                 f"Save piece {piece.piece_index} from {self.connected_peer_id[:6]}. "
@@ -570,7 +1065,15 @@ class ConnectionListenerImpl(ConnectionListener):
                 except Exception:
                     logging.exception(self.resource_manager._log_prefix("Cannot complete download"))
 
-            await self.resource_manager._send_bitfield_to_all_peers()
+            await self.resource_manager._send_have_to_all_peers(piece.piece_index)
+
+            # Only the peers that have this piece may have nothing more to offer
+            await asyncio.gather(
+                *(self.resource_manager._update_interest(peer_id)
+                  for peer_id, bitfield in list(self.resource_manager._bitfields.items())
+                  if bitfield[piece.piece_index]),
+                return_exceptions=True
+            )
         except Exception:
             logging.exception(
                 self.resource_manager._log_prefix(
@@ -582,12 +1085,73 @@ class ConnectionListenerImpl(ConnectionListener):
 
     async def on_bitfield(self, bitfield: Bitfield):
         self.resource_manager._bitfields[self.connected_peer_id] = bitfield.bitfield
-        owned_pieces = sum(bitfield.bitfield)
+        owned_pieces = bitfield.bitfield.count()
         self._log(
             logging.DEBUG,
             f"Bitfield from {self.connected_peer_id[:6]}."
             f" The peer claims to have {owned_pieces}/{len(bitfield.bitfield)} pieces"
         )
+        await self.resource_manager._update_interest(self.connected_peer_id)
+
+    async def on_have(self, have: Have):
+        self.resource_manager._bitfields[self.connected_peer_id].set(have.piece_index)
+        peer_state = self.resource_manager._peer_states.get(self.connected_peer_id)
+        if (
+                peer_state is not None and not peer_state.am_interested and
+                not self.resource_manager._saved_pieces[have.piece_index]
+        ):
+            await self.resource_manager._update_interest(self.connected_peer_id)
+
+    async def on_have_all(self, have_all: HaveAll):
+        pieces_count = len(self.resource_manager.resource.pieces)
+        self.resource_manager._bitfields[self.connected_peer_id] = Bitset.full(pieces_count)
+        self._log(logging.DEBUG, f"Have-All from {self.connected_peer_id[:6]}")
+        await self.resource_manager._update_interest(self.connected_peer_id)
+
+    async def on_have_none(self, have_none: HaveNone):
+        pieces_count = len(self.resource_manager.resource.pieces)
+        self.resource_manager._bitfields[self.connected_peer_id] = Bitset(pieces_count)
+        self._log(logging.DEBUG, f"Have-None from {self.connected_peer_id[:6]}")
+        await self.resource_manager._update_interest(self.connected_peer_id)
+
+    async def on_choke(self, choke: Choke):
+        peer_state = self.resource_manager._peer_states.get(self.connected_peer_id)
+        if peer_state is not None:
+            peer_state.peer_choking = True
+        # The peer will not answer the pending requests anymore
+        self.resource_manager._release_pieces_of(self.connected_peer_id)
+        self._log(logging.DEBUG, f"Choked by {self.connected_peer_id[:6]}")
+
+    async def on_unchoke(self, unchoke: Unchoke):
+        peer_state = self.resource_manager._peer_states.get(self.connected_peer_id)
+        if peer_state is not None:
+            peer_state.peer_choking = False
+        self._log(logging.DEBUG, f"Unchoked by {self.connected_peer_id[:6]}")
+
+    async def on_interested(self, interested: Interested):
+        peer_state = self.resource_manager._peer_states.get(self.connected_peer_id)
+        if peer_state is None:
+            return
+        peer_state.peer_interested = True
+
+        # Do not make the peer wait for the next rechoke if there is a free upload slot
+        resource_manager = self.resource_manager
+        if (
+                resource_manager.share_file and
+                resource_manager._unchoked_peers_count() < resource_manager._upload_slot_manager.total_slots()
+        ):
+            await resource_manager._set_choking(self.connected_peer_id, False)
+
+    async def on_not_interested(self, not_interested: NotInterested):
+        peer_state = self.resource_manager._peer_states.get(self.connected_peer_id)
+        if peer_state is None:
+            return
+        peer_state.peer_interested = False
+        # Free the upload slot for someone else
+        await self.resource_manager._set_choking(self.connected_peer_id, True)
+
+    async def on_pex(self, pex: Pex):
+        self.resource_manager._on_pex(self.connected_peer_id, pex)
 
     async def on_close(self, cause):
         # The connection with peer for some reason is closed
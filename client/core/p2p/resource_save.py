@@ -3,6 +3,7 @@ import json
 
 import aiofiles
 
+from core.common.bitset import Bitset
 from core.common.resource import Resource
 
 
@@ -10,15 +11,28 @@ class ResourceSave:
     def __init__(self, destination: Path, resource: Resource):
         self.save_file = \
             destination.parent.joinpath(f".torrentinno_save-file_{destination.name}_{resource.get_info_hash()}")
+        self.pieces_count = len(resource.pieces)
 
     async def remove_save(self):
         self.save_file.unlink(missing_ok=True)
 
-    async def read_bitfield(self) -> list[bool]:
-        async with aiofiles.open(self.save_file, mode='r') as f:
-            result = json.loads(await f.read())
-            return result
+    async def read_bitfield(self) -> Bitset:
+        async with aiofiles.open(self.save_file, mode='rb') as f:
+            content = await f.read()
 
-    async def write_bitfield(self, bitfield: list[bool]):
-        async with aiofiles.open(self.save_file, mode='w') as f:
-            await f.write(json.dumps(bitfield))
+        # Old saves store the bitfield as a JSON list of booleans
+        if content.startswith(b'['):
+            try:
+                bools = json.loads(content)
+            except ValueError:
+                bools = None  # The packed bitfield just happens to begin with '['
+            if bools is not None:
+                if len(bools) != self.pieces_count:
+                    raise ValueError(f"Expected {self.pieces_count} pieces in the save, got {len(bools)}")
+                return Bitset.from_bools(bools)
+        return Bitset(self.pieces_count, content)
+
+    async def write_bitfield(self, bitfield: Bitset):
+        # The bitfield is stored packed, in the same format as in the Bitfield message
+        async with aiofiles.open(self.save_file, mode='wb') as f:
+            await f.write(bitfield.view())
@@ -0,0 +1,46 @@
+import random
+
+
+class UploadSlotManager:
+    """
+    Decides which peers are unchoked, i.e. which peers' Request messages are served by the host peer.
+
+    On every rechoke the interested peers with the best rate get the regular upload slots. The rate is supplied by
+    the caller: while downloading it is the amount of data received from the peer (reciprocation), while seeding it is
+    the amount of data sent to the peer (so the fastest downloaders are preferred). One more, optimistic, slot goes to
+    a random interested peer and is rotated every `optimistic_unchoke_rounds` rechokes, so that new peers get
+    a chance to show their rate.
+    """
+
+    def __init__(self, upload_slots: int = 4, optimistic_unchoke_rounds: int = 3):
+        self.upload_slots = upload_slots
+        self.optimistic_unchoke_rounds = optimistic_unchoke_rounds
+        self.optimistic_peer: str | None = None
+        self._rounds = 0
+
+    def total_slots(self) -> int:
+        """
+        :return: the number of peers that may be unchoked at the same time (including the optimistic slot)
+        """
+        return self.upload_slots + 1
+
+    def rechoke(self, interested_rates: dict[str, int]) -> set[str]:
+        """
+        :param interested_rates: peer_id <-> rate of every interested peer
+        :return: the peer ids to be unchoked, all the other peers are choked
+        """
+        ranked = sorted(interested_rates, key=lambda peer_id: interested_rates[peer_id], reverse=True)
+        unchoked = set(ranked[:self.upload_slots])
+
+        if (
+                self._rounds % self.optimistic_unchoke_rounds == 0 or
+                self.optimistic_peer not in interested_rates or
+                self.optimistic_peer in unchoked
+        ):
+            candidates = [peer_id for peer_id in interested_rates if peer_id not in unchoked]
+            self.optimistic_peer = random.choice(candidates) if candidates else None
+        self._rounds += 1
+
+        if self.optimistic_peer is not None:
+            unchoked.add(self.optimistic_peer)
+        return unchoked
@@ -0,0 +1,764 @@
+import asyncio
+import base64
+import ipaddress
+import json
+import logging
+import random
+import struct
+import time
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from core.common.peer_info import PeerInfo
+from core.p2p.resource_manager import ResourceManager
+from core.s2p.tracker_client import TrackerClient
+from core.s2p.udp_tracker import UdpTrackerClient
+
+# Every resource is announced about this often, unless its trackers recommend another interval
+ANNOUNCE_INTERVAL_SECONDS = 30
+
+# The resources are not announced more often than this, unless their trackers allow it
+MIN_ANNOUNCE_INTERVAL_SECONDS = 10
+
+# The interval of each resource is shortened by a random part up to this fraction, so that the resources started
+# together drift apart instead of being announced in the same second forever (and never exceed the tracker lifespan)
+ANNOUNCE_JITTER = 0.2
+
+# The resources being downloaded from fewer peers than this are announced at the minimum interval of their trackers
+LOW_PEER_COUNT = 5
+
+# A resource no tracker has answered for is announced again after this delay, doubling with each next failure
+ANNOUNCE_RETRY_MIN_SECONDS = 5
+ANNOUNCE_RETRY_MAX_SECONDS = 5 * 60
+
+# The resources due within this time are announced together with the due ones
+BATCH_WINDOW_SECONDS = 5
+
+# At most this many info hashes are sent in one batch request
+MAX_BATCH_SIZE = 500
+
+# The subscription to the peers joining the swarms is reopened after this delay, which doubles after each failure
+PUSH_RETRY_MIN_SECONDS = 1
+PUSH_RETRY_MAX_SECONDS = 60
+
+# The resources registered within this time after a change share the new subscription
+PUSH_RESUBSCRIBE_DELAY_SECONDS = 1
+
+# At most this many resources get the pushed peers, the others get the peers only with the announces
+MAX_PUSH_INFO_HASHES = 200
+
+# A tracker that has not answered is skipped for this long (doubling with each next failure) while other trackers
+# of the resource are available
+TRACKER_RETRY_MIN_SECONDS = 30
+TRACKER_RETRY_MAX_SECONDS = 30 * 60
+
+# The weight of the last response time in the smoothed response time of a tracker
+LATENCY_SMOOTHING = 0.3
+
+# After a failed UDP announce, the resources are announced over HTTP for this long
+UDP_FALLBACK_SECONDS = 300
+
+# The tracker returns a random sample of at most this many peers for each resource
+NUM_WANT = 50
+
+# The events of the announce, the regular announces have no event
+EVENT_STARTED = 'started'
+EVENT_COMPLETED = 'completed'
+EVENT_STOPPED = 'stopped'
+
+# The compact peer list: [peer-id (32 bytes)][IPv4 address (4 bytes)][port (2 bytes)]...
+_COMPACT_PEER = struct.Struct('>32s4sH')
+
+
+def decode_compact_peers(data: bytes) -> list[PeerInfo]:
+    if len(data) % _COMPACT_PEER.size != 0:
+        raise ValueError("The compact peer list has a partial entry")
+    return [
+        PeerInfo(public_ip=str(ipaddress.IPv4Address(ip)), public_port=port, peer_id=peer_id.hex())
+        for peer_id, ip, port in _COMPACT_PEER.iter_unpack(data)
+    ]
+
+
+def parse_peer_list(peers_json: list | str | bytes, host_peer_id: str) -> list[PeerInfo]:
+    '''
+    Convert the peers of the tracker response (a list of peer objects, a base64 compact peer list or the compact
+    peer list itself) into PeerInfo list (skipping the host peer and malformed entries)
+    '''
+    if isinstance(peers_json, (str, bytes)):
+        try:
+            compact = base64.b64decode(peers_json, validate=True) if isinstance(peers_json, str) else peers_json
+            peers = decode_compact_peers(compact)
+        except ValueError as e:
+            logging.info(f"Error parsing compact peer list: {e!r}")
+            return []
+        return [peer for peer in peers if peer.peer_id != host_peer_id]
+
+    peer_list = []
+    for peer in peers_json or []:
+        try:
+            if peer["peerId"] != host_peer_id:
+                peer_list.append(PeerInfo(
+                    public_ip=peer["publicIp"],
+                    public_port=int(peer["publicPort"]),
+                    peer_id=peer["peerId"]
+                ))
+        except (KeyError, TypeError, ValueError) as e:
+            logging.info(f"Error parsing peer: {e!r}")
+    return peer_list
+
+
+def announce_delay(interval: float | None, min_interval: float | None, short_of_peers: bool = False) -> float:
+    '''
+    Function returns the delay before the next announce of the resource: the interval recommended by the tracker
+    shortened by a random part or, if the resource is short of peers, the minimum interval of the tracker lengthened
+    by a random part. None means the tracker has not recommended the interval
+    '''
+    interval, min_interval = _resolve_intervals(interval, min_interval)
+    if short_of_peers:
+        return random.uniform(min_interval, min(min_interval * (1 + ANNOUNCE_JITTER), interval))
+    return max(interval * (1 - random.uniform(0, ANNOUNCE_JITTER)), min_interval)
+
+
+def retry_delay(failures: int) -> float:
+    '''
+    Function returns the delay before announcing again after the number of consecutive failed announces. The delay
+    doubles with each failure and only a random part of it is waited, so that the peers do not come back to
+    a restarted tracker all at once
+    '''
+    delay = min(ANNOUNCE_RETRY_MIN_SECONDS * 2 ** (failures - 1), ANNOUNCE_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1)
+
+
+# The (interval, min interval) the tracker asks for, with the defaults for the ones it has not set
+def _resolve_intervals(interval: float | None, min_interval: float | None) -> tuple[float, float]:
+    interval = ANNOUNCE_INTERVAL_SECONDS if interval is None else interval
+    min_interval = MIN_ANNOUNCE_INTERVAL_SECONDS if min_interval is None else min_interval
+    return interval, min(min_interval, interval)
+
+
+class Announcer:
+    """
+    Announces all resources of the session to their trackers with batch requests (`POST /peers/batch`) and passes
+    the returned peers to the callback of each resource. The resources keep their own staggered schedules, and
+    the ones due close to each other share a request. If a tracker has no batch endpoint, the resources are
+    announced to it one by one with `POST /peers`.
+    A resource may name several trackers in tiers: the trackers of a tier are announced to in parallel, and the peers
+    of each tracker are passed on as soon as it answers (without the peers already passed in the same round), so that
+    a slow tracker does not delay the others. The next tier is tried only for the resources no tracker of the tier has
+    answered for. A failed tracker is skipped for a growing time while the other trackers are available, and the
+    trackers of a tier are tried from the healthiest one (see `TrackerHealth`).
+    Between the announces, the trackers of the first tiers push the peers joining the swarms of the resources
+    (`GET /peers/events`), so that a new peer is known to the others within a second, not with their next announce.
+    With `udp_client`, the resources are announced with the UDP protocol of the trackers, and HTTP is the fallback.
+    Each announce carries the transfer statistics of the resource and its event (started, completed, stopped),
+    so that the tracker returns the seeds to the leechers and the leechers to the seeds.
+    Each resource is announced again after the interval its trackers recommend (`interval`), or sooner while it is
+    downloaded from few peers, but never more often than they allow (`minInterval`). A resource no tracker has
+    answered for is retried after a growing random delay (see `retry_delay`).
+    The class works with asyncio, therefore its methods must be called on a thread with running event loop
+    """
+
+    def __init__(
+            self,
+            client: TrackerClient,
+            peer_id: str,
+            public_ip: str,
+            public_port: int,
+            push: bool = True,
+            udp_client: UdpTrackerClient | None = None
+    ):
+        """
+        :param client: the tracker of the resources registered without their own trackers
+        :param push: whether to subscribe to the peers joining the swarms (the subscription is dropped if the tracker
+        does not support it)
+        :param udp_client: if set, the announces are sent over UDP, and HTTP is used only while UDP fails
+        (the other trackers of the resources get their own UDP clients)
+        """
+        self.client = client
+        self.udp_client = udp_client
+        self.peer_id = peer_id
+        self.public_ip = public_ip
+        self.public_port = public_port
+
+        # (host, port) <-> the tracker, the default tracker is always there
+        self._trackers: dict[tuple[str, int], _Tracker] = {(client.host, client.port): _Tracker(client, udp_client)}
+        self._own_trackers: list[_Tracker] = []  # The trackers whose clients are created (and closed) by the announcer
+        # info_hash <-> callback receiving the peers of the resource
+        self._on_peers: dict[str, Callable[[list[PeerInfo]], Awaitable]] = dict()
+        # info_hash <-> callback returning the transfer statistics of the resource
+        self._get_stats: dict[str, Callable[[], Awaitable[ResourceManager.TransferStats]]] = dict()
+        self._tiers: dict[str, list[list[_Tracker]]] = dict()  # info_hash <-> tiers of the trackers of the resource
+        self._left: dict[str, int] = dict()  # info_hash <-> the last reported number of bytes left
+        self._next_announce: dict[str, float] = dict()  # info_hash <-> time.monotonic() of the next announce
+        # info_hash <-> time.monotonic() before which the trackers do not want the resource announced again
+        self._not_before: dict[str, float] = dict()
+        self._failures: dict[str, int] = dict()  # info_hash <-> the number of the rounds no tracker has answered
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._push = push
+        self._background_tasks: set[asyncio.Task] = set()
+
+    def register(
+            self,
+            info_hash: str,
+            on_peers: Callable[[list[PeerInfo]], Awaitable],
+            get_stats: Callable[[], Awaitable[ResourceManager.TransferStats]] | None = None,
+            trackers: list[list[tuple[str, int]]] | None = None
+    ):
+        """
+        Start announcing the resource, the first announce is sent right away
+
+        :param on_peers: receives the peers returned by the tracker
+        :param get_stats: returns the transfer statistics reported with each announce (for example,
+        `ResourceManager.get_transfer_stats`), None means the statistics are not reported
+        :param trackers: the tiers of the (host, port) of the trackers of the resource (for example,
+        `Resource.get_tracker_tiers()`), the first tier is preferred. None means the tracker of `client`
+        """
+        tiers = [[self._get_tracker(host, int(port)) for host, port in tier] for tier in trackers or [] if tier]
+        self._tiers[info_hash] = tiers or [[self._trackers[(self.client.host, self.client.port)]]]
+        self._on_peers[info_hash] = on_peers
+        if get_stats is not None:
+            self._get_stats[info_hash] = get_stats
+        for tracker in self._trackers_of(info_hash):
+            tracker.events[info_hash] = EVENT_STARTED
+        self._next_announce[info_hash] = time.monotonic()
+        self._wakeup.set()
+        self._on_resources_changed()
+
+    def unregister(self, info_hash: str):
+        """
+        Stop announcing the resource, the trackers are told that the host peer does not share it anymore
+        """
+        registered = self._on_peers.pop(info_hash, None) is not None
+        get_stats = self._get_stats.pop(info_hash, None)
+        trackers = self._trackers_of(info_hash)
+        self._tiers.pop(info_hash, None)
+        self._left.pop(info_hash, None)
+        self._next_announce.pop(info_hash, None)
+        self._not_before.pop(info_hash, None)
+        self._failures.pop(info_hash, None)
+        announced = []
+        for tracker in trackers:
+            tracker.events.pop(info_hash, None)
+            if info_hash in tracker.announced:
+                tracker.announced.discard(info_hash)
+                announced.append(tracker)
+        self._on_resources_changed()
+        if registered and announced and self._task is not None:
+            self._run_in_background(self._announce_stopped(info_hash, get_stats, announced))
+
+    def health(self) -> dict[tuple[str, int], 'TrackerHealth']:
+        """
+        :return: the health of every tracker known to the announcer by its (host, port)
+        """
+        return {address: tracker.health for address, tracker in self._trackers.items()}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._announce_loop())
+        self._start_push()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for tracker in self._trackers.values():
+            if tracker.push_task is not None:
+                tracker.push_task.cancel()
+                tracker.push_task = None
+        background_tasks = list(self._background_tasks)
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        for tracker in self._own_trackers:
+            await tracker.client.close()
+            if tracker.udp_client is not None:
+                tracker.udp_client.close()
+
+    # Return the tracker of the address, creating its clients on the first use
+    def _get_tracker(self, host: str, port: int) -> '_Tracker':
+        tracker = self._trackers.get((host, port))
+        if tracker is None:
+            tracker = _Tracker(
+                TrackerClient(host, port, timeout_seconds=self.client.timeout_seconds),
+                UdpTrackerClient(host, port) if self.udp_client is not None else None
+            )
+            self._trackers[(host, port)] = tracker
+            self._own_trackers.append(tracker)
+        return tracker
+
+    def _trackers_of(self, info_hash: str) -> list['_Tracker']:
+        return [tracker for tier in self._tiers.get(info_hash, []) for tracker in tier]
+
+    # Schedule the next announce of the resource by the intervals of the trackers that have answered for it
+    # (the shortest interval, so that no tracker forgets the host peer, and the longest minimum interval)
+    def _schedule(self, info_hash: str, now: float, trackers: list['_Tracker'], short_of_peers: bool):
+        if info_hash not in self._next_announce:
+            return
+        if not trackers:
+            failures = self._failures[info_hash] = self._failures.get(info_hash, 0) + 1
+            self._not_before.pop(info_hash, None)
+            self._next_announce[info_hash] = now + retry_delay(failures)
+            return
+
+        self._failures.pop(info_hash, None)
+        intervals = [tracker.interval_seconds for tracker in trackers if tracker.interval_seconds is not None]
+        min_intervals = [
+            tracker.min_interval_seconds for tracker in trackers if tracker.min_interval_seconds is not None
+        ]
+        interval, min_interval = _resolve_intervals(min(intervals, default=None), max(min_intervals, default=None))
+        self._not_before[info_hash] = now + min_interval
+        self._next_announce[info_hash] = now + announce_delay(interval, min_interval, short_of_peers)
+
+    async def _announce_loop(self):
+        while True:
+            now = time.monotonic()
+            # The resources due soon join the due ones, if their trackers allow announcing them already
+            due = [
+                info_hash for info_hash, announce_at in self._next_announce.items()
+                if announce_at <= now + BATCH_WINDOW_SECONDS and self._not_before.get(info_hash, 0) <= now
+            ]
+            if not due:
+                self._wakeup.clear()
+                wake_at = min(
+                    (
+                        max(announce_at - BATCH_WINDOW_SECONDS, self._not_before.get(info_hash, 0))
+                        for info_hash, announce_at in self._next_announce.items()
+                    ),
+                    default=now + ANNOUNCE_INTERVAL_SECONDS
+                )
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(wake_at - now, 0) + 0.01)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Until the announce is answered, the resources are scheduled as if it failed
+            for info_hash in due:
+                self._next_announce[info_hash] = now + retry_delay(self._failures.get(info_hash, 0) + 1)
+            for start in range(0, len(due), MAX_BATCH_SIZE):
+                try:
+                    await self._announce(due[start:start + MAX_BATCH_SIZE])
+                except Exception:
+                    logging.exception("Failed to announce to the trackers")
+
+    # The part of the announce about one resource: its info hash, transfer statistics and pending event
+    @staticmethod
+    def _resource_announce(info_hash: str, stats: ResourceManager.TransferStats | None, event: str | None) -> dict:
+        announce = {"infoHash": info_hash}
+        if stats is not None:
+            announce.update(uploaded=stats.uploaded, downloaded=stats.downloaded, left=stats.left)
+        if event is not None:
+            announce["event"] = event
+        return announce
+
+    async def _announce(self, info_hashes: list[str]):
+        announces = dict()
+        short_of_peers = set()
+        for info_hash in info_hashes:
+            get_stats = self._get_stats.get(info_hash)
+            stats = await get_stats() if get_stats is not None else None
+            if stats is not None and stats.left > 0 and stats.peers < LOW_PEER_COUNT:
+                short_of_peers.add(info_hash)
+            announce = self._resource_announce(info_hash, stats, None)
+            left = announce.get("left")
+            if left == 0 and self._left.get(info_hash, 0) > 0:
+                # The download has been completed since the last announce, each tracker is told about it once
+                for tracker in self._trackers_of(info_hash):
+                    tracker.events.setdefault(info_hash, EVENT_COMPLETED)
+            if left is not None:
+                self._left[info_hash] = left
+            announces[info_hash] = announce
+
+        # A resource goes to its next tier once all trackers of its current tier have failed, the trackers of the
+        # resources advancing together share a request. The announce returns once every resource is answered for
+        # or has no tiers left, the slow trackers still in flight finish in the background
+        now = time.monotonic()
+        tiers_left = {info_hash: tiers for info_hash in info_hashes if (tiers := self._plan(info_hash, now))}
+        unfinished: dict[str, int] = dict()  # info_hash <-> the number of the trackers of its tier still in flight
+        answered: dict[str, list[_Tracker]] = dict()  # info_hash <-> the trackers that have answered for it
+        in_flight: dict[asyncio.Task, tuple[_Tracker, list[str]]] = dict()  # task <-> its tracker and info hashes
+        delivered_peers = {info_hash: set() for info_hash in info_hashes}
+
+        def announce_next_tier(advancing: list[str]):
+            batches: dict[_Tracker, list[dict]] = dict()
+            for info_hash in advancing:
+                tier = tiers_left[info_hash].pop(0)
+                unfinished[info_hash] = len(tier)
+                for tracker in tier:
+                    batches.setdefault(tracker, []).append(tracker.announce_of(announces[info_hash]))
+            for tracker, resources in batches.items():
+                task = asyncio.create_task(self._announce_to(tracker, resources, delivered_peers))
+                self._background_tasks.add(task)
+                task.add_done_callback(self._background_tasks.discard)
+                in_flight[task] = tracker, [resource["infoHash"] for resource in resources]
+
+        def settled(info_hash: str) -> bool:
+            return info_hash in answered or (unfinished[info_hash] == 0 and not tiers_left[info_hash])
+
+        announce_next_tier(list(tiers_left))
+        while in_flight and not all(settled(info_hash) for info_hash in tiers_left):
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            advancing = []
+            for task in done:
+                tracker, announced = in_flight.pop(task)
+                for info_hash in task.result():
+                    answered.setdefault(info_hash, []).append(tracker)
+                for info_hash in announced:
+                    unfinished[info_hash] -= 1
+                    if unfinished[info_hash] == 0 and info_hash not in answered and tiers_left[info_hash]:
+                        advancing.append(info_hash)
+            if advancing:
+                announce_next_tier(advancing)
+
+        now = time.monotonic()
+        for info_hash in info_hashes:
+            self._schedule(info_hash, now, answered.get(info_hash, []), info_hash in short_of_peers)
+
+    # The tiers to try for the resource: the trackers that have not failed recently, the healthiest first
+    # (if all of them have failed recently, the healthiest one is tried anyway)
+    def _plan(self, info_hash: str, now: float) -> list[list['_Tracker']]:
+        tiers = [sorted(tier, key=lambda tracker: tracker.health.rank()) for tier in self._tiers.get(info_hash, [])]
+        available = [[tracker for tracker in tier if tracker.health.available(now)] for tier in tiers]
+        available = [tier for tier in available if tier]
+        if available or not tiers:
+            return available
+        return [[min((tracker for tier in tiers for tracker in tier), key=lambda tracker: tracker.health.rank())]]
+
+    # Announce the resources to one tracker, return the info hashes the tracker has answered for
+    async def _announce_to(
+            self,
+            tracker: '_Tracker',
+            resources: list[dict],
+            delivered_peers: dict[str, set[str]]
+    ) -> set[str]:
+        started_at = time.monotonic()
+        try:
+            answered = await self._send_announces(tracker, resources, delivered_peers)
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            logging.info(f"Failed to announce to {tracker.address}: {e!r}")
+            answered = set()
+        except Exception:
+            logging.exception(f"Failed to announce to {tracker.address}")
+            answered = set()
+        if answered:
+            tracker.health.on_success(time.monotonic() - started_at)
+        else:
+            tracker.health.on_failure(time.monotonic())
+        return answered
+
+    async def _send_announces(
+            self,
+            tracker: '_Tracker',
+            resources: list[dict],
+            delivered_peers: dict[str, set[str]]
+    ) -> set[str]:
+        answered = set()
+        if self._udp_usable(tracker):
+            failed = await self._announce_udp(tracker, resources, delivered_peers)
+            answered = {resource["infoHash"] for resource in resources if resource not in failed}
+            resources = failed
+            if not resources:
+                return answered
+
+        if tracker.batch_supported:
+            status, text = await tracker.client.post_json('/peers/batch', {
+                "peerId": self.peer_id,
+                "publicIp": self.public_ip,
+                "publicPort": str(self.public_port),
+                "resources": resources,
+                "numwant": NUM_WANT,
+                "compact": True
+            })
+            if status == 404:
+                logging.info(f"The tracker {tracker.address} has no batch endpoint, announce the resources one by one")
+                tracker.batch_supported = False
+            elif status != 200:
+                logging.info(f"Failed to announce to {tracker.address}. Status code: {status}")
+                return answered
+            else:
+                response = json.loads(text)
+                tracker.on_response(response)
+                peers = response.get("peers") or {}
+                self._on_delivered(tracker, resources)
+                await self._deliver(
+                    {resource["infoHash"]: peers.get(resource["infoHash"]) for resource in resources},
+                    delivered_peers
+                )
+                return answered | {resource["infoHash"] for resource in resources}
+
+        responses = await asyncio.gather(
+            *(tracker.client.post_json('/peers', {
+                "peerId": self.peer_id,
+                "publicIp": self.public_ip,
+                "publicPort": str(self.public_port),
+                **resource,
+                "numwant": NUM_WANT,
+                "compact": True
+            }) for resource in resources),
+            return_exceptions=True
+        )
+        peers = dict()
+        for resource, response in zip(resources, responses):
+            if not isinstance(response, BaseException) and response[0] == 200:
+                # A malformed response fails the announce of its resource only
+                try:
+                    response = json.loads(response[1])
+                    tracker.on_response(response)
+                except (ValueError, AttributeError) as e:
+                    logging.info(f"Malformed response of {tracker.address} for {resource['infoHash']}: {e!r}")
+                    continue
+                self._on_delivered(tracker, [resource])
+                peers[resource["infoHash"]] = response.get("peers")
+        await self._deliver(peers, delivered_peers)
+        return answered | set(peers)
+
+    def _udp_usable(self, tracker: '_Tracker') -> bool:
+        return tracker.udp_client is not None and time.monotonic() >= tracker.udp_retry_at
+
+    # Announce the resources over UDP, return the resources the tracker has not answered for
+    async def _announce_udp(
+            self,
+            tracker: '_Tracker',
+            resources: list[dict],
+            delivered_peers: dict[str, set[str]] | None = None
+    ) -> list[dict]:
+        responses = await asyncio.gather(
+            *(tracker.udp_client.announce(
+                resource["infoHash"],
+                self.peer_id,
+                self.public_ip,
+                self.public_port,
+                uploaded=resource.get("uploaded", 0),
+                downloaded=resource.get("downloaded", 0),
+                left=resource.get("left"),
+                event=resource.get("event"),
+                num_want=NUM_WANT
+            ) for resource in resources),
+            return_exceptions=True
+        )
+        peers = dict()
+        failed = []
+        for resource, response in zip(resources, responses):
+            if isinstance(response, (OSError, asyncio.TimeoutError, RuntimeError)):
+                failed.append(resource)
+            elif isinstance(response, BaseException):
+                raise response
+            else:
+                tracker.interval_seconds = response.interval_seconds or None
+                self._on_delivered(tracker, [resource])
+                peers[resource["infoHash"]] = response.compact_peers
+        if failed:
+            logging.info(f"The UDP announce to {tracker.address} failed, use HTTP for {UDP_FALLBACK_SECONDS} seconds")
+            tracker.udp_retry_at = time.monotonic() + UDP_FALLBACK_SECONDS
+        await self._deliver(peers, delivered_peers)
+        return failed
+
+    # Forget the events the tracker has received (the other events are sent again with the next announce)
+    def _on_delivered(self, tracker: '_Tracker', resources: list[dict]):
+        for resource in resources:
+            info_hash = resource["infoHash"]
+            if info_hash in self._on_peers:
+                tracker.announced.add(info_hash)
+            if "event" in resource and tracker.events.get(info_hash) == resource["event"]:
+                del tracker.events[info_hash]
+
+    async def _announce_stopped(
+            self,
+            info_hash: str,
+            get_stats: Callable[[], Awaitable[ResourceManager.TransferStats]] | None,
+            trackers: list['_Tracker']
+    ):
+        try:
+            resource = self._resource_announce(info_hash, await get_stats() if get_stats else None, EVENT_STOPPED)
+        except Exception:
+            logging.exception("Failed to get the transfer statistics of the stopped resource")
+            return
+        await asyncio.gather(*(self._send_stopped(tracker, resource) for tracker in trackers))
+
+    async def _send_stopped(self, tracker: '_Tracker', resource: dict):
+        try:
+            if self._udp_usable(tracker) and not await self._announce_udp(tracker, [resource]):
+                return
+            status, _ = await tracker.client.post_json('/peers', {
+                "peerId": self.peer_id,
+                "publicIp": self.public_ip,
+                "publicPort": str(self.public_port),
+                **resource
+            })
+            if status != 200:
+                logging.info(f"Failed to announce the stop to {tracker.address}. Status code: {status}")
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.info(f"Error announcing the stop to {tracker.address}: {e!r}")
+
+    # The trackers of the first tiers push the peers of the resources, the other tiers are only fallbacks
+    def _push_info_hashes(self, tracker: '_Tracker') -> list[str]:
+        return [info_hash for info_hash, tiers in self._tiers.items() if tracker in tiers[0]][:MAX_PUSH_INFO_HASHES]
+
+    def _on_resources_changed(self):
+        for tracker in self._trackers.values():
+            tracker.push_changed.set()
+        self._start_push()
+
+    def _start_push(self):
+        if not self._push or self._task is None:
+            return
+        for tracker in {tracker for tiers in self._tiers.values() for tracker in tiers[0]}:
+            if tracker.push_task is None and tracker.push_supported:
+                tracker.push_task = asyncio.create_task(self._push_loop(tracker))
+
+    async def _push_loop(self, tracker: '_Tracker'):
+        retry_delay = PUSH_RETRY_MIN_SECONDS
+        while True:
+            if not self._push_info_hashes(tracker):
+                tracker.push_changed.clear()
+                await tracker.push_changed.wait()
+            await asyncio.sleep(PUSH_RESUBSCRIBE_DELAY_SECONDS)
+            tracker.push_changed.clear()
+            info_hashes = self._push_info_hashes(tracker)
+            if not info_hashes:
+                continue
+
+            # The subscription lasts until the tracker closes it or the registered resources change
+            stream = asyncio.create_task(self._receive_pushes(tracker, info_hashes))
+            changed = asyncio.create_task(tracker.push_changed.wait())
+            try:
+                await asyncio.wait([stream, changed], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                stream.cancel()
+                changed.cancel()
+            if not stream.done() or stream.cancelled():
+                continue
+
+            try:
+                status = stream.result()
+            except (OSError, asyncio.TimeoutError, ValueError) as e:
+                logging.info(f"The subscription to the tracker {tracker.address} failed: {e!r}")
+                status = None
+            if status == 404:
+                logging.info(f"The tracker {tracker.address} does not push the peers, rely on the announces")
+                tracker.push_supported = False
+                return
+            # The tracker ends the accepted subscriptions from time to time, these are reopened right away
+            retry_delay = PUSH_RETRY_MIN_SECONDS if status == 200 else min(retry_delay * 2, PUSH_RETRY_MAX_SECONDS)
+            await asyncio.sleep(retry_delay)
+
+    async def _receive_pushes(self, tracker: '_Tracker', info_hashes: list[str]) -> int:
+        query = '&'.join(f'infoHash={info_hash}' for info_hash in info_hashes)
+        status, events = await tracker.client.events(f'/peers/events?{query}')
+        async with aclosing(events):
+            async for event_type, data in events:
+                if event_type == 'join':
+                    self._on_join(json.loads(data))
+        return status
+
+    def _on_join(self, peer_json: dict):
+        info_hash = peer_json.get("infoHash")
+        on_peers = self._on_peers.get(info_hash)
+        if on_peers is None:
+            return
+        if peer_json.get("seed") and self._left.get(info_hash) == 0:
+            return  # Two seeds have nothing to exchange
+        peers = parse_peer_list([peer_json], self.peer_id)
+        if peers:
+            self._run_in_background(self._run_callback(on_peers(peers)))
+
+    # Pass the peers to the callbacks of their resources, without the peers passed before in the same announce round
+    async def _deliver(
+            self,
+            peers: dict[str, list | str | bytes | None],
+            delivered_peers: dict[str, set[str]] | None = None
+    ):
+        for info_hash, peers_json in peers.items():
+            on_peers = self._on_peers.get(info_hash)
+            if on_peers is None or not peers_json:
+                continue
+            peer_list = parse_peer_list(peers_json, self.peer_id)
+            if delivered_peers is not None:
+                seen = delivered_peers.setdefault(info_hash, set())
+                peer_list = [peer for peer in peer_list if peer.peer_id not in seen]
+                seen.update(peer.peer_id for peer in peer_list)
+            if peer_list:
+                # The callbacks run in the background, so that the slow dialing does not delay the next announces
+                self._run_in_background(self._run_callback(on_peers(peer_list)))
+
+    def _run_in_background(self, coroutine: Awaitable):
+        task = asyncio.create_task(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    @staticmethod
+    async def _run_callback(callback: Awaitable):
+        try:
+            await callback
+        except Exception:
+            logging.exception("Failed to handle the peers from the tracker")
+
+
+@dataclass
+class TrackerHealth:
+    """
+    The record of the announces sent to one tracker. A failed tracker is skipped for a time doubling with each
+    consecutive failure (while other trackers are available), and the trackers are tried in the order of `rank`.
+    """
+    successes: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    latency_seconds: float | None = None  # The smoothed response time of the answered announces
+    retry_at: float = 0.0  # time.monotonic() before which the tracker is skipped if possible
+
+    def on_success(self, latency_seconds: float):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.retry_at = 0.0
+        if self.latency_seconds is None:
+            self.latency_seconds = latency_seconds
+        else:
+            self.latency_seconds += LATENCY_SMOOTHING * (latency_seconds - self.latency_seconds)
+
+    def on_failure(self, now: float):
+        self.failures += 1
+        self.consecutive_failures += 1
+        delay = TRACKER_RETRY_MIN_SECONDS * 2 ** (self.consecutive_failures - 1)
+        self.retry_at = now + min(delay, TRACKER_RETRY_MAX_SECONDS)
+
+    def available(self, now: float) -> bool:
+        return now >= self.retry_at
+
+    def rank(self) -> tuple[int, float]:
+        """
+        :return: the key ordering the trackers from the healthiest one: the fewest consecutive failures, then the
+        fastest responses (a tracker not yet asked is tried early)
+        """
+        return self.consecutive_failures, self.latency_seconds or 0.0
+
+
+class _Tracker:
+    # The state of one tracker of the announcer
+    def __init__(self, client: TrackerClient, udp_client: UdpTrackerClient | None):
+        self.client = client
+        self.udp_client = udp_client
+        self.address = f'{client.host}:{client.port}'
+        self.health = TrackerHealth()
+        self.batch_supported = True
+        self.udp_retry_at = 0.0  # time.monotonic() when UDP is tried again after a failure
+        self.events: dict[str, str] = dict()  # info_hash <-> the event not yet delivered to this tracker
+        self.announced: set[str] = set()  # The info hashes this tracker has been told about
+        self.push_supported = True
+        self.push_task: asyncio.Task | None = None
+        self.push_changed = asyncio.Event()  # The resources pushed by this tracker may have changed
+        self.interval_seconds: float | None = None  # The announce interval the tracker recommends
+        self.min_interval_seconds: float | None = None  # The tracker asks not to announce more often than this
+
+    # Remember the announce intervals of the tracker response (the trackers not sending them keep the defaults)
+    def on_response(self, response: dict):
+        for key, attribute in ("interval", "interval_seconds"), ("minInterval", "min_interval_seconds"):
+            value = response.get(key)
+            if isinstance(value, (int, float)) and value >= 0:
+                setattr(self, attribute, value)
+
+    # The announce of the resource for this tracker, with the event this tracker has not received yet
+    def announce_of(self, announce: dict) -> dict:
+        event = self.events.get(announce["infoHash"])
+        return {**announce, "event": event} if event is not None else announce
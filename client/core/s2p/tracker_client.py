@@ -0,0 +1,210 @@
+import asyncio
+import json
+from collections import deque
+from typing import AsyncIterator
+
+
+class TrackerClient:
+    """
+    A minimal asyncio HTTP/1.1 client for the tracker. The connections are kept alive and reused by the next requests
+    (at most `max_idle_connections` idle connections are kept), so that the periodic announces do not open a new TCP
+    connection each time. The timeout covers the whole request and delays only its caller, never the event loop.
+    The class works with asyncio, therefore its methods must be called on a thread with running event loop
+    """
+
+    def __init__(self, host: str, port: int, timeout_seconds: float = 5.0, max_idle_connections: int = 4):
+        self.host = host
+        self.port = port
+        self.timeout_seconds = timeout_seconds
+        self.max_idle_connections = max_idle_connections
+        self._idle: deque[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = deque()
+
+    async def post_json(self, path: str, payload) -> tuple[int, str]:
+        """
+        :return: the status code and the text of the response
+        """
+        status, body = await self.request(
+            'POST',
+            path,
+            json.dumps(payload).encode(),
+            {'Content-Type': 'application/json'}
+        )
+        return status, body.decode()
+
+    async def get(self, path: str) -> tuple[int, str]:
+        """
+        :return: the status code and the text of the response
+        """
+        status, body = await self.request('GET', path)
+        return status, body.decode()
+
+    async def request(
+            self,
+            method: str,
+            path: str,
+            body: bytes | None = None,
+            headers: dict[str, str] | None = None
+    ) -> tuple[int, bytes]:
+        """
+        Send the request, raises asyncio.TimeoutError if the response does not arrive in `timeout_seconds`
+
+        :return: the status code and the body of the response
+        """
+        return await asyncio.wait_for(self._request(method, path, body, headers or {}), self.timeout_seconds)
+
+    async def events(self, path: str) -> tuple[int, AsyncIterator[tuple[str, str]]]:
+        """
+        Open a stream of server-sent events. The stream has its own connection, and only the response headers must
+        arrive in `timeout_seconds`. The events are read until the tracker closes the stream or the iterator is closed.
+
+        :return: the status code of the response and the iterator of the event types and data (the iterator is empty
+        if the status code is not 200)
+        """
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout_seconds)
+        try:
+            writer.write(
+                f'GET {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nAccept: text/event-stream\r\n\r\n'.encode()
+            )
+            await writer.drain()
+            status, headers = await asyncio.wait_for(self._read_head(reader), self.timeout_seconds)
+        except BaseException:
+            writer.close()
+            raise
+        if status != 200:
+            writer.close()
+            return status, self._no_events()
+        return status, self._read_events(reader, writer, headers)
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.popleft()
+            writer.close()
+
+    async def _acquire(self) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        return reader, writer, False
+
+    def _release(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if len(self._idle) < self.max_idle_connections:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _request(self, method: str, path: str, body: bytes | None, headers: dict[str, str]) -> tuple[int, bytes]:
+        headers = {
+            'Host': f'{self.host}:{self.port}',
+            'Connection': 'keep-alive',
+            'Content-Length': str(len(body or b'')),
+            **headers
+        }
+        request = f'{method} {path} HTTP/1.1\r\n'.encode() + \
+            ''.join(f'{name}: {value}\r\n' for name, value in headers.items()).encode() + b'\r\n' + (body or b'')
+
+        while True:
+            reader, writer, reused = await self._acquire()
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, response_headers, response_body = await self._read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue  # The tracker has closed the idle connection, retry on a fresh one
+                raise
+            except BaseException:
+                writer.close()
+                raise
+
+            if response_headers.get('connection', '').lower() == 'close' or reader.at_eof():
+                writer.close()
+            else:
+                self._release(reader, writer)
+            return status, response_body
+
+    @staticmethod
+    async def _read_head(reader: asyncio.StreamReader) -> tuple[int, dict[str, str]]:
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("The tracker closed the connection")
+        status = int(status_line.split()[1])
+
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader) -> tuple[int, dict[str, str], bytes]:
+        status, headers = await TrackerClient._read_head(reader)
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()  # The empty trailer
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()  # The body lasts until the tracker closes the connection
+        return status, headers, body
+
+    @staticmethod
+    async def _no_events() -> AsyncIterator[tuple[str, str]]:
+        return
+        yield
+
+    @staticmethod
+    async def _read_events(
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            headers: dict[str, str]
+    ) -> AsyncIterator[tuple[str, str]]:
+        chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        buffer = b''
+        event_type, data = 'message', []
+        try:
+            while True:
+                if chunked:
+                    size = int((await reader.readline()).split(b';')[0], 16)
+                    if size == 0:
+                        return
+                    chunk = await reader.readexactly(size)
+                    await reader.readline()
+                else:
+                    chunk = await reader.read(64 * 1024)
+                    if not chunk:
+                        return
+
+                buffer += chunk
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    line = line.rstrip(b'\r').decode()
+                    if not line:  # The empty line ends the event
+                        if data:
+                            yield event_type, '\n'.join(data)
+                        event_type, data = 'message', []
+                    elif line.startswith(':'):
+                        continue  # A comment, for example, the keep-alive
+                    else:
+                        name, _, value = line.partition(':')
+                        value = value.removeprefix(' ')
+                        if name == 'event':
+                            event_type = value
+                        elif name == 'data':
+                            data.append(value)
+        finally:
+            writer.close()
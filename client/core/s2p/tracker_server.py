@@ -0,0 +1,335 @@
+import asyncio
+import base64
+import heapq
+import ipaddress
+import json
+import logging
+import random
+import time
+from dataclasses import dataclass
+from urllib.parse import parse_qs, urlsplit
+
+# The peer not announcing itself for this long is removed (the same as in the Go tracker)
+PEER_LIFESPAN_SECONDS = 35
+
+# The announce interval recommended to the peers and the shortest interval they may announce at (the same as in
+# the Go tracker)
+ANNOUNCE_INTERVAL_SECONDS = 30
+MIN_ANNOUNCE_INTERVAL_SECONDS = 10
+
+# How often the expired peers are removed
+EXPIRE_INTERVAL_SECONDS = 1
+
+DEFAULT_NUM_WANT = 50
+MAX_NUM_WANT = 200
+MAX_BATCH_SIZE = 1000
+
+# The number of events kept for a slow subscriber, the next events are dropped (the same as in the Go tracker)
+SUBSCRIPTION_BUFFER = 256
+
+# How often an idle event stream gets a comment line
+PUSH_KEEP_ALIVE_SECONDS = 15
+
+
+@dataclass
+class _PeerEntry:
+    peer: dict  # peerId, infoHash, publicIp, publicPort as they are returned to the peers
+    seed: bool
+    expires_at: float
+
+
+class TrackerServer:
+    """
+    A pure-Python asyncio implementation of the HTTP contract of the tracker (`tracker/main.go`): `POST /peers`,
+    `POST /peers/batch`, `GET /peers`, `GET /scrape` and the push of the peer events with `GET /peers/events`,
+    with the same expiry of the peers. It runs in the process of the caller, so that the swarm tests and benchmarks
+    need no outside service:
+
+        tracker = TrackerServer()
+        port = await tracker.start()
+        resource_json = create_resource_json(name, comment, file_path, trackers=[[('127.0.0.1', port)]])
+
+    The UDP protocol is not implemented, the clients fall back to HTTP.
+    The class works with asyncio, therefore its methods must be called on a thread with running event loop
+    """
+
+    def __init__(
+            self,
+            peer_lifespan_seconds: float = PEER_LIFESPAN_SECONDS,
+            announce_interval_seconds: float = ANNOUNCE_INTERVAL_SECONDS,
+            min_announce_interval_seconds: float = MIN_ANNOUNCE_INTERVAL_SECONDS
+    ):
+        """
+        :param announce_interval_seconds: returned with the announces as `interval`, must be shorter than
+        the lifespan of the peers
+        :param min_announce_interval_seconds: returned with the announces as `minInterval`
+        """
+        self.peer_lifespan_seconds = peer_lifespan_seconds
+        self.announce_interval_seconds = announce_interval_seconds
+        self.min_announce_interval_seconds = min_announce_interval_seconds
+        self._swarms: dict[str, dict[str, _PeerEntry]] = dict()  # info_hash <-> peer_id <-> entry
+        self._downloaded: dict[str, int] = dict()  # info_hash <-> the number of the completed downloads
+        # (expires_at, info_hash, peer_id), an entry is outdated if the peer has announced itself since
+        self._expiry: list[tuple[float, str, str]] = []
+        self._server: asyncio.Server | None = None
+        self._expire_task: asyncio.Task | None = None
+        self._subscribers: dict[str, set[asyncio.Queue]] = dict()  # info_hash <-> queues of the event streams
+        self._connections: dict[asyncio.Task, asyncio.StreamWriter] = dict()  # The tasks serving the connections
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> int:
+        """
+        :return: the port the tracker listens on
+        """
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        self._expire_task = asyncio.create_task(self._expire_loop())
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._expire_task is not None:
+            self._expire_task.cancel()
+            self._expire_task = None
+        if self._server is not None:
+            self._server.close()
+            # Closing the connections ends their tasks (the cancelled tasks of asyncio servers are reported as errors)
+            handlers = list(self._connections)
+            for writer in self._connections.values():
+                writer.close()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    def announce(self, announce: dict, now: float | None = None) -> list[dict]:
+        """
+        Register or refresh the peer of the announce (the body of `POST /peers`)
+
+        :param now: the time.monotonic() of the announce
+
+        :return: a random sample of the other peers of the resource, the seeds get only the leechers
+        """
+        info_hash, peer_id = announce["infoHash"], announce["peerId"]
+        swarm = self._swarms.setdefault(info_hash, dict())
+        event = announce.get("event")
+        if event == 'stopped':
+            entry = swarm.pop(peer_id, None)
+            if not swarm:
+                del self._swarms[info_hash]
+            if entry is not None:
+                self._publish('leave', entry)
+            return []
+        if event == 'completed':
+            self._downloaded[info_hash] = self._downloaded.get(info_hash, 0) + 1
+
+        seed = announce.get("left") == 0
+        expires_at = (time.monotonic() if now is None else now) + self.peer_lifespan_seconds
+        joined = peer_id not in swarm
+        swarm[peer_id] = _PeerEntry(
+            peer={
+                "peerId": peer_id,
+                "infoHash": info_hash,
+                "publicIp": announce["publicIp"],
+                "publicPort": str(announce["publicPort"])
+            },
+            seed=seed,
+            expires_at=expires_at
+        )
+        heapq.heappush(self._expiry, (expires_at, info_hash, peer_id))
+        if joined:
+            self._publish('join', swarm[peer_id])
+        return self._sample(info_hash, peer_id, self._num_want(announce.get("numwant")), seed)
+
+    def scrape(self, info_hash: str) -> dict:
+        swarm = self._swarms.get(info_hash, dict())
+        seeds = sum(entry.seed for entry in swarm.values())
+        return {
+            "complete": seeds,
+            "incomplete": len(swarm) - seeds,
+            "downloaded": self._downloaded.get(info_hash, 0)
+        }
+
+    def expire(self, now: float | None = None):
+        """
+        Remove the peers that have not announced themselves for the lifespan
+        """
+        now = time.monotonic() if now is None else now
+        while self._expiry and self._expiry[0][0] < now:
+            expires_at, info_hash, peer_id = heapq.heappop(self._expiry)
+            swarm = self._swarms.get(info_hash)
+            entry = swarm.get(peer_id) if swarm is not None else None
+            if entry is not None and entry.expires_at == expires_at:
+                logging.debug(f"Peer {peer_id[:6]} seems to be dead. Removing...")
+                del swarm[peer_id]
+                if not swarm:
+                    del self._swarms[info_hash]
+                self._publish('leave', entry)
+
+    @staticmethod
+    def _num_want(num_want) -> int:
+        if not isinstance(num_want, int) or num_want <= 0:
+            return DEFAULT_NUM_WANT
+        return min(num_want, MAX_NUM_WANT)
+
+    def _sample(self, info_hash: str, exclude: str, num_want: int, for_seed: bool) -> list[dict]:
+        swarm = self._swarms.get(info_hash, dict())
+        seeds = [entry.peer for peer_id, entry in swarm.items() if entry.seed and peer_id != exclude]
+        leechers = [entry.peer for peer_id, entry in swarm.items() if not entry.seed and peer_id != exclude]
+        sample = [] if for_seed else random.sample(seeds, min(num_want, len(seeds)))
+        return sample + random.sample(leechers, min(num_want - len(sample), len(leechers)))
+
+    @staticmethod
+    def _peer_list(peers: list[dict], compact: bool) -> list[dict] | str:
+        if not compact:
+            return peers
+        encoded = []
+        for peer in peers:
+            try:
+                encoded.append(
+                    bytes.fromhex(peer["peerId"]) +
+                    ipaddress.IPv4Address(peer["publicIp"]).packed +
+                    int(peer["publicPort"]).to_bytes(2, 'big')
+                )
+            except ValueError:
+                continue  # Not a 32 byte id or not an IPv4 address
+        return base64.b64encode(b''.join(encoded)).decode()
+
+    # Pass the event to the subscribers of the info hash of the peer without ever blocking
+    def _publish(self, event_type: str, entry: _PeerEntry):
+        for queue in self._subscribers.get(entry.peer["infoHash"], ()):
+            try:
+                queue.put_nowait((event_type, {**entry.peer, "seed": entry.seed}))
+            except asyncio.QueueFull:
+                pass
+
+    # Stream the events of the peers of the info hashes until the subscriber closes the connection
+    async def _stream_events(self, info_hashes: list[str], reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if not info_hashes or len(info_hashes) > MAX_BATCH_SIZE:
+            status = 400 if not info_hashes else 413
+            writer.write(f'HTTP/1.1 {status} Error\r\nContent-Length: 0\r\n\r\n'.encode())
+            await writer.drain()
+            return
+
+        def write_chunk(text: str):
+            data = text.encode()
+            writer.write(f'{len(data):x}\r\n'.encode() + data + b'\r\n')
+
+        queue = asyncio.Queue(SUBSCRIPTION_BUFFER)
+        for info_hash in info_hashes:
+            self._subscribers.setdefault(info_hash, set()).add(queue)
+        closed = asyncio.create_task(reader.read())  # The subscriber sends nothing more, EOF means it has left
+        try:
+            writer.write(
+                b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                b'Transfer-Encoding: chunked\r\n\r\n'
+            )
+            await writer.drain()
+            while not closed.done():
+                event = asyncio.create_task(queue.get())
+                await asyncio.wait(
+                    {event, closed},
+                    timeout=PUSH_KEEP_ALIVE_SECONDS,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if event.done():
+                    event_type, data = event.result()
+                    write_chunk(f'event: {event_type}\ndata: {json.dumps(data)}\n\n')
+                else:
+                    event.cancel()
+                    if not closed.done():
+                        write_chunk(': keep-alive\n\n')
+                await writer.drain()
+        finally:
+            closed.cancel()
+            for info_hash in info_hashes:
+                subscribers = self._subscribers.get(info_hash)
+                if subscribers is not None:
+                    subscribers.discard(queue)
+                    if not subscribers:
+                        del self._subscribers[info_hash]
+
+    async def _expire_loop(self):
+        while True:
+            self.expire()
+            await asyncio.sleep(EXPIRE_INTERVAL_SECONDS)
+
+    # Route the request, return the status code and the JSON of the response
+    def _route(self, method: str, target: str, body: bytes) -> tuple[int, object]:
+        url = urlsplit(target)
+        query = parse_qs(url.query)
+        if method == 'POST' and url.path == '/peers':
+            announce = json.loads(body)
+            peers = self.announce(announce)
+            return 200, {
+                "infoHash": announce["infoHash"],
+                "peers": self._peer_list(peers, announce.get("compact")),
+                **self._intervals()
+            }
+        if method == 'POST' and url.path == '/peers/batch':
+            announce = json.loads(body)
+            resources = announce.get("resources") or [{"infoHash": h} for h in announce.get("infoHashes") or []]
+            if len(resources) > MAX_BATCH_SIZE:
+                return 413, None
+            response = dict()
+            for resource in resources:
+                peers = self.announce({
+                    "peerId": announce["peerId"],
+                    "publicIp": announce["publicIp"],
+                    "publicPort": announce["publicPort"],
+                    "numwant": announce.get("numwant"),
+                    **resource
+                })
+                response[resource["infoHash"]] = self._peer_list(peers, announce.get("compact"))
+            return 200, {"peers": response, **self._intervals()}
+        if method == 'GET' and url.path == '/peers':
+            if "infoHash" not in query:
+                return 200, {
+                    info_hash: {peer_id: entry.peer for peer_id, entry in swarm.items()}
+                    for info_hash, swarm in self._swarms.items()
+                }
+            info_hash = query["infoHash"][0]
+            num_want = self._num_want(int(query["numwant"][0]) if "numwant" in query else None)
+            compact = query.get("compact", ["false"])[0].lower() in ('1', 'true')
+            peers = self._sample(info_hash, '', num_want, False)
+            return 200, {"infoHash": info_hash, "peers": self._peer_list(peers, compact)}
+        if method == 'GET' and url.path == '/scrape':
+            return 200, {"files": {info_hash: self.scrape(info_hash) for info_hash in query.get("infoHash", [])}}
+        return 404, None
+
+    def _intervals(self) -> dict:
+        return {"interval": self.announce_interval_seconds, "minInterval": self.min_announce_interval_seconds}
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections[asyncio.current_task()] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = dict()
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                url = urlsplit(target)
+                if method == 'GET' and url.path == '/peers/events':
+                    await self._stream_events(parse_qs(url.query).get("infoHash", []), reader, writer)
+                    break
+
+                try:
+                    status, response = self._route(method, target, body)
+                except (ValueError, KeyError, TypeError) as e:
+                    logging.debug(f"Bad tracker request: {e!r}")
+                    status, response = 400, None
+                content = b'' if response is None else json.dumps(response).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                    f'Content-Type: application/json\r\nContent-Length: {len(content)}\r\n\r\n'.encode() + content
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._connections.pop(asyncio.current_task(), None)
+            writer.close()
@@ -0,0 +1,194 @@
+import asyncio
+import ipaddress
+import random
+import struct
+import time
+from dataclasses import dataclass
+
+# The first attempt of a request waits this long for the response, each retry waits twice as long as the previous one
+UDP_TIMEOUT_SECONDS = 2
+
+# The number of retries after the first attempt
+UDP_MAX_RETRIES = 2
+
+# The connection id is used for this long, the tracker accepts it for at least 2 minutes
+CONNECTION_ID_LIFETIME_SECONDS = 60
+
+_PROTOCOL_ID = 0x41727101980
+_ACTION_CONNECT = 0
+_ACTION_ANNOUNCE = 1
+_ACTION_ERROR = 3
+
+_CONNECT_REQUEST = struct.Struct('>QII')
+_CONNECT_RESPONSE = struct.Struct('>IIQ')
+# [connection-id][action][transaction-id][info-hash][peer-id][downloaded][left][uploaded][event][IPv4][numwant][port]
+_ANNOUNCE_REQUEST = struct.Struct('>QII32s32sQQQI4siH')
+_ANNOUNCE_RESPONSE = struct.Struct('>IIIII')
+_RESPONSE_HEADER = struct.Struct('>II')
+
+_EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+_LEFT_UNKNOWN = 2 ** 64 - 1
+
+
+@dataclass
+class UdpAnnounceResponse:
+    interval_seconds: int
+    leechers: int
+    seeders: int
+    compact_peers: bytes  # The peers in the compact peer list format
+
+
+class _UdpTrackerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client: 'UdpTrackerClient'):
+        self.client = client
+
+    def datagram_received(self, data: bytes, addr):
+        self.client._on_response(data)
+
+    def error_received(self, exc: Exception):
+        self.client._on_error(exc)
+
+    def connection_lost(self, exc: Exception | None):
+        self.client._on_error(exc or ConnectionResetError("The UDP socket is closed"))
+
+
+class UdpTrackerClient:
+    """
+    The client of the connectionless UDP announce protocol of the tracker (see `tracker/udp.go`). An announce
+    costs one datagram each way (plus the connection id handshake once a minute) instead of a TCP connection and
+    an HTTP request with JSON. The lost datagrams are sent again with a growing timeout, and if the tracker does not
+    answer at all, asyncio.TimeoutError is raised, so that the caller falls back to HTTP.
+    The class works with asyncio, therefore its methods must be called on a thread with running event loop
+    """
+
+    def __init__(
+            self,
+            host: str,
+            port: int,
+            timeout_seconds: float = UDP_TIMEOUT_SECONDS,
+            max_retries: int = UDP_MAX_RETRIES
+    ):
+        self.host = host
+        self.port = port
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self._transport: asyncio.DatagramTransport | None = None
+        self._pending: dict[int, asyncio.Future] = dict()  # transaction id <-> future of the response
+        self._connection_id: int | None = None
+        self._connection_id_expires_at = 0.0
+
+    async def announce(
+            self,
+            info_hash: str,
+            peer_id: str,
+            public_ip: str,
+            public_port: int,
+            uploaded: int = 0,
+            downloaded: int = 0,
+            left: int | None = None,
+            event: str | None = None,
+            num_want: int = -1
+    ) -> UdpAnnounceResponse:
+        """
+        Announce the resource, raises asyncio.TimeoutError if the tracker does not answer, OSError if the packets
+        cannot be sent and RuntimeError if the tracker answers with an error
+
+        :param public_ip: the IPv4 address put in the announce (zero if it is not IPv4), the tracker of this
+        repository ignores it and stores the address of the sender
+        :param left: None means unknown
+        :param num_want: -1 means the default of the tracker
+        """
+        try:
+            ip = ipaddress.IPv4Address(public_ip).packed
+        except ValueError:
+            ip = bytes(4)
+
+        for attempt in range(2):
+            connection_id = await self._get_connection_id()
+            try:
+                response = await self._request(lambda transaction_id: _ANNOUNCE_REQUEST.pack(
+                    connection_id,
+                    _ACTION_ANNOUNCE,
+                    transaction_id,
+                    bytes.fromhex(info_hash),
+                    bytes.fromhex(peer_id),
+                    downloaded,
+                    _LEFT_UNKNOWN if left is None else left,
+                    uploaded,
+                    _EVENTS[event],
+                    ip,
+                    num_want,
+                    public_port
+                ))
+            except RuntimeError:
+                if attempt == 0:
+                    self._connection_id = None  # The connection id may have expired on the tracker
+                    continue
+                raise
+            if len(response) < _ANNOUNCE_RESPONSE.size:
+                raise RuntimeError("The announce response is too short")
+            action, _, interval, leechers, seeders = _ANNOUNCE_RESPONSE.unpack_from(response)
+            if action != _ACTION_ANNOUNCE:
+                raise RuntimeError(f"Unexpected action {action} in the announce response")
+            return UdpAnnounceResponse(interval, leechers, seeders, response[_ANNOUNCE_RESPONSE.size:])
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+    async def _get_connection_id(self) -> int:
+        if self._connection_id is None or time.monotonic() >= self._connection_id_expires_at:
+            response = await self._request(
+                lambda transaction_id: _CONNECT_REQUEST.pack(_PROTOCOL_ID, _ACTION_CONNECT, transaction_id)
+            )
+            if len(response) < _CONNECT_RESPONSE.size:
+                raise RuntimeError("The connect response is too short")
+            action, _, connection_id = _CONNECT_RESPONSE.unpack_from(response)
+            if action != _ACTION_CONNECT:
+                raise RuntimeError(f"Unexpected action {action} in the connect response")
+            self._connection_id = connection_id
+            self._connection_id_expires_at = time.monotonic() + CONNECTION_ID_LIFETIME_SECONDS
+        return self._connection_id
+
+    # Send the request built for a new transaction id until the response arrives, return the response
+    async def _request(self, build) -> bytes:
+        if self._transport is None:
+            self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _UdpTrackerProtocol(self),
+                remote_addr=(self.host, self.port)
+            )
+
+        for attempt in range(self.max_retries + 1):
+            transaction_id = random.getrandbits(32)
+            future = asyncio.get_running_loop().create_future()
+            self._pending[transaction_id] = future
+            try:
+                self._transport.sendto(build(transaction_id))
+                response = await asyncio.wait_for(future, self.timeout_seconds * 2 ** attempt)
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                self._pending.pop(transaction_id, None)
+
+            action, _ = _RESPONSE_HEADER.unpack_from(response)
+            if action == _ACTION_ERROR:
+                raise RuntimeError(response[_RESPONSE_HEADER.size:].decode(errors='replace'))
+            return response
+        raise asyncio.TimeoutError("The tracker does not answer")
+
+    def _on_response(self, data: bytes):
+        if len(data) < _RESPONSE_HEADER.size:
+            return
+        _, transaction_id = _RESPONSE_HEADER.unpack_from(data)
+        future = self._pending.get(transaction_id)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def _on_error(self, exc: Exception):
+        # For example, the port is unreachable: fail the pending requests at once instead of waiting for timeouts
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(exc)
+        if isinstance(exc, ConnectionResetError):
+            self._transport = None
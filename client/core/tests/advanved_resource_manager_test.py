@@ -7,6 +7,7 @@ import json
 import shutil
 import logging
 
+from core.common.bitset import Bitset
 from core.common.peer_info import PeerInfo
 from core.common.resource import Resource
 from core.p2p.resource_file import ResourceFile
@@ -27,7 +28,7 @@ def random_peer_id() -> str:
 async def simulate_ownership(bitfield: list[bool], data: list[bytes], destination: Path, resource: Resource):
     resource_file = ResourceFile(destination, resource)
     resource_save = ResourceSave(destination, resource)
-    await resource_save.write_bitfield(bitfield)
+    await resource_save.write_bitfield(Bitset.from_bools(bitfield))
     for i, piece_status in enumerate(bitfield):
         if piece_status:
             await resource_file.save_validated_piece(i, data[i])
@@ -0,0 +1,400 @@
+import asyncio
+import base64
+import ipaddress
+import json
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.p2p.resource_manager import ResourceManager
+from core.s2p import announcer as announcer_module
+from core.s2p.announcer import Announcer, TrackerHealth, parse_peer_list
+from core.s2p.tracker_client import TrackerClient
+from core.s2p.tracker_server import TrackerServer
+from core.s2p.udp_tracker import UdpTrackerClient
+
+HOST_PEER_ID = '00' * 32
+
+
+def sse_chunk(event_type: str, peer: dict) -> bytes:
+    event = f'event: {event_type}\ndata: {json.dumps(peer)}\n\n'.encode()
+    return f'{len(event):x}\r\n'.encode() + event + b'\r\n'
+
+
+async def start_tracker(
+        batch_supported: bool = True,
+        pushed_peers: list[dict] | None = None,
+        malformed: tuple[str, ...] = ()
+):
+    requests = []
+
+    async def handle_client(reader, writer):
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while (line := await reader.readline()) != b'\r\n':
+                name, _, value = line.decode().partition(':')
+                headers[name.strip().lower()] = value.strip()
+            path = request_line.split()[1].decode()
+            if path.startswith('/peers/events'):
+                if pushed_peers is None:
+                    writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                    continue
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n')
+                writer.write(b'e\r\n: keep-alive\n\n\r\n')
+                for peer in pushed_peers:
+                    if f'infoHash={peer["infoHash"]}' in path:
+                        writer.write(sse_chunk('join', peer))
+                await writer.drain()
+                await reader.read()
+                break
+
+            announce = json.loads(await reader.readexactly(int(headers.get('content-length', 0))))
+            requests.append((path, announce))
+
+            status, response = 200, b''
+            if path == '/peers/batch' and batch_supported:
+                # Every resource has one other peer, whose id is the info hash, and the host peer itself
+                response = json.dumps({'peers': {
+                    resource['infoHash']: [
+                        {'peerId': resource['infoHash'], 'publicIp': '127.0.0.1', 'publicPort': '7000'},
+                        {'peerId': HOST_PEER_ID, 'publicIp': '127.0.0.1', 'publicPort': '6000'}
+                    ] for resource in announce['resources']
+                }}).encode()
+            elif path == '/peers' and announce['infoHash'] in malformed:
+                response = b'{"peers": ['
+            elif path == '/peers':
+                response = json.dumps({'peers': [
+                    {'peerId': announce['infoHash'], 'publicIp': '127.0.0.1', 'publicPort': '7000'}
+                ]}).encode()
+            else:
+                status = 404
+            writer.write(
+                f'HTTP/1.1 {status} OK\r\nContent-Length: {len(response)}\r\n\r\n'.encode() + response
+            )
+            await writer.drain()
+
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    return server, requests
+
+
+async def announce_resources(
+        batch_supported: bool,
+        malformed: tuple[str, ...] = ()
+) -> tuple[list, dict[str, list[PeerInfo]]]:
+    server, requests = await start_tracker(batch_supported, malformed=malformed)
+    client = TrackerClient('127.0.0.1', server.sockets[0].getsockname()[1])
+    announcer = Announcer(client, HOST_PEER_ID, '127.0.0.1', 6000)
+
+    received = {}
+    info_hashes = [f'{i:02x}' * 32 for i in range(1, 4)]
+    for info_hash in info_hashes:
+        async def on_peers(peers, info_hash=info_hash):
+            received[info_hash] = peers
+        announcer.register(info_hash, on_peers)
+    announcer.start()
+
+    for _ in range(50):
+        if len(received) == len(info_hashes):
+            break
+        await asyncio.sleep(0.02)
+
+    await announcer.close()
+    await client.close()
+    server.close()
+    await server.wait_closed()
+    return requests, received
+
+
+@pytest.mark.asyncio
+async def test_resources_are_announced_in_one_request():
+    requests, received = await announce_resources(batch_supported=True)
+
+    assert len(requests) == 1
+    path, announce = requests[0]
+    assert path == '/peers/batch'
+    assert announce['publicPort'] == '6000'
+    assert sorted(resource['infoHash'] for resource in announce['resources']) == sorted(received)
+    assert all(resource['event'] == 'started' for resource in announce['resources'])
+    for info_hash, peers in received.items():
+        assert peers == [PeerInfo('127.0.0.1', 7000, info_hash)]
+
+
+@pytest.mark.asyncio
+async def test_announce_falls_back_to_single_requests():
+    requests, received = await announce_resources(batch_supported=False)
+
+    assert [path for path, _ in requests] == ['/peers/batch'] + ['/peers'] * 3
+    assert len(received) == 3
+    for info_hash, peers in received.items():
+        assert peers == [PeerInfo('127.0.0.1', 7000, info_hash)]
+
+
+@pytest.mark.asyncio
+async def test_malformed_single_response_fails_only_its_resource():
+    malformed = '02' * 32
+    requests, received = await announce_resources(batch_supported=False, malformed=(malformed,))
+
+    assert {announce['infoHash'] for path, announce in requests if path == '/peers'} == \
+        {f'{i:02x}' * 32 for i in range(1, 4)}
+    assert sorted(received) == ['01' * 32, '03' * 32]
+
+
+def test_compact_peer_list_is_parsed():
+    peers = [PeerInfo('10.0.0.1', 6881, '11' * 32), PeerInfo('192.168.1.20', 65535, HOST_PEER_ID)]
+    compact = b''.join(
+        bytes.fromhex(peer.peer_id) + ipaddress.IPv4Address(peer.public_ip).packed + peer.public_port.to_bytes(2, 'big')
+        for peer in peers
+    )
+
+    assert parse_peer_list(base64.b64encode(compact).decode(), HOST_PEER_ID) == peers[:1]
+    # A truncated list is dropped as a whole
+    assert parse_peer_list(base64.b64encode(compact[:-1]).decode(), HOST_PEER_ID) == []
+
+
+@pytest.mark.asyncio
+async def test_transfer_stats_and_events_are_announced(monkeypatch):
+    monkeypatch.setattr(announcer_module, 'ANNOUNCE_INTERVAL_SECONDS', 0.3)
+    monkeypatch.setattr(announcer_module, 'ANNOUNCE_JITTER', 0)
+    monkeypatch.setattr(announcer_module, 'BATCH_WINDOW_SECONDS', 0)
+
+    server, requests = await start_tracker()
+    client = TrackerClient('127.0.0.1', server.sockets[0].getsockname()[1])
+    announcer = Announcer(client, HOST_PEER_ID, '127.0.0.1', 6000)
+    info_hash = '11' * 32
+
+    stats = ResourceManager.TransferStats(uploaded=0, downloaded=0, left=100)
+
+    async def get_stats():
+        return stats
+
+    async def on_peers(peers):
+        pass
+
+    announcer.register(info_hash, on_peers, get_stats)
+    announcer.start()
+    await asyncio.sleep(0.15)
+
+    # The download completes, the next announce reports it once
+    stats = ResourceManager.TransferStats(uploaded=10, downloaded=100, left=0)
+    await asyncio.sleep(0.6)
+
+    announcer.unregister(info_hash)
+    await asyncio.sleep(0.1)
+
+    announces = [announce['resources'][0] if path == '/peers/batch' else announce for path, announce in requests]
+    assert [(announce.get('event'), announce['left']) for announce in announces] == [
+        ('started', 100), ('completed', 0), (None, 0), ('stopped', 0)
+    ]
+    assert announces[1]['uploaded'] == 10 and announces[1]['downloaded'] == 100
+
+    await announcer.close()
+    await client.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_pushed_peers_are_submitted(monkeypatch):
+    monkeypatch.setattr(announcer_module, 'PUSH_RESUBSCRIBE_DELAY_SECONDS', 0)
+    info_hash = '11' * 32
+    pushed = [
+        {'infoHash': info_hash, 'peerId': '22' * 32, 'publicIp': '127.0.0.1', 'publicPort': '7001', 'seed': True},
+        {'infoHash': '33' * 32, 'peerId': '44' * 32, 'publicIp': '127.0.0.1', 'publicPort': '7002', 'seed': False},
+    ]
+    server, _ = await start_tracker(pushed_peers=pushed)
+    client = TrackerClient('127.0.0.1', server.sockets[0].getsockname()[1])
+    announcer = Announcer(client, HOST_PEER_ID, '127.0.0.1', 6000)
+
+    received = []
+
+    async def on_peers(peers):
+        received.extend(peers)
+
+    announcer.register(info_hash, on_peers)
+    announcer.start()
+    for _ in range(50):
+        if PeerInfo('127.0.0.1', 7001, '22' * 32) in received:
+            break
+        await asyncio.sleep(0.02)
+
+    # The announce gives its own peer, the push gives the peer of the subscribed resource only
+    assert PeerInfo('127.0.0.1', 7001, '22' * 32) in received
+    assert all(peer.peer_id != '44' * 32 for peer in received)
+
+    await announcer.close()
+    await asyncio.sleep(0.05)  # The tracker sees the closed subscription
+    await client.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_announce_falls_back_to_http_if_udp_fails():
+    server, requests = await start_tracker()
+    client = TrackerClient('127.0.0.1', server.sockets[0].getsockname()[1])
+    udp_client = UdpTrackerClient('127.0.0.1', 9, timeout_seconds=0.05, max_retries=0)
+    announcer = Announcer(client, HOST_PEER_ID, '127.0.0.1', 6000, push=False, udp_client=udp_client)
+
+    received = {}
+    info_hash = '11' * 32
+
+    async def on_peers(peers):
+        received[info_hash] = peers
+
+    announcer.register(info_hash, on_peers)
+    announcer.start()
+    for _ in range(50):
+        if received:
+            break
+        await asyncio.sleep(0.02)
+
+    assert [path for path, _ in requests] == ['/peers/batch']
+    assert received[info_hash] == [PeerInfo('127.0.0.1', 7000, info_hash)]
+    assert not announcer._udp_usable(announcer._trackers[('127.0.0.1', client.port)])
+
+    await announcer.close()
+    udp_client.close()
+    await client.close()
+    server.close()
+    await server.wait_closed()
+
+
+async def start_silent_tracker():
+    async def handle_client(reader, writer):
+        await reader.read()  # Never answers
+
+    return await asyncio.start_server(handle_client, '127.0.0.1', 0)
+
+
+def address(server) -> tuple[str, int]:
+    return '127.0.0.1', server.sockets[0].getsockname()[1]
+
+
+@pytest.mark.asyncio
+async def test_tiers_fail_over_and_peers_are_merged():
+    first, first_requests = await start_tracker()
+    second, second_requests = await start_tracker()
+    backup, backup_requests = await start_tracker()
+    silent = await start_silent_tracker()
+    dead = await asyncio.start_server(lambda reader, writer: None, '127.0.0.1', 0)
+    dead_address = address(dead)
+    dead.close()
+    await dead.wait_closed()
+
+    client = TrackerClient(*address(first))
+    announcer = Announcer(client, HOST_PEER_ID, '127.0.0.1', 6000, push=False)
+    merged, failed_over = '11' * 32, '22' * 32
+    received = {merged: [], failed_over: []}
+
+    async def on_peers(peers, info_hash):
+        received[info_hash].extend(peers)
+
+    announcer.register(
+        merged,
+        lambda peers: on_peers(peers, merged),
+        trackers=[[address(silent), address(first), address(second)], [address(backup)]]
+    )
+    announcer.register(
+        failed_over,
+        lambda peers: on_peers(peers, failed_over),
+        trackers=[[dead_address], [address(backup)]]
+    )
+    announcer.start()
+    for _ in range(50):
+        if all(received.values()):
+            break
+        await asyncio.sleep(0.02)
+
+    # Both working trackers of the first tier are announced to, the silent one delays nobody, and the peer
+    # returned by both of them is passed once
+    assert received[merged] == [PeerInfo('127.0.0.1', 7000, merged)]
+    assert [[resource['infoHash'] for resource in announce['resources']] for _, announce in first_requests] == [[merged]]
+    assert len(second_requests) == 1
+    # The backup tier is used only for the resource whose first tier has failed
+    assert received[failed_over] == [PeerInfo('127.0.0.1', 7000, failed_over)]
+    assert [[resource['infoHash'] for resource in announce['resources']] for _, announce in backup_requests] == [
+        [failed_over]
+    ]
+
+    health = announcer.health()
+    assert health[dead_address].consecutive_failures == 1
+    assert health[address(first)].successes == 1
+    assert health[address(silent)].successes == 0
+
+    await announcer.close()
+    await client.close()
+    for server in [first, second, backup, silent]:
+        server.close()
+        await server.wait_closed()
+
+
+def test_failed_trackers_are_skipped_while_others_remain(monkeypatch):
+    monkeypatch.setattr(announcer_module, 'TRACKER_RETRY_MIN_SECONDS', 10)
+    healthy = TrackerHealth()
+    healthy.on_success(0.2)
+    failed = TrackerHealth()
+    failed.on_failure(now=100)
+    failed.on_failure(now=100)
+
+    assert not failed.available(now=119)
+    assert failed.available(now=120)  # The delay doubles with each consecutive failure
+    assert sorted([failed, healthy, TrackerHealth()], key=TrackerHealth.rank)[-1] is failed
+
+    failed.on_success(0.1)
+    assert failed.available(now=100) and failed.consecutive_failures == 0
+
+
+@pytest.mark.asyncio
+async def test_tracker_intervals_are_honored(monkeypatch):
+    monkeypatch.setattr(announcer_module, 'ANNOUNCE_JITTER', 0)
+    monkeypatch.setattr(announcer_module, 'BATCH_WINDOW_SECONDS', 0)
+    tracker = TrackerServer(announce_interval_seconds=0.8, min_announce_interval_seconds=0.3)
+    port = await tracker.start()
+    announced = []
+    announce = tracker.announce
+    monkeypatch.setattr(tracker, 'announce', lambda body, now=None: announced.append(body['infoHash']) or announce(body))
+
+    client = TrackerClient('127.0.0.1', port)
+    announcer = Announcer(client, HOST_PEER_ID, '127.0.0.1', 6000, push=False)
+    starving, seeding = '11' * 32, '22' * 32
+    stats = {
+        starving: ResourceManager.TransferStats(uploaded=0, downloaded=0, left=100, peers=1),
+        seeding: ResourceManager.TransferStats(uploaded=0, downloaded=0, left=0, peers=1)
+    }
+
+    async def on_peers(peers):
+        pass
+
+    for info_hash in stats:
+        async def get_stats(info_hash=info_hash):
+            return stats[info_hash]
+        announcer.register(info_hash, on_peers, get_stats)
+    announcer.start()
+    await asyncio.sleep(1.3)
+
+    # The download short of peers is announced at the minimum interval, the seed at the recommended one
+    assert announced.count(starving) == 5
+    assert announced.count(seeding) == 2
+    assert announcer._trackers[('127.0.0.1', port)].interval_seconds == 0.8
+
+    await announcer.close()
+    await client.close()
+    await tracker.close()
+
+
+def test_announce_delays(monkeypatch):
+    monkeypatch.setattr(announcer_module.random, 'uniform', lambda low, high: high)
+
+    assert announcer_module.announce_delay(None, None) == announcer_module.ANNOUNCE_INTERVAL_SECONDS * 0.8
+    assert announcer_module.announce_delay(60, 20, short_of_peers=True) == 24
+    # The minimum interval never exceeds the interval
+    assert announcer_module.announce_delay(5, None, short_of_peers=True) == 5
+
+    monkeypatch.setattr(announcer_module, 'ANNOUNCE_RETRY_MIN_SECONDS', 1)
+    monkeypatch.setattr(announcer_module, 'ANNOUNCE_RETRY_MAX_SECONDS', 10)
+    assert [announcer_module.retry_delay(failures) for failures in range(1, 6)] == [1, 2, 4, 8, 10]
+    monkeypatch.setattr(announcer_module.random, 'uniform', lambda low, high: low)
+    assert announcer_module.retry_delay(3) == 2
@@ -0,0 +1,40 @@
+import pytest
+
+from core.common.bitset import Bitset
+
+
+def test_bitset_get_set():
+    bitset = Bitset(10)
+    bitset.set(0)
+    bitset.set(9)
+    bitset[4] = True
+    bitset.clear(0)
+    assert list(bitset) == [False, False, False, False, True, False, False, False, False, True]
+    assert bitset.count() == 2
+    assert list(bitset.indices()) == [4, 9]
+
+    with pytest.raises(IndexError):
+        bitset.set(10)
+
+
+def test_bitset_wire_format():
+    bitset = Bitset.from_bools([True, True, False, False, True, True, True, False, True, False])
+    assert bitset.to_bytes() == bytes([206, 128])
+    assert bytes(bitset.view()) == bytes([206, 128])
+
+    # Spare bits at the end are dropped
+    assert Bitset(10, bytes([206, 191])) == bitset
+    assert Bitset.full(10).to_bytes() == bytes([255, 192])
+
+
+def test_bitset_operations():
+    a = Bitset.from_bools([True, True, False, False, True])
+    b = Bitset.from_bools([True, False, True, False, True])
+    assert list(a & b) == [True, False, False, False, True]
+    assert list(a | b) == [True, True, True, False, True]
+    assert list(a.and_not(b)) == [False, True, False, False, False]
+    assert not Bitset(5).any()
+    assert Bitset.full(5).all()
+
+    with pytest.raises(ValueError):
+        a & Bitset(6)
@@ -1,10 +1,13 @@
 import asyncio
+import random
 
 import pytest
 
-from core.p2p.connection import Connection
+from core.p2p.connection import Connection, MAX_UNKNOWN_MESSAGE_LENGTH
+from core.p2p.protocol_connection import ProtocolConnection
 from core.p2p.connection_listener import ConnectionListener
-from core.p2p.message import Piece, Request, Bitfield
+from core.p2p.message import Piece, Request, Bitfield, Have, HaveAll
+from core.p2p.rate_limiter import RateLimiter
 from core.tests.mocks import mock_resource, mock_request, mock_piece, mock_bitfield
 from core.common.resource import Resource
 
@@ -69,3 +72,118 @@ async def test_connection():
     await sender.close()
     await receiver.close()
 
+
+@pytest.mark.asyncio
+async def test_protocol_connection():
+    client_connection, server_connection = await get_connections(mock_resource)
+    # Some bytes may arrive before the receiving side switches to the protocol
+    await client_connection.send_message(mock_bitfield)
+    await asyncio.sleep(0.1)
+
+    sender = client_connection
+    receiver = ProtocolConnection(server_connection.reader, server_connection.writer, mock_resource, buffer_size=16)
+
+    big_piece = Piece(2, 0, 700_000, bytes(random.randint(0, 255) for _ in range(256)) * 2734 + b'\0' * 96)
+    # Requests are served by their own worker and Pieces are sent after the control messages,
+    # so only the order within each group is preserved
+    received: asyncio.Queue = asyncio.Queue()
+    received_requests: asyncio.Queue = asyncio.Queue()
+    received_pieces: asyncio.Queue = asyncio.Queue()
+    closed = asyncio.Event()
+
+    class ReceiverListener(ConnectionListener):
+        async def on_request(self, request: Request):
+            await received_requests.put(request)
+
+        async def on_piece(self, piece: Piece):
+            await received_pieces.put(piece)
+
+        async def on_bitfield(self, bitfield: Bitfield):
+            await received.put(bitfield)
+
+        async def on_have(self, have: Have):
+            await received.put(have)
+
+        async def on_have_all(self, have_all: HaveAll):
+            await received.put(have_all)
+
+        async def on_close(self, cause):
+            closed.set()
+
+    receiver.add_listener(ReceiverListener())
+    await receiver.listen()
+
+    await sender.send_message(mock_request)
+    await sender.send_message(mock_piece)
+    await sender.send_message(big_piece)
+    await sender.send_message(Have(1))
+    await sender.send_message(HaveAll())
+    await sender.send_message(mock_request)
+
+    for message in [Bitfield(bitfield=[False, True, False]), Have(1), HaveAll()]:
+        assert await asyncio.wait_for(received.get(), timeout=5) == message
+    for piece in [mock_piece, big_piece]:
+        assert await asyncio.wait_for(received_pieces.get(), timeout=5) == piece
+    for _ in range(2):
+        assert await asyncio.wait_for(received_requests.get(), timeout=5) == mock_request
+
+    # Messages can be sent back through the taken over transport
+    await receiver.send_message(mock_piece)
+
+    sender.writer.close()
+    await asyncio.wait_for(closed.wait(), timeout=5)
+    await sender.close()
+    await receiver.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('protocol', [False, True])
+@pytest.mark.parametrize('frame', [
+    (0).to_bytes(4) + (9).to_bytes(1),  # No message type
+    (MAX_UNKNOWN_MESSAGE_LENGTH + 2).to_bytes(4) + (100).to_bytes(1)  # Unknown message over the limit
+])
+async def test_malformed_frames_close_the_connection(protocol, frame):
+    client_connection, server_connection = await get_connections(mock_resource)
+    receiver = server_connection
+    if protocol:
+        receiver = ProtocolConnection(server_connection.reader, server_connection.writer, mock_resource)
+    causes: asyncio.Queue = asyncio.Queue()
+
+    class ReceiverListener(ConnectionListener):
+        async def on_close(self, cause):
+            await causes.put(cause)
+
+    receiver.add_listener(ReceiverListener())
+    await receiver.listen()
+
+    # An unknown message within the limit is skipped
+    client_connection.writer.write((3).to_bytes(4) + (100).to_bytes(1) + b'\0\0')
+    client_connection.writer.write(frame + b'\0' * 16)
+    assert isinstance(await asyncio.wait_for(causes.get(), timeout=5), RuntimeError)
+
+    await client_connection.close()
+    await receiver.close()
+
+
+@pytest.mark.asyncio
+async def test_bogus_length_does_not_stall_the_download_limit():
+    client_connection, server_connection = await get_connections(mock_resource)
+    session_limiter = RateLimiter(download_bytes_per_sec=100_000)
+    server_connection.rate_limiter = session_limiter.child()
+    closed = asyncio.Event()
+
+    class ReceiverListener(ConnectionListener):
+        async def on_close(self, cause):
+            closed.set()
+
+    server_connection.add_listener(ReceiverListener())
+    await server_connection.listen()
+
+    # The Piece message of 4 GB is refused before it is charged to the limit
+    client_connection.writer.write((0xFFFFFFFF).to_bytes(4) + (2).to_bytes(1) + b'\0' * 12)
+    await asyncio.wait_for(closed.wait(), timeout=5)
+    # The other connections sharing the limit are not held up
+    await asyncio.wait_for(session_limiter.child().download.consume(10), timeout=1)
+
+    await client_connection.close()
+    await server_connection.close()
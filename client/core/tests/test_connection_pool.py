@@ -0,0 +1,107 @@
+import asyncio
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.p2p import resource_manager as resource_manager_module
+from core.p2p.connection import Connection
+from core.p2p.connection_listener import ConnectionListener
+from core.p2p.connection_pool import ConnectionPool
+from core.p2p.protocol_connection import ProtocolConnection
+from core.p2p.resource_manager import ResourceManager
+from core.tests.mocks import mock_resource
+
+
+def test_slots_are_counted_in_ancestors():
+    session = ConnectionPool(max_inbound=2, max_outbound=None)
+    first = session.child(max_inbound=None, max_outbound=1)
+    second = session.child()
+
+    assert first.try_acquire(inbound=True)
+    assert second.try_acquire(inbound=True)
+    # The session cap is reached
+    assert not first.try_acquire(inbound=True)
+    assert session.inbound == 2
+
+    # The outbound quota is separate
+    assert first.try_acquire(inbound=False)
+    assert not first.try_acquire(inbound=False)
+    assert second.try_acquire(inbound=False)
+
+    second.release(inbound=True)
+    assert first.try_acquire(inbound=True)
+    assert (first.inbound, first.outbound, session.inbound, session.outbound) == (2, 1, 2, 2)
+
+
+@pytest.mark.asyncio
+async def test_idle_seed_is_evicted_for_new_peer(tmp_path, monkeypatch):
+    monkeypatch.setattr(resource_manager_module, 'EVICTION_GRACE_SECONDS', 0)
+
+    source = tmp_path / 'file'
+    source.write_bytes(b'0' * sum(piece.size_bytes for piece in mock_resource.pieces))
+
+    # All three peers are seeds, the host peer (with the smallest id) may keep one outbound connection
+    host = ResourceManager('00' * 32, source, mock_resource)
+    await host.full_start(open_public_port=False, start_download=False)
+    await host.set_connection_limits(max_inbound=None, max_outbound=1)
+
+    seeds = []
+    for peer_id in ['11' * 32, '22' * 32]:
+        seed = ResourceManager(peer_id, source, mock_resource)
+        port = await seed.full_start(start_download=False)
+        seeds.append((seed, PeerInfo('127.0.0.1', port, peer_id)))
+
+    await host.submit_peers([seeds[0][1]])
+    await asyncio.sleep(0.2)  # Receive the Have-All message
+    assert set(host._connections) == {seeds[0][1].peer_id}
+
+    await host.submit_peers([seeds[1][1]])
+    assert set(host._connections) == {seeds[1][1].peer_id}
+    assert host.connection_pool.outbound == 1
+
+    for resource_manager in [host] + [seed for seed, _ in seeds]:
+        await resource_manager.shutdown()
+    assert host.connection_pool.outbound == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('connection_class', [Connection, ProtocolConnection])
+async def test_remotely_closed_peer_frees_its_slot(tmp_path, connection_class):
+    source = tmp_path / 'file'
+    source.write_bytes(b'0' * sum(piece.size_bytes for piece in mock_resource.pieces))
+    session = ConnectionPool(max_inbound=None, max_outbound=None)
+    seed = ResourceManager('ff' * 32, source, mock_resource, connection_pool=session, connection_class=connection_class)
+    seed_port = await seed.full_start()
+    downloader = ResourceManager('00' * 32, tmp_path / 'download', mock_resource, connection_class=connection_class)
+    await downloader.full_start(start_download=False, open_public_port=False)
+
+    await downloader.submit_peers([PeerInfo('127.0.0.1', seed_port, seed.host_peer_id)])
+    for _ in range(50):
+        if session.inbound == 1:
+            break
+        await asyncio.sleep(0.02)
+    assert (seed.connection_pool.inbound, session.inbound) == (1, 1)
+
+    # The other listeners of the connection are notified to the end, while the seed closes the connection
+    connection = seed._connections[downloader.host_peer_id]
+    assert type(connection) is connection_class
+    notified = asyncio.Event()
+
+    class CloseListener(ConnectionListener):
+        async def on_close(self, cause):
+            await asyncio.sleep(0.05)
+            notified.set()
+
+    connection.add_listener(CloseListener())
+
+    # The downloader goes away, the seed learns it from the closed connection
+    await downloader.shutdown()
+    await asyncio.wait_for(notified.wait(), timeout=5)
+    for _ in range(50):
+        if downloader.host_peer_id not in seed._connections:
+            break
+        await asyncio.sleep(0.02)
+    assert downloader.host_peer_id not in seed._connections
+    assert (seed.connection_pool.inbound, session.inbound) == (0, 0)
+
+    await seed.shutdown()
@@ -0,0 +1,150 @@
+import asyncio
+import json
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.p2p import dht as dht_module
+from core.p2p.dht import DhtNode, NodeContact, RoutingTable, distance
+from core.p2p.resource_manager import ResourceManager
+from core.tests.mocks import mock_resource
+
+INFO_HASH = 'ab' * 32
+
+
+async def start_network(size: int) -> list[DhtNode]:
+    nodes = []
+    for i in range(size):
+        node = DhtNode(f'{i:064x}')
+        await node.start(listen_port=7000 + i, host='127.0.0.1')
+        nodes.append(node)
+    for node in nodes[1:]:
+        await node.bootstrap([('127.0.0.1', nodes[0].port)])
+    return nodes
+
+
+def test_full_bucket_prefers_old_contacts():
+    table = RoutingTable('00' * 32, bucket_size=2)
+    # The distances of these contacts are in [2^255, 2^256), so they share the last bucket
+    contacts = [NodeContact(f'{0x80 + i:02x}' + '00' * 31, '127.0.0.1', 7000 + i) for i in range(3)]
+
+    assert table.add(contacts[0]) is None
+    assert table.add(contacts[1]) is None
+    assert table.add(contacts[2]) == contacts[0]  # The least recently seen one must be pinged first
+    assert contacts[2].node_id not in table
+
+    table.add(contacts[0])  # Seen again, now the other one is the least recently seen
+    assert table.add(contacts[2]) == contacts[1]
+
+    target = '81' + '00' * 31
+    assert table.closest(target) == sorted([contacts[0], contacts[1]], key=lambda c: distance(c.node_id, target))
+
+
+@pytest.mark.asyncio
+async def test_many_nodes_find_announced_peer(monkeypatch):
+    monkeypatch.setattr(dht_module, 'RPC_TIMEOUT_SECONDS', 0.5)
+    nodes = await start_network(30)
+
+    assert await nodes[20].get_peers(INFO_HASH) == []
+    await nodes[5].announce(INFO_HASH)
+
+    # The record is stored on the nodes closest to the info hash, not on all of them
+    storing = [node for node in nodes if INFO_HASH in node._peers]
+    assert 0 < len(storing) <= dht_module.BUCKET_SIZE
+    others = nodes[:5] + nodes[6:]
+    closest = sorted(others, key=lambda node: distance(node.node_id, INFO_HASH))[:dht_module.BUCKET_SIZE]
+    assert set(storing) <= set(closest)
+
+    for node in nodes[10:15]:
+        assert await node.get_peers(INFO_HASH) == [PeerInfo('127.0.0.1', 7005, nodes[5].host_peer_id)]
+
+    for node in nodes:
+        await node.close()
+
+
+@pytest.mark.asyncio
+async def test_announce_requires_token(monkeypatch):
+    monkeypatch.setattr(dht_module, 'RPC_TIMEOUT_SECONDS', 0.5)
+    nodes = await start_network(2)
+    address = ('127.0.0.1', nodes[0].port)
+
+    with pytest.raises(RuntimeError):
+        await nodes[1]._query(address, 'announce_peer', {
+            'info_hash': INFO_HASH, 'port': 7001, 'peer_id': nodes[1].host_peer_id, 'token': '0' * 16
+        })
+    assert INFO_HASH not in nodes[0]._peers
+
+    token = (await nodes[1]._query(address, 'get_peers', {'info_hash': INFO_HASH}))['token']
+    await nodes[1]._query(address, 'announce_peer', {
+        'info_hash': INFO_HASH, 'port': 7001, 'peer_id': nodes[1].host_peer_id, 'token': token
+    })
+    assert nodes[0]._answer('get_peers', {'info_hash': INFO_HASH}, ('127.0.0.2', 1))['peers'] == [
+        ['127.0.0.1', 7001, nodes[1].host_peer_id]
+    ]
+
+    for node in nodes:
+        await node.close()
+
+
+@pytest.mark.asyncio
+async def test_malformed_response_drops_only_its_node(monkeypatch):
+    monkeypatch.setattr(dht_module, 'RPC_TIMEOUT_SECONDS', 0.5)
+    nodes = await start_network(3)
+    bad_id = 'ee' * 32
+
+    class BadNode(asyncio.DatagramProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+
+        def datagram_received(self, data, addr):
+            query = json.loads(data)
+            response = {'t': query['t'], 'y': 'r', 'id': bad_id, 'r': {'nodes': [[1]]}}
+            self.transport.sendto(json.dumps(response).encode(), addr)
+
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(BadNode, local_addr=('127.0.0.1', 0))
+    nodes[2].table.add(NodeContact(bad_id, '127.0.0.1', transport.get_extra_info('sockname')[1]))
+
+    await nodes[1].announce(INFO_HASH)
+    assert await nodes[2].get_peers(INFO_HASH) == [PeerInfo('127.0.0.1', 7001, nodes[1].host_peer_id)]
+    assert bad_id not in nodes[2].table
+
+    transport.close()
+    for node in nodes:
+        await node.close()
+
+
+@pytest.mark.asyncio
+async def test_peers_of_same_resource_find_each_other(tmp_path, monkeypatch):
+    monkeypatch.setattr(dht_module, 'RPC_TIMEOUT_SECONDS', 0.5)
+    source = tmp_path / 'file'
+    source.write_bytes(b'0' * sum(piece.size_bytes for piece in mock_resource.pieces))
+
+    seed = ResourceManager('ff' * 32, source, mock_resource)
+    seed_port = await seed.full_start()
+    downloader = ResourceManager('00' * 32, tmp_path / 'download', mock_resource)
+    await downloader.full_start(open_public_port=False)
+
+    network = await start_network(10)
+    bootstrap_nodes = [('127.0.0.1', network[0].port)]
+    seed_dht = DhtNode(seed.host_peer_id, bootstrap_nodes=bootstrap_nodes)
+    downloader_dht = DhtNode(downloader.host_peer_id, bootstrap_nodes=bootstrap_nodes)
+    seed_dht.register(seed)
+    await seed_dht.start(listen_port=seed_port, host='127.0.0.1')
+    for _ in range(50):
+        if any(node._peers for node in network):
+            break
+        await asyncio.sleep(0.1)
+
+    # The downloader knows neither the tracker nor the seed, only a node of the network
+    downloader_dht.register(downloader)
+    await downloader_dht.start(listen_port=1, host='127.0.0.1')
+    for _ in range(50):
+        if seed.host_peer_id in downloader._connections:
+            break
+        await asyncio.sleep(0.1)
+    assert seed.host_peer_id in downloader._connections
+
+    for node in network + [seed_dht, downloader_dht]:
+        await node.close()
+    await seed.shutdown()
+    await downloader.shutdown()
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.p2p import connection
+from core.p2p.dial_backoff import DialBackoff
+from core.p2p.resource_manager import ResourceManager
+from core.tests.mocks import mock_resource
+
+
+def test_backoff_doubles_until_success():
+    backoff = DialBackoff(initial_delay_seconds=1, max_delay_seconds=3)
+    address = ('127.0.0.1', 1000)
+    assert backoff.can_dial(address, now=0)
+
+    backoff.on_failure(address, now=0)
+    assert not backoff.can_dial(address, now=0.5)
+    assert backoff.can_dial(address, now=1)
+
+    backoff.on_failure(address, now=1)
+    assert not backoff.can_dial(address, now=2.5)
+    assert backoff.can_dial(address, now=3)
+
+    # The delay is capped
+    backoff.on_failure(address, now=3)
+    assert backoff.can_dial(address, now=6)
+
+    # Other addresses are not affected
+    assert backoff.can_dial(('127.0.0.1', 1001), now=3)
+
+    backoff.on_success(address)
+    assert backoff.can_dial(address, now=3)
+
+
+@pytest.mark.asyncio
+async def test_silent_peers_do_not_stall_dialing(tmp_path, monkeypatch):
+    monkeypatch.setattr(connection, 'HANDSHAKE_TIMEOUT_SECONDS', 0.5)
+
+    # The peers accept the TCP connection but never answer the handshake
+    accepted = []
+
+    async def handle_client(reader, writer):
+        accepted.append(writer)
+
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    peers = [PeerInfo('127.0.0.1', port, f'{i + 1:064x}') for i in range(20)]
+
+    resource_manager = ResourceManager('00' * 32, tmp_path / 'file', mock_resource, max_concurrent_dials=10)
+
+    start = time.monotonic()
+    await resource_manager.submit_peers(peers)
+    # Two rounds of concurrent attempts, each bounded by the handshake timeout
+    assert time.monotonic() - start < 2.5
+    assert len(accepted) == 20
+    assert not resource_manager._connections
+
+    # The failed addresses are not dialed again right away
+    await resource_manager.submit_peers(peers)
+    assert len(accepted) == 20
+
+    await resource_manager.shutdown()
+    for writer in accepted:
+        writer.close()
+    server.close()
+    await server.wait_closed()
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.p2p.resource_manager import ResourceManager
+from core.tests.mocks import mock_resource
+
+
+@pytest.mark.asyncio
+async def test_pending_requests_are_cancelled_on_shutdown(tmp_path):
+    source = tmp_path / 'file'
+    source.write_bytes(b'0' * sum(piece.size_bytes for piece in mock_resource.pieces))
+    seed = ResourceManager('ff' * 32, source, mock_resource)
+    seed_port = await seed.full_start()
+
+    # The requests reach the seed, but their blocks are never read
+    requested = []
+
+    async def get_block(piece_index: int, piece_inner_offset: int, block_length: int) -> bytes:
+        requested.append(piece_index)
+        await asyncio.Event().wait()
+    seed.resource_file.get_block = get_block
+
+    downloader = ResourceManager('00' * 32, tmp_path / 'download', mock_resource)
+    await downloader.full_start(open_public_port=False)
+    await downloader.submit_peers([PeerInfo('127.0.0.1', seed_port, seed.host_peer_id)])
+    for _ in range(100):
+        if downloader._download_works:
+            break
+        await asyncio.sleep(0.02)
+    works = set(downloader._download_works)
+    assert works
+    for _ in range(100):
+        if requested:
+            break
+        await asyncio.sleep(0.02)
+    assert requested
+
+    await downloader.shutdown()
+    assert all(work.cancelled() for work in works)
+    assert not downloader._download_works
+
+    await seed.shutdown()
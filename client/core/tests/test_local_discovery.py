@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+from core.p2p.local_discovery import LocalPeerDiscovery, encode_announcement, decode_announcement
+from core.p2p.resource_manager import ResourceManager
+from core.tests.mocks import mock_resource
+
+
+def test_announcement_round_trip():
+    peer_id = 'ab' * 32
+    info_hashes = ['01' * 32, '02' * 32]
+    assert decode_announcement(encode_announcement(peer_id, 6881, info_hashes)) == (peer_id, 6881, info_hashes)
+
+    with pytest.raises(ValueError):
+        decode_announcement(encode_announcement(peer_id, 6881, info_hashes)[:-1])
+
+
+@pytest.mark.asyncio
+async def test_peers_of_same_resource_find_each_other(tmp_path):
+    source = tmp_path / 'file'
+    source.write_bytes(b'0' * sum(piece.size_bytes for piece in mock_resource.pieces))
+
+    seed = ResourceManager('ff' * 32, source, mock_resource)
+    seed_port = await seed.full_start()
+    downloader = ResourceManager('00' * 32, tmp_path / 'download', mock_resource)
+    await downloader.full_start(open_public_port=False)
+
+    # A separate group and port, so that the test does not meet real peers
+    seed_discovery = LocalPeerDiscovery(seed.host_peer_id, group='239.192.152.144', port=16771)
+    downloader_discovery = LocalPeerDiscovery(downloader.host_peer_id, group='239.192.152.144', port=16771)
+    try:
+        await downloader_discovery.start(listen_port=1)
+        await seed_discovery.start(listen_port=seed_port)
+    except OSError as e:
+        pytest.skip(f"Multicast is not available: {e}")
+    downloader_discovery.register(downloader)
+    seed_discovery.register(seed)
+
+    for _ in range(50):
+        if seed.host_peer_id in downloader._connections:
+            break
+        await asyncio.sleep(0.1)
+    assert seed.host_peer_id in downloader._connections
+    assert downloader._peer_states[seed.host_peer_id].local
+
+    await seed_discovery.close()
+    await downloader_discovery.close()
+    await seed.shutdown()
+    await downloader.shutdown()
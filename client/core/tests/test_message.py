@@ -1,4 +1,5 @@
-from core.p2p.message import Handshake, Request, Piece, Bitfield
+from core.common.peer_info import PeerInfo
+from core.p2p.message import Handshake, Request, Piece, Bitfield, Have, HaveAll, HaveNone, Pex
 
 
 def test_handshake_to_bytes():
@@ -47,3 +48,34 @@ def test_bitfield_to_bytes():
     )
 
     assert bitfield.to_bytes() == expected
+
+
+def test_bitfield_from_bytes():
+    bitfield = Bitfield.from_bytes(bytes([206, 128]), 10)
+    assert bitfield == Bitfield([True, True, False, False, True, True, True, False, True, False])
+
+
+def test_have_to_bytes():
+    assert Have(19).to_bytes() == (5).to_bytes(4) + (4).to_bytes(1) + (19).to_bytes(4)
+    assert HaveAll().to_bytes() == (1).to_bytes(4) + (5).to_bytes(1)
+    assert HaveNone().to_bytes() == (1).to_bytes(4) + (6).to_bytes(1)
+
+
+def test_piece_to_buffers():
+    piece = Piece(10, 1024, 4, b'102b')
+    header, data = piece.to_buffers()
+    # The data is sent as is, without copying it into the header
+    assert data is piece.data
+    assert header + data == piece.to_bytes()
+
+
+def test_pex_round_trip():
+    added = [PeerInfo('10.0.0.1', 6881, 'aa' * 32), PeerInfo('192.168.1.20', 443, 'bb' * 32)]
+    dropped = [PeerInfo('10.0.0.2', 1, 'cc' * 32)]
+    pex = Pex(added, dropped + [PeerInfo('example.com', 80, 'dd' * 32)])
+
+    encoded = pex.to_bytes()
+    # Only IPv4 addresses are transferred
+    assert int.from_bytes(encoded[0:4]) == len(encoded) - 4 == 1 + 2 + 2 * 38 + 2 + 38
+    assert encoded[4] == 13
+    assert Pex.from_bytes(encoded[5:]) == Pex(added, dropped)
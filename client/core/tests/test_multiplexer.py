@@ -0,0 +1,280 @@
+import asyncio
+import dataclasses
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.p2p.connection import MAX_UNKNOWN_MESSAGE_LENGTH
+from core.p2p.connection_listener import ConnectionListener
+from core.p2p.message import Handshake, Have, Piece
+from core.p2p import multiplexer as multiplexer_module
+from core.p2p.multiplexer import Multiplexer, ChannelConnection, SESSION_INFO_HASH
+from core.p2p.rate_limiter import RateLimiter
+from core.tests.mocks import mock_resource, mock_piece
+
+other_resource = dataclasses.replace(mock_resource, name="other_file.txt")
+
+low_peer_id = '00' * 31 + '01'
+high_peer_id = 'ff' * 32
+
+
+class QueueListener(ConnectionListener):
+    def __init__(self):
+        self.messages = asyncio.Queue()
+
+    async def on_have(self, have: Have):
+        await self.messages.put(have)
+
+    async def on_piece(self, piece: Piece):
+        await self.messages.put(piece)
+
+    async def on_close(self, cause: BaseException):
+        self.messages.put_nowait(cause)
+
+
+# Establish the multiplexed connection to the acceptor by hand, so that any frames can be sent over it
+async def open_raw_session(acceptor: Multiplexer):
+    async def handle_client(reader, writer):
+        handshake = Handshake.from_bytes(await reader.readexactly(75))
+        await acceptor.accept_session(handshake.peer_id, reader, writer)
+
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname())
+    writer.write(Handshake(low_peer_id, SESSION_INFO_HASH).to_bytes())
+    await reader.readexactly(75)
+    return server, reader, writer
+
+
+# [body-length][channel-id][message-type][message-data]
+def raw_frame(channel_id: int, message_type: int, data: bytes = b'') -> bytes:
+    return (5 + len(data)).to_bytes(4) + channel_id.to_bytes(4) + message_type.to_bytes(1) + data
+
+
+def raw_attach(channel_id: int, info_hash: str) -> bytes:
+    return raw_frame(0, 11, channel_id.to_bytes(4) + bytes.fromhex(info_hash))
+
+
+@pytest.mark.asyncio
+async def test_channels_share_one_connection():
+    # The peer with the smaller id dials, the other one accepts
+    dialer = Multiplexer(low_peer_id)
+    acceptor = Multiplexer(high_peer_id)
+
+    accepted: asyncio.Queue[ChannelConnection] = asyncio.Queue()
+
+    async def on_channel(peer_id: str, channel: ChannelConnection) -> bool:
+        assert peer_id == low_peer_id
+        await channel.accept()
+        await accepted.put(channel)
+        return True
+
+    acceptor.register(mock_resource, on_channel)
+    acceptor.register(other_resource, on_channel)
+
+    async def handle_client(reader, writer):
+        handshake = Handshake.from_bytes(await reader.readexactly(75))
+        assert handshake.info_hash == SESSION_INFO_HASH
+        await acceptor.accept_session(handshake.peer_id, reader, writer)
+
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    host, port = server.sockets[0].getsockname()
+    peer = PeerInfo(peer_id=high_peer_id, public_ip=host, public_port=port)
+
+    first, second = await asyncio.gather(
+        dialer.open_channel(peer, mock_resource),
+        dialer.open_channel(peer, other_resource)
+    )
+    remote_channels = {}
+    for _ in range(2):
+        channel = await accepted.get()
+        remote_channels[channel.resource.get_info_hash()] = channel
+
+    assert len(dialer.sessions) == 1 and len(acceptor.sessions) == 1
+    assert first.session is second.session
+    assert first.channel_id != second.channel_id
+
+    listeners = {}
+    for channel in [first, second, *remote_channels.values()]:
+        listener = QueueListener()
+        channel.add_listener(listener)
+        await channel.listen()
+        listeners[channel] = listener
+
+    # Every message arrives to the channel of its resource only
+    await first.send_message(mock_piece)
+    await second.send_message(Have(2))
+    await remote_channels[mock_resource.get_info_hash()].send_message(Have(1))
+
+    assert await listeners[remote_channels[mock_resource.get_info_hash()]].messages.get() == mock_piece
+    assert await listeners[remote_channels[other_resource.get_info_hash()]].messages.get() == Have(2)
+    assert await listeners[first].messages.get() == Have(1)
+    assert listeners[second].messages.empty()
+
+    # Closing one channel keeps the shared connection for the other one
+    await first.close()
+    assert isinstance(await listeners[remote_channels[mock_resource.get_info_hash()]].messages.get(), BaseException)
+    await second.send_message(Have(0))
+    assert await listeners[remote_channels[other_resource.get_info_hash()]].messages.get() == Have(0)
+    assert len(dialer.sessions) == 1
+
+    # The connection is closed together with the last channel
+    await second.close()
+    assert isinstance(await listeners[remote_channels[other_resource.get_info_hash()]].messages.get(), BaseException)
+    await asyncio.sleep(0.1)
+    assert not dialer.sessions and not acceptor.sessions
+
+    await dialer.close()
+    await acceptor.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_unknown_resource_is_refused():
+    dialer = Multiplexer(low_peer_id)
+    acceptor = Multiplexer(high_peer_id)
+
+    async def handle_client(reader, writer):
+        handshake = Handshake.from_bytes(await reader.readexactly(75))
+        await acceptor.accept_session(handshake.peer_id, reader, writer)
+
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    host, port = server.sockets[0].getsockname()
+    peer = PeerInfo(peer_id=high_peer_id, public_ip=host, public_port=port)
+
+    with pytest.raises(RuntimeError):
+        await dialer.open_channel(peer, mock_resource)
+
+    await dialer.close()
+    await acceptor.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_bogus_length_does_not_stall_the_download_limit():
+    acceptor = Multiplexer(high_peer_id)
+    session_limiter = RateLimiter(download_bytes_per_sec=100_000)
+    accepted: asyncio.Queue[ChannelConnection] = asyncio.Queue()
+
+    async def on_channel(peer_id: str, channel: ChannelConnection) -> bool:
+        channel.rate_limiter = session_limiter.child()
+        await channel.accept()
+        await accepted.put(channel)
+        return True
+
+    acceptor.register(mock_resource, on_channel)
+    server, reader, writer = await open_raw_session(acceptor)
+    writer.write(raw_attach(1, mock_resource.get_info_hash()))
+    channel = await asyncio.wait_for(accepted.get(), timeout=5)
+    listener = QueueListener()
+    channel.add_listener(listener)
+    await channel.listen()
+
+    # The Piece message of 4 GB is refused before it is charged to the limit
+    writer.write((0xFFFFFFFF).to_bytes(4) + (1).to_bytes(4) + (2).to_bytes(1) + b'\0' * 12)
+    assert isinstance(await asyncio.wait_for(listener.messages.get(), timeout=5), BaseException)
+    # The other connections sharing the limit are not held up
+    await asyncio.wait_for(session_limiter.child().download.consume(10), timeout=1)
+
+    writer.close()
+    await acceptor.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('frame', [
+    (4).to_bytes(4) + (0).to_bytes(4) + b'\0' * 16,  # No message type
+    (MAX_UNKNOWN_MESSAGE_LENGTH + 6).to_bytes(4) + (0).to_bytes(4) + (99).to_bytes(1)  # Unknown control message
+])
+async def test_malformed_frames_close_the_session(frame):
+    acceptor = Multiplexer(high_peer_id)
+    accepted: asyncio.Queue[ChannelConnection] = asyncio.Queue()
+
+    async def on_channel(peer_id: str, channel: ChannelConnection) -> bool:
+        await channel.accept()
+        await accepted.put(channel)
+        return True
+
+    acceptor.register(mock_resource, on_channel)
+    server, reader, writer = await open_raw_session(acceptor)
+
+    # The unknown control messages and the messages of closed channels within the limits are skipped
+    writer.write(raw_frame(0, 99, b'\0' * 100))
+    writer.write(raw_frame(7, 4, (1).to_bytes(4)))
+    writer.write(raw_attach(1, mock_resource.get_info_hash()))
+    await asyncio.wait_for(accepted.get(), timeout=5)
+    assert len(acceptor.sessions) == 1
+
+    writer.write(frame)
+    await asyncio.wait_for(reader.read(), timeout=5)
+    assert not acceptor.sessions
+
+    writer.close()
+    await acceptor.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_slow_channel_does_not_hold_up_the_others(monkeypatch):
+    monkeypatch.setattr(multiplexer_module, '_CHANNEL_QUEUE_SIZE', 4)
+    dialer = Multiplexer(low_peer_id)
+    acceptor = Multiplexer(high_peer_id)
+    accepted: asyncio.Queue[ChannelConnection] = asyncio.Queue()
+
+    async def on_channel(peer_id: str, channel: ChannelConnection) -> bool:
+        await channel.accept()
+        await accepted.put(channel)
+        return True
+
+    acceptor.register(mock_resource, on_channel)
+    acceptor.register(other_resource, on_channel)
+
+    async def handle_client(reader, writer):
+        handshake = Handshake.from_bytes(await reader.readexactly(75))
+        await acceptor.accept_session(handshake.peer_id, reader, writer)
+
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    host, port = server.sockets[0].getsockname()
+    peer = PeerInfo(peer_id=high_peer_id, public_ip=host, public_port=port)
+
+    slow, fast = await dialer.open_channel(peer, mock_resource), await dialer.open_channel(peer, other_resource)
+    remote_channels = {}
+    for _ in range(2):
+        channel = await accepted.get()
+        remote_channels[channel.resource.get_info_hash()] = channel
+    remote_slow = remote_channels[mock_resource.get_info_hash()]
+    remote_fast = remote_channels[other_resource.get_info_hash()]
+
+    # The listener of the slow channel is stuck on the first message
+    released = asyncio.Event()
+
+    class StuckListener(QueueListener):
+        async def on_have(self, have: Have):
+            await released.wait()
+
+    listeners = {}
+    for channel, listener in [(slow, QueueListener()), (fast, QueueListener()),
+                              (remote_slow, StuckListener()), (remote_fast, QueueListener())]:
+        channel.add_listener(listener)
+        await channel.listen()
+        listeners[channel] = listener
+
+    for i in range(10):
+        await slow.send_message(Have(i))
+    await fast.send_message(Have(1))
+    assert await asyncio.wait_for(listeners[remote_fast].messages.get(), timeout=5) == Have(1)
+
+    # The slow channel is closed on both sides, the connection stays for the other one
+    assert isinstance(await asyncio.wait_for(listeners[slow].messages.get(), timeout=5), BaseException)
+    released.set()
+    assert isinstance(await asyncio.wait_for(listeners[remote_slow].messages.get(), timeout=5), BaseException)
+    await fast.send_message(Have(2))
+    assert await asyncio.wait_for(listeners[remote_fast].messages.get(), timeout=5) == Have(2)
+
+    await dialer.close()
+    await acceptor.close()
+    server.close()
+    await server.wait_closed()
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.p2p import peer_cache as peer_cache_module
+from core.p2p.peer_cache import PeerCache
+from core.p2p.resource_manager import ResourceManager
+from core.tests.mocks import mock_resource
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+@pytest.mark.asyncio
+async def test_peers_are_ranked_and_aged_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(peer_cache_module, 'MAX_PEER_FAILURES', 2)
+    cache = PeerCache(tmp_path / 'file', mock_resource)
+    fast, slow, stale, dead = (PeerInfo('127.0.0.1', 7000 + i, f'{i + 1:064x}') for i in range(4))
+
+    for peer in fast, slow, dead:
+        cache.on_connected(peer, now=10 * DAY_SECONDS)
+    cache.on_connected(stale, now=DAY_SECONDS)
+    cache.on_disconnected(fast.peer_id, bytes_downloaded=1000, connected_seconds=1)
+    cache.on_disconnected(slow.peer_id, bytes_downloaded=1000, connected_seconds=10)
+    cache.on_failure(dead.peer_id)
+    assert cache.peers() == [fast, slow, dead, stale]
+
+    # A peer failing in a row is dropped, a peer not connected for long is dropped on save
+    cache.on_failure(dead.peer_id)
+    await cache.save(now=10 * DAY_SECONDS)
+
+    restored = PeerCache(tmp_path / 'file', mock_resource)
+    await restored.load(now=10 * DAY_SECONDS)
+    assert restored.peers() == [fast, slow]
+
+    restored.cache_file.write_text('[corrupted')
+    await restored.load()
+    assert restored.peers() == []
+
+
+@pytest.mark.asyncio
+async def test_cached_peers_are_dialed_at_start(tmp_path):
+    source = tmp_path / 'file'
+    source.write_bytes(b'0' * sum(piece.size_bytes for piece in mock_resource.pieces))
+    seed = ResourceManager('ff' * 32, source, mock_resource)
+    seed_port = await seed.full_start()
+
+    downloader = ResourceManager('00' * 32, tmp_path / 'download', mock_resource)
+    await downloader.full_start(start_download=False, open_public_port=False)
+    await downloader.submit_peers([PeerInfo('127.0.0.1', seed_port, seed.host_peer_id)])
+    assert seed.host_peer_id in downloader._connections
+    await downloader.shutdown()
+    assert downloader._peer_cache.cache_file.exists()
+
+    async def disconnected():
+        while downloader.host_peer_id in seed._connections:
+            await asyncio.sleep(0.02)
+
+    await asyncio.wait_for(disconnected(), 5)
+
+    # After the restart, the seed is connected with no peers submitted
+    restarted = ResourceManager('00' * 32, tmp_path / 'download', mock_resource)
+    await restarted.full_start(start_download=False, open_public_port=False)
+    for _ in range(50):
+        if seed.host_peer_id in restarted._connections:
+            break
+        await asyncio.sleep(0.02)
+    assert seed.host_peer_id in restarted._connections
+
+    await restarted.shutdown()
+    await seed.shutdown()
@@ -0,0 +1,61 @@
+import asyncio
+import datetime
+import hashlib
+import random
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.common.resource import Resource
+from core.p2p.peer_listener import PeerListener
+from core.p2p.resource_manager import ResourceManager
+
+low_peer_id = '00' * 31 + '01'
+high_peer_id = 'ff' * 32
+
+
+def random_resource(name: str) -> tuple[Resource, bytes]:
+    data = [random.randbytes(random.randint(1000, 20000)) for _ in range(5)]
+    pieces = [Resource.Piece(sha256=hashlib.sha256(piece).hexdigest(), size_bytes=len(piece)) for piece in data]
+    resource = Resource('127.0.0.1', 8080, 'test', datetime.datetime(2025, 1, 1), name, pieces)
+    return resource, b''.join(data)
+
+
+@pytest.mark.asyncio
+async def test_one_port_serves_all_resources(tmp_path):
+    listener = PeerListener()
+    port = await listener.start(host='127.0.0.1')
+
+    seeds = []
+    downloads = []
+    for name in ['first', 'second']:
+        resource, data = random_resource(name)
+        source = tmp_path / 'seed' / name
+        source.parent.mkdir(exist_ok=True)
+        source.write_bytes(data)
+
+        seed = ResourceManager(high_peer_id, source, resource)
+        await seed.full_start(open_public_port=False)
+        listener.register(seed)
+        seeds.append(seed)
+
+        destination = tmp_path / 'download' / name
+        destination.parent.mkdir(exist_ok=True)
+        download = ResourceManager(low_peer_id, destination, resource)
+        await download.full_start(open_public_port=False)
+        downloads.append((download, destination, data))
+
+    # Both resources are reached through the same port
+    for download, _, _ in downloads:
+        await download.submit_peers([PeerInfo('127.0.0.1', port, high_peer_id)])
+
+    for _ in range(100):
+        if all(destination.exists() for _, destination, _ in downloads):
+            break
+        await asyncio.sleep(0.1)
+    for _, destination, data in downloads:
+        assert destination.read_bytes() == data
+
+    for resource_manager in seeds + [download for download, _, _ in downloads]:
+        await resource_manager.shutdown()
+    await listener.close()
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.p2p import resource_manager as resource_manager_module
+from core.p2p.resource_manager import ResourceManager
+from core.tests.mocks import mock_resource
+
+
+@pytest.mark.asyncio
+async def test_peers_learn_each_other_from_pex(tmp_path, monkeypatch):
+    monkeypatch.setattr(resource_manager_module, 'PEX_CHECK_SECONDS', 0.2)
+
+    source = tmp_path / 'file'
+    source.write_bytes(b'0' * sum(piece.size_bytes for piece in mock_resource.pieces))
+
+    # Only the first peer knows the others (as if it were the only one to reach the tracker)
+    managers = []
+    peers = []
+    for peer_id in ['11' * 32, '22' * 32, '33' * 32]:
+        destination = tmp_path / peer_id / 'file'
+        destination.parent.mkdir()
+        resource_manager = ResourceManager(peer_id, source if not managers else destination, mock_resource)
+        port = await resource_manager.full_start()
+        managers.append(resource_manager)
+        peers.append(PeerInfo('127.0.0.1', port, peer_id))
+
+    await managers[0].submit_peers(peers[1:])
+
+    # The second peer dials the third one once it gets the Pex message
+    for _ in range(50):
+        if peers[2].peer_id in managers[1]._connections:
+            break
+        await asyncio.sleep(0.1)
+    assert peers[2].peer_id in managers[1]._connections
+    assert peers[1].peer_id in managers[2]._connections
+
+    for resource_manager in managers:
+        await resource_manager.shutdown()
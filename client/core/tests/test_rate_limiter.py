@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+import pytest
+
+from core.p2p.rate_limiter import TokenBucket, RateLimiter
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limits_rate():
+    bucket = TokenBucket(100_000)
+    start = time.monotonic()
+    # The first 100 KB are taken from the full bucket, the rest must wait
+    for _ in range(15):
+        await bucket.consume(10_000)
+    assert 0.4 <= time.monotonic() - start < 1
+
+
+@pytest.mark.asyncio
+async def test_unlimited_bucket_does_not_wait():
+    session = RateLimiter()
+    peer = session.child().child()
+    start = time.monotonic()
+    await peer.upload.consume(10 ** 9)
+    assert time.monotonic() - start < 0.1
+
+
+@pytest.mark.asyncio
+async def test_parent_is_shared_fairly_between_children():
+    session = RateLimiter(upload_bytes_per_sec=100_000)
+    session.upload._tokens = 0
+    big_resource = session.child()
+    small_resource = session.child()
+    sent = {'big': 0, 'small': 0}
+
+    async def send(name: str, resource: RateLimiter):
+        while True:
+            await resource.upload.consume(5_000)
+            sent[name] += 5_000
+
+    # A big resource with many connections and a small one with a single connection
+    tasks = [asyncio.create_task(send('big', big_resource.child())) for _ in range(10)]
+    tasks.append(asyncio.create_task(send('small', small_resource.child())))
+    await asyncio.sleep(1)
+    for task in tasks:
+        task.cancel()
+
+    assert abs(sent['big'] - sent['small']) <= 10_000
+
+
+@pytest.mark.asyncio
+async def test_rate_can_be_changed_while_waiting():
+    bucket = TokenBucket(1_000)
+    bucket._tokens = 0
+    start = time.monotonic()
+    consumer = asyncio.create_task(bucket.consume(1_000))
+    await asyncio.sleep(0.1)
+    bucket.set_rate(None)
+    await asyncio.wait_for(consumer, timeout=1)
+    assert time.monotonic() - start < 0.5
@@ -3,7 +3,9 @@ import pytest
 import random
 import asyncio
 from pathlib import Path
+from core.common.bitset import Bitset
 from core.p2p.resource_file import ResourceFile
+from core.p2p.resource_save import ResourceSave
 from core.tests.mocks import mock_resource
 
 
@@ -41,3 +43,20 @@ async def test_resource_file(tmp_path):
 
     with pytest.raises(Exception):
         await resource_file.save_validated_piece(2, "\x02\xa0".encode())
+
+
+@pytest.mark.asyncio
+async def test_resource_save(tmp_path):
+    resource_save = ResourceSave(tmp_path / 'test_file', mock_resource)
+    pieces_count = len(mock_resource.pieces)
+
+    await resource_save.write_bitfield(Bitset.from_bools([True, False, True]))
+    assert list(await resource_save.read_bitfield()) == [True, False, True]
+
+    # Old saves are JSON lists, a list of another length does not belong to the resource
+    resource_save.save_file.write_text('[false, true, true]')
+    assert list(await resource_save.read_bitfield()) == [False, True, True]
+    for bools in [[True] * (pieces_count - 1), [True] * (pieces_count + 1)]:
+        resource_save.save_file.write_text(str(bools).lower())
+        with pytest.raises(ValueError):
+            await resource_save.read_bitfield()
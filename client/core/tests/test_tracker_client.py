@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from core.s2p.tracker_client import TrackerClient
+
+
+async def start_tracker(respond: bool = True):
+    connections = []
+
+    async def handle_client(reader, writer):
+        connections.append(writer)
+        while respond:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while (line := await reader.readline()) != b'\r\n':
+                name, _, value = line.decode().partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            response = json.dumps({'echo': json.loads(body) if body else None}).encode()
+            writer.write(
+                b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n' +
+                f'Content-Length: {len(response)}\r\n\r\n'.encode() + response
+            )
+            await writer.drain()
+
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    return server, connections
+
+
+@pytest.mark.asyncio
+async def test_requests_reuse_connection():
+    server, connections = await start_tracker()
+    client = TrackerClient('127.0.0.1', server.sockets[0].getsockname()[1])
+
+    for i in range(3):
+        status, text = await client.post_json('/peers', {'i': i})
+        assert status == 200
+        assert json.loads(text) == {'echo': {'i': i}}
+    assert len(connections) == 1
+
+    # The tracker closes the idle connection, the next request goes over a new one
+    connections[0].close()
+    await asyncio.sleep(0.05)
+    status, _ = await client.get('/peers')
+    assert status == 200
+    assert len(connections) == 2
+
+    await client.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_timeout_does_not_block_event_loop():
+    server, connections = await start_tracker(respond=False)
+    client = TrackerClient('127.0.0.1', server.sockets[0].getsockname()[1], timeout_seconds=0.5)
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    ticker = asyncio.create_task(tick())
+    start = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        await client.post_json('/peers', {})
+    assert time.monotonic() - start < 1
+    assert ticks > 10
+    ticker.cancel()
+
+    await client.close()
+    for writer in connections:
+        writer.close()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_events_are_parsed_across_chunks():
+    stream = b': keep-alive\n\nevent: join\ndata: {"a": 1}\n\nevent: leave\r\ndata: first\r\ndata: second\r\n\r\n'
+
+    async def handle_client(reader, writer):
+        await reader.readuntil(b'\r\n\r\n')
+        writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n')
+        # The chunks split the lines of the events
+        for start in range(0, len(stream), 7):
+            chunk = stream[start:start + 7]
+            writer.write(f'{len(chunk):x}\r\n'.encode() + chunk + b'\r\n')
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle_client, '127.0.0.1', 0)
+    client = TrackerClient('127.0.0.1', server.sockets[0].getsockname()[1])
+
+    status, events = await client.events('/peers/events?infoHash=00')
+    assert status == 200
+    assert [event async for event in events] == [('join', '{"a": 1}'), ('leave', 'first\nsecond')]
+
+    server.close()
+    await server.wait_closed()
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.s2p.announcer import parse_peer_list
+from core.s2p.tracker_client import TrackerClient
+from core.s2p.tracker_server import TrackerServer
+from torrentInno import TorrentInno, create_resource_from_json, create_resource_json
+
+INFO_HASH = 'aa' * 32
+
+
+def announce(peer_id: str, port: int, left: int = 100, **fields) -> dict:
+    return {
+        'peerId': peer_id,
+        'infoHash': INFO_HASH,
+        'publicIp': '127.0.0.1',
+        'publicPort': str(port),
+        'left': left,
+        **fields
+    }
+
+
+async def post(client: TrackerClient, path: str, body: dict) -> tuple[int, dict | None]:
+    status, response = await client.request('POST', path, json.dumps(body).encode())
+    return status, json.loads(response) if response else None
+
+
+async def get(client: TrackerClient, path: str) -> tuple[int, dict | None]:
+    status, response = await client.request('GET', path)
+    return status, json.loads(response) if response else None
+
+
+@pytest.mark.asyncio
+async def test_announces_are_answered_with_other_peers():
+    tracker = TrackerServer()
+    port = await tracker.start()
+    client = TrackerClient('127.0.0.1', port)
+
+    status, _ = await post(client, '/peers', announce('11' * 32, 7001, left=0, event='started'))
+    assert status == 200
+    status, response = await post(client, '/peers', announce('22' * 32, 7002, event='started'))
+    assert status == 200
+    assert parse_peer_list(response['peers'], '22' * 32) == [PeerInfo('127.0.0.1', 7001, '11' * 32)]
+
+    # The seeds get only the leechers, in the compact format if asked to
+    status, response = await post(client, '/peers', announce('11' * 32, 7001, left=0, compact=True))
+    assert parse_peer_list(response['peers'], '11' * 32) == [PeerInfo('127.0.0.1', 7002, '22' * 32)]
+
+    status, response = await post(client, '/peers/batch', {
+        'peerId': '33' * 32,
+        'publicIp': '127.0.0.1',
+        'publicPort': 7003,
+        'resources': [{'infoHash': INFO_HASH, 'left': 100}]
+    })
+    assert status == 200
+    assert len(response['peers'][INFO_HASH]) == 2
+
+    status, response = await get(client, f'/peers?infoHash={INFO_HASH}&numwant=1')
+    assert len(response['peers']) == 1
+    status, response = await get(client, f'/scrape?infoHash={INFO_HASH}')
+    assert response['files'][INFO_HASH] == {'complete': 1, 'incomplete': 2, 'downloaded': 0}
+
+    status, _ = await post(client, '/peers', announce('22' * 32, 7002, event='stopped'))
+    assert status == 200
+    assert tracker.scrape(INFO_HASH)['incomplete'] == 1
+    status, _ = await get(client, '/unknown')
+    assert status == 404
+
+    await client.close()
+    await tracker.close()
+
+
+def test_silent_peers_expire():
+    tracker = TrackerServer(peer_lifespan_seconds=10)
+    tracker.announce(announce('11' * 32, 7001), now=0)
+    tracker.announce(announce('22' * 32, 7002), now=0)
+
+    tracker.expire(5)
+    tracker.announce(announce('22' * 32, 7002), now=5)  # Refreshed, the first entry of the heap is outdated
+    tracker.expire(11)
+
+    assert tracker.scrape(INFO_HASH)['incomplete'] == 1
+    assert tracker.announce(announce('33' * 32, 7003), now=11) == [{
+        'peerId': '22' * 32, 'infoHash': INFO_HASH, 'publicIp': '127.0.0.1', 'publicPort': '7002'
+    }]
+
+
+@pytest.mark.asyncio
+async def test_swarm_downloads_through_in_process_tracker(tmp_path):
+    tracker = TrackerServer()
+    port = await tracker.start()
+    source = tmp_path / 'source.bin'
+    source.write_bytes(os.urandom(256 * 1024))
+    resource = create_resource_from_json(
+        create_resource_json('source.bin', '', str(source), trackers=[[('127.0.0.1', port)]])
+    )
+
+    seed = TorrentInno(tracker_host='127.0.0.1', tracker_port=port)
+    await seed.start_share_file(str(source), resource)
+    # Only the peer with the smaller id dials, so the seed must learn about the leechers from the pushed events
+    while resource.get_info_hash() not in tracker._subscribers:
+        await asyncio.sleep(0.01)
+    leechers = [TorrentInno(tracker_host='127.0.0.1', tracker_port=port) for _ in range(2)]
+    destinations = [str(tmp_path / f'destination{i}.bin') for i in range(len(leechers))]
+    for leecher, destination in zip(leechers, destinations):
+        await leecher.start_download_file(destination, resource)
+
+    async def downloaded():
+        while True:
+            states = [await leecher.get_state(d) for leecher, d in zip(leechers, destinations)]
+            # The temporary file is renamed into the destination after the last piece is saved
+            if all(state.piece_status.all() for state in states) and all(map(os.path.exists, destinations)):
+                return
+            await asyncio.sleep(0.1)
+
+    await asyncio.wait_for(downloaded(), 30)
+    for session in [seed] + leechers:
+        await session.shutdown()
+    await tracker.close()
+    for destination in destinations:
+        assert open(destination, 'rb').read() == source.read_bytes()
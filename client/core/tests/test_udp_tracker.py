@@ -0,0 +1,67 @@
+import asyncio
+import struct
+
+import pytest
+
+from core.common.peer_info import PeerInfo
+from core.s2p.announcer import parse_peer_list
+from core.s2p.udp_tracker import UdpTrackerClient
+
+CONNECTION_ID = 0x1234567890
+
+
+class FakeUdpTracker(asyncio.DatagramProtocol):
+    """
+    Answers the connect requests and the announces, but drops the first announce
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.announces = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        connection_id, action, transaction_id = struct.unpack_from('>QII', data)
+        if action == 0:
+            self.transport.sendto(struct.pack('>IIQ', 0, transaction_id, CONNECTION_ID), addr)
+            return
+
+        assert connection_id == CONNECTION_ID
+        self.announces.append(data)
+        if len(self.announces) == 1:
+            return
+        info_hash, peer_id, downloaded, left, uploaded, event, ip, num_want, port = \
+            struct.unpack_from('>32s32sQQQI4siH', data, 16)
+        compact = bytes.fromhex('22' * 32) + bytes([10, 0, 0, 2]) + (7001).to_bytes(2, 'big')
+        self.transport.sendto(struct.pack('>IIIII', 1, transaction_id, 30, 1, 0) + compact, addr)
+
+
+@pytest.mark.asyncio
+async def test_announce_is_retried():
+    transport, tracker = await asyncio.get_running_loop().create_datagram_endpoint(
+        FakeUdpTracker,
+        local_addr=('127.0.0.1', 0)
+    )
+    client = UdpTrackerClient('127.0.0.1', transport.get_extra_info('sockname')[1], timeout_seconds=0.1)
+
+    response = await client.announce('11' * 32, '00' * 32, '10.0.0.1', 7000, left=100, event='started')
+
+    assert len(tracker.announces) == 2
+    assert (response.interval_seconds, response.leechers, response.seeders) == (30, 1, 0)
+    assert parse_peer_list(response.compact_peers, '00' * 32) == [PeerInfo('10.0.0.2', 7001, '22' * 32)]
+    _, _, _, left, _, event, ip, _, port = struct.unpack_from('>32s32sQQQI4siH', tracker.announces[-1], 16)
+    assert (left, event, ip, port) == (100, 2, bytes([10, 0, 0, 1]), 7000)
+
+    client.close()
+    transport.close()
+
+
+@pytest.mark.asyncio
+async def test_unreachable_tracker_fails():
+    client = UdpTrackerClient('127.0.0.1', 9, timeout_seconds=0.1, max_retries=1)
+
+    with pytest.raises((OSError, asyncio.TimeoutError)):
+        await client.announce('11' * 32, '00' * 32, '10.0.0.1', 7000)
+    client.close()
@@ -0,0 +1,39 @@
+import random
+
+from core.p2p.upload_slot_manager import UploadSlotManager
+
+
+def test_best_rates_get_regular_slots():
+    random.seed(0)
+    manager = UploadSlotManager(upload_slots=2, optimistic_unchoke_rounds=3)
+    rates = {'a': 100, 'b': 300, 'c': 200, 'd': 0, 'e': 50}
+
+    unchoked = manager.rechoke(rates)
+    assert {'b', 'c'} <= unchoked
+    assert len(unchoked) == 3
+    assert manager.optimistic_peer in {'a', 'd', 'e'}
+
+
+def test_optimistic_unchoke_rotates():
+    random.seed(0)
+    manager = UploadSlotManager(upload_slots=1, optimistic_unchoke_rounds=2)
+    rates = {peer_id: 0 for peer_id in 'abcdefgh'}
+    rates['a'] = 100
+
+    first = manager.rechoke(rates)
+    optimistic = manager.optimistic_peer
+    # The optimistic peer stays for the whole period
+    assert manager.rechoke(rates) == first
+    assert manager.optimistic_peer == optimistic
+
+    # Leaving peers free their optimistic slot immediately
+    del rates[optimistic]
+    unchoked = manager.rechoke(rates)
+    assert 'a' in unchoked
+    assert manager.optimistic_peer in rates and manager.optimistic_peer != 'a'
+
+
+def test_no_interested_peers():
+    manager = UploadSlotManager()
+    assert manager.rechoke({}) == set()
+    assert manager.optimistic_peer is None
@@ -12,8 +12,18 @@ from typing import Dict
 from pathlib import Path
 from dataclasses import dataclass
 
+from core.common.bitset import Bitset
+from core.p2p.connection import Connection
+from core.p2p.connection_pool import ConnectionPool
+from core.p2p.dht import DhtNode
+from core.p2p.local_discovery import LocalPeerDiscovery
+from core.p2p.multiplexer import Multiplexer
+from core.p2p.peer_listener import PeerListener
+from core.p2p.rate_limiter import RateLimiter
 from core.p2p.resource_manager import ResourceManager
-from core.s2p.server_manager import update_peer, heart_beat
+from core.s2p.announcer import Announcer
+from core.s2p.tracker_client import TrackerClient
+from core.s2p.udp_tracker import UdpTrackerClient
 from core.common.peer_info import PeerInfo
 from core.common.resource import Resource
 
@@ -21,6 +31,10 @@ from core.common.resource import Resource
 TRACKER_IP = '80.71.232.39'
 TRACKER_PORT = 8080
 
+# The default caps of the connections of the whole session
+MAX_SESSION_INBOUND_CONNECTIONS = 200
+MAX_SESSION_OUTBOUND_CONNECTIONS = 200
+
 logging.basicConfig(level=logging.INFO)
 
 # --- utility functions ---
@@ -45,10 +59,19 @@ def get_peer_public_ip():
     ip = socket.gethostbyname(hostname)
     return ip
 
-def create_resource_json(name: str, comment: str, file_path, max_pieces: int = 1000, min_piece_size: int = 64 * 1024):
+def create_resource_json(
+        name: str,
+        comment: str,
+        file_path,
+        max_pieces: int = 1000,
+        min_piece_size: int = 64 * 1024,
+        trackers: list[list[tuple[str, int]]] | None = None
+):
     '''
     Create a resource by splitting the file into an adaptive number of pieces.
+    The trackers are the tiers of (host, port), the first tier is preferred (the default tracker by default).
     '''
+    trackers = trackers or [[(TRACKER_IP, TRACKER_PORT)]]
     size_bytes = os.path.getsize(file_path)
     # Calculate adaptive piece size
     piece_size = max(min_piece_size, math.ceil(size_bytes / max_pieces))
@@ -71,8 +94,9 @@ def create_resource_json(name: str, comment: str, file_path, max_pieces: int = 1
     assert sum(p['size'] for p in pieces) == size_bytes, "Piece sizes do not sum to file size"
 
     resource_json = {
-        'trackerIp': TRACKER_IP,
-        'trackerPort': TRACKER_PORT,
+        'trackerIp': trackers[0][0][0],
+        'trackerPort': trackers[0][0][1],
+        'trackers': [[f'{host}:{port}' for host, port in tier] for tier in trackers],
         'comment': comment,
         'creationDate': datetime.datetime.now().isoformat(),
         'name': name,
@@ -94,7 +118,11 @@ def create_resource_from_json(resource_json):
         comment=resource_json['comment'],
         creation_date=datetime.datetime.fromisoformat(resource_json['creationDate']),
         name=resource_json['name'],
-        pieces=pieces
+        pieces=pieces,
+        trackers=[
+            [(host, int(port)) for host, _, port in (tracker.rpartition(':') for tracker in tier)]
+            for tier in resource_json.get('trackers', [])
+        ]
     )
     return resource
 
@@ -102,13 +130,57 @@ def create_resource_from_json(resource_json):
 class TorrentInno:
     @dataclass
     class State:
-        piece_status: list[bool]
+        piece_status: Bitset
         upload_speed_bytes_per_sec: int
         download_speed_bytes_per_sec: int
         destination: str
 
-    def __init__(self):
+    def __init__(
+            self,
+            connection_class: type[Connection] = Connection,
+            multiplex: bool = False,
+            listen_port: int = 0,
+            local_discovery: bool = False,
+            udp_tracker: bool = False,
+            tracker_host: str = TRACKER_IP,
+            tracker_port: int = TRACKER_PORT,
+            dht: bool = False,
+            dht_port: int = 0,
+            dht_bootstrap_nodes: list[tuple[str, int]] | None = None
+    ):
+        """
+        :param connection_class: the `Connection` implementation used by all resources of the session
+        (`Connection` is based on asyncio streams, `ProtocolConnection` on `asyncio.BufferedProtocol`)
+        :param multiplex: whether all resources shared with the same peer use one TCP connection
+        :param listen_port: the port accepting the connections for all resources, 0 means some random port
+        :param local_discovery: whether the peers of the local network are found with UDP multicast announcements
+        :param udp_tracker: whether the resources are announced with the UDP protocol of the tracker (HTTP remains
+        the fallback)
+        :param tracker_host: the host of the default tracker, the resources are announced to the trackers they name
+        (see `Resource.get_tracker_tiers`)
+        :param tracker_port: the port of the default tracker
+        :param dht: whether the peers are also found with the distributed hash table, so that new swarms form
+        without the tracker
+        :param dht_port: the UDP port of the DHT node, 0 means some random port
+        :param dht_bootstrap_nodes: the addresses of the DHT nodes through which the node joins the network
+        """
         self.peer_id = generate_peer_id()
+        self.connection_class = connection_class
+        self.multiplexer = Multiplexer(self.peer_id) if multiplex else None
+        # One listening socket for the whole session, the connections are dispatched by the info hash
+        self.peer_listener = PeerListener(self.multiplexer)
+        self.listen_port = listen_port
+        self.local_discovery = LocalPeerDiscovery(self.peer_id) if local_discovery else None
+        self.dht = DhtNode(self.peer_id, port=dht_port, bootstrap_nodes=dht_bootstrap_nodes) if dht else None
+        # The keep-alive connections to the tracker are shared by the heartbeats of all resources
+        self.tracker_client = TrackerClient(tracker_host, tracker_port)
+        self.udp_tracker_client = UdpTrackerClient(tracker_host, tracker_port) if udp_tracker else None
+        # All resources are announced together, the announcer is created once the listening port is known
+        self.announcer: Announcer | None = None
+        # Session-wide bandwidth limits, every resource gets a child limiter
+        self.rate_limiter = RateLimiter()
+        # Session-wide connection caps, every resource gets a child pool
+        self.connection_pool = ConnectionPool(MAX_SESSION_INBOUND_CONNECTIONS, MAX_SESSION_OUTBOUND_CONNECTIONS)
         self.resource_manager_dict: Dict[str, ResourceManager] = {}
 
     async def start_share_file(self, destination: str, resource: Resource):
@@ -116,53 +188,57 @@ class TorrentInno:
         Function what starting sharing of file, and updating peer information
         on tracker server
         '''
-        peer_public_ip = get_peer_public_ip()
-        local_resource_manager = ResourceManager(self.peer_id, Path(destination), resource)
+        local_resource_manager = ResourceManager(
+            self.peer_id,
+            Path(destination),
+            resource,
+            connection_class=self.connection_class,
+            rate_limiter=self.rate_limiter,
+            multiplexer=self.multiplexer,
+            connection_pool=self.connection_pool
+        )
         self.resource_manager_dict[destination] = local_resource_manager
-        peer_public_port = await self.resource_manager_dict.get(destination).full_start()
-        resource_info_hash = resource.get_info_hash()
-        peer = {
-            "peerId": str(self.peer_id),
-            "infoHash": str(resource_info_hash),
-            "publicIp": str(peer_public_ip),
-            "publicPort": str(peer_public_port)
-        }
-        tracker_url = 'http://' + TRACKER_IP + f':{TRACKER_PORT}/peers'
-
-        async def parse_peer_list(json_text):
-            '''
-            Function to parse JSON text and return a list of PeerInfo elements.
-            '''
-            peer_list = []
-
-            if not json_text.strip():
-                logging.info("Error parsing peer list: Response is empty")
-                return
-
-            try:
-                data = json.loads(json_text)
-                resource_info_hash = resource.get_info_hash()
-                for peer in data.get("peers", []):
-                    if peer.get("infoHash") == resource_info_hash:
-                        peer_info = PeerInfo(
-                            public_ip=peer["publicIp"],
-                            public_port=int(peer["publicPort"]),
-                            peer_id=peer["peerId"]
-                        )
-                        peer_list.append(peer_info)
-            except (json.JSONDecodeError, KeyError, ValueError) as e:
-                logging.info(f"Error parsing peer list: {e}")
-            logging.info("Share peer list:")
-            logging.info(peer_list)
-            await self.resource_manager_dict.get(destination).submit_peers(peer_list)
-
-        task = asyncio.create_task(heart_beat(tracker_url, peer, parse_peer_list))
+        await local_resource_manager.full_start(open_public_port=False)
+        peer_public_port = await self.peer_listener.start(port=self.listen_port)
+        self.peer_listener.register(local_resource_manager)
+        if self.local_discovery is not None:
+            await self.local_discovery.start(peer_public_port)
+            self.local_discovery.register(local_resource_manager)
+        if self.dht is not None:
+            await self.dht.start(peer_public_port)
+            self.dht.register(local_resource_manager)
+        self._get_announcer(peer_public_port).register(
+            resource.get_info_hash(),
+            local_resource_manager.submit_peers,
+            local_resource_manager.get_transfer_stats,
+            resource.get_tracker_tiers()
+        )
+
+    # Create and start the announcer on the first use
+    def _get_announcer(self, peer_public_port: int) -> Announcer:
+        if self.announcer is None:
+            self.announcer = Announcer(
+                self.tracker_client,
+                self.peer_id,
+                get_peer_public_ip(),
+                peer_public_port,
+                udp_client=self.udp_tracker_client
+            )
+            self.announcer.start()
+        return self.announcer
 
     async def stop_share_file(self, destination: str):
         '''
         Function what stopping sharing of file, and updating peer information
         '''
         await self.resource_manager_dict.get(destination).stop_sharing_file()
+        self.peer_listener.unregister(self.resource_manager_dict.get(destination))
+        if self.local_discovery is not None:
+            self.local_discovery.unregister(self.resource_manager_dict.get(destination))
+        if self.dht is not None:
+            self.dht.unregister(self.resource_manager_dict.get(destination))
+        if self.announcer is not None:
+            self.announcer.unregister(self.resource_manager_dict.get(destination).info_hash)
         await self.resource_manager_dict.get(destination).shutdown()
         del self.resource_manager_dict[destination]
 
@@ -171,46 +247,31 @@ class TorrentInno:
         '''
         Function what starting downloading of file, and updating peer information
         '''
-        peer_public_ip = get_peer_public_ip()
-        local_resource_manager = ResourceManager(self.peer_id, Path(destination), resource)
+        local_resource_manager = ResourceManager(
+            self.peer_id,
+            Path(destination),
+            resource,
+            connection_class=self.connection_class,
+            rate_limiter=self.rate_limiter,
+            multiplexer=self.multiplexer,
+            connection_pool=self.connection_pool
+        )
         self.resource_manager_dict[destination] = local_resource_manager
-        peer_public_port = await self.resource_manager_dict.get(destination).full_start()
-        resource_info_hash = resource.get_info_hash()
-        peer = {
-            "peerId": str(self.peer_id),
-            "infoHash": str(resource_info_hash),
-            "publicIp": str(peer_public_ip),
-            "publicPort": str(peer_public_port)
-        }
-
-        tracker_url = 'http://' + TRACKER_IP + f':{TRACKER_PORT}/peers'
-
-        async def parse_peer_list(json_text):
-            peer_list = []
-            if not json_text.strip():
-                logging.info("Error parsing peer list: Response is empty")
-                return
-
-            try:
-                data = json.loads(json_text)
-                resource_info_hash = resource.get_info_hash()
-                for peer in data.get("peers", []):
-                    if peer.get("infoHash") == resource_info_hash:
-                        peer_info = PeerInfo(
-                            public_ip=peer["publicIp"],
-                            public_port=int(peer["publicPort"]),
-                            peer_id=peer["peerId"]
-                        )
-                        peer_list.append(peer_info)
-            except (json.JSONDecodeError, KeyError, ValueError) as e:
-                logging.info(f"Error parsing peer list: {e}")
-
-            filtered_peers = [p for p in peer_list if p.peer_id != self.peer_id]
-            await self.resource_manager_dict.get(destination).submit_peers(filtered_peers)
-            logging.info('download peer list:')
-            logging.info(filtered_peers)
-
-        task = asyncio.create_task(heart_beat(tracker_url, peer, parse_peer_list))
+        await local_resource_manager.full_start(open_public_port=False)
+        peer_public_port = await self.peer_listener.start(port=self.listen_port)
+        self.peer_listener.register(local_resource_manager)
+        if self.local_discovery is not None:
+            await self.local_discovery.start(peer_public_port)
+            self.local_discovery.register(local_resource_manager)
+        if self.dht is not None:
+            await self.dht.start(peer_public_port)
+            self.dht.register(local_resource_manager)
+        self._get_announcer(peer_public_port).register(
+            resource.get_info_hash(),
+            local_resource_manager.submit_peers,
+            local_resource_manager.get_transfer_stats,
+            resource.get_tracker_tiers()
+        )
         await self.resource_manager_dict.get(destination).start_download()
 
     async def stop_download_file(self, destination: str):
@@ -219,9 +280,50 @@ class TorrentInno:
         on tracker server
         '''
         await self.resource_manager_dict.get(destination).stop_download()
+        self.peer_listener.unregister(self.resource_manager_dict.get(destination))
+        if self.local_discovery is not None:
+            self.local_discovery.unregister(self.resource_manager_dict.get(destination))
+        if self.dht is not None:
+            self.dht.unregister(self.resource_manager_dict.get(destination))
+        if self.announcer is not None:
+            self.announcer.unregister(self.resource_manager_dict.get(destination).info_hash)
         await self.resource_manager_dict.get(destination).shutdown()
         del self.resource_manager_dict[destination]
 
+    async def set_rate_limits(self, upload_bytes_per_sec: int | None, download_bytes_per_sec: int | None):
+        '''
+        Function what limiting bandwidth of the whole session (None means unlimited)
+        '''
+        self.rate_limiter.set_limits(upload_bytes_per_sec, download_bytes_per_sec)
+
+    async def set_resource_rate_limits(
+            self,
+            destination: str,
+            upload_bytes_per_sec: int | None,
+            download_bytes_per_sec: int | None
+    ):
+        '''
+        Function what limiting bandwidth of one file (None means unlimited)
+        '''
+        await self.resource_manager_dict.get(destination).set_rate_limits(upload_bytes_per_sec, download_bytes_per_sec)
+
+    async def set_connection_limits(self, max_inbound: int | None, max_outbound: int | None):
+        '''
+        Function what limiting number of connections of the whole session (None means unlimited)
+        '''
+        self.connection_pool.set_limits(max_inbound, max_outbound)
+
+    async def set_resource_connection_limits(
+            self,
+            destination: str,
+            max_inbound: int | None,
+            max_outbound: int | None
+    ):
+        '''
+        Function what limiting number of connections of one file (None means unlimited)
+        '''
+        await self.resource_manager_dict.get(destination).set_connection_limits(max_inbound, max_outbound)
+
     async def get_state(self, destination):
         '''
         Function what starting downloading of file, and updating peer information
@@ -251,9 +353,33 @@ class TorrentInno:
 
         return return_list
 
+    async def shutdown(self):
+        '''
+        Function what removing all files from torrent and closing the connections of the session
+        '''
+        for destination in list(self.resource_manager_dict):
+            await self.remove_from_torrent(destination)
+        if self.announcer is not None:
+            await self.announcer.close()
+        if self.local_discovery is not None:
+            await self.local_discovery.close()
+        if self.dht is not None:
+            await self.dht.close()
+        await self.peer_listener.close()
+        await self.tracker_client.close()
+        if self.udp_tracker_client is not None:
+            self.udp_tracker_client.close()
+
     async def remove_from_torrent(self , destination):
         '''
         Function what removing file from torrent
         '''
+        self.peer_listener.unregister(self.resource_manager_dict.get(destination))
+        if self.local_discovery is not None:
+            self.local_discovery.unregister(self.resource_manager_dict.get(destination))
+        if self.dht is not None:
+            self.dht.unregister(self.resource_manager_dict.get(destination))
+        if self.announcer is not None:
+            self.announcer.unregister(self.resource_manager_dict.get(destination).info_hash)
         await self.resource_manager_dict.get(destination).shutdown()
         del self.resource_manager_dict[destination]
\ No newline at end of file
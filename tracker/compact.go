@@ -0,0 +1,44 @@
+package main
+
+import (
+	"encoding/binary"
+	"encoding/hex"
+	"net"
+	"strconv"
+)
+
+// CompactPeerSize is the size of one peer in the compact peer list:
+// [peer-id (32 bytes)][IPv4 address (4 bytes)][port (2 bytes, big endian)]
+const CompactPeerSize = 38
+
+// encodeCompact packs the peers one after another, the peers without IPv4 address are skipped
+func encodeCompact(peers []Peer) []byte {
+	encoded := make([]byte, 0, len(peers)*CompactPeerSize)
+	for _, peer := range peers {
+		peerId, err := hex.DecodeString(peer.PeerId)
+		if err != nil || len(peerId) != 32 {
+			continue
+		}
+		ip := net.ParseIP(peer.PublicIp).To4()
+		if ip == nil {
+			continue
+		}
+		port, err := strconv.ParseUint(peer.PublicPort, 10, 16)
+		if err != nil {
+			continue
+		}
+		encoded = append(encoded, peerId...)
+		encoded = append(encoded, ip...)
+		encoded = binary.BigEndian.AppendUint16(encoded, uint16(port))
+	}
+	return encoded
+}
+
+// peerList is the JSON value of the returned peers: an array of peer objects, or the compact peer list
+// (a []byte value is written by encoding/json as a base64 string)
+func peerList(peers []Peer, compact bool) any {
+	if compact {
+		return encodeCompact(peers)
+	}
+	return peers
+}
@@ -0,0 +1,31 @@
+package main
+
+import (
+	"bytes"
+	"encoding/json"
+	"testing"
+)
+
+func TestEncodeCompact(t *testing.T) {
+	encoded := encodeCompact([]Peer{
+		{PeerId: peerId(1), PublicIp: "1.2.3.4", PublicPort: "258"},
+		{PeerId: "not hex", PublicIp: "1.2.3.4", PublicPort: "1"},
+		{PeerId: peerId(2), PublicIp: "::1", PublicPort: "1"},
+		{PeerId: peerId(3), PublicIp: "1.2.3.4", PublicPort: "70000"},
+	})
+
+	want := append(make([]byte, 31), 1, 1, 2, 3, 4, 1, 2)
+	if !bytes.Equal(encoded, want) {
+		t.Fatalf("got %v, want %v (the malformed peers are skipped)", encoded, want)
+	}
+
+	// The compact list is written as a base64 string, the peer objects as an array
+	response, _ := json.Marshal(map[string]any{"peers": peerList(nil, true)})
+	if string(response) != `{"peers":""}` {
+		t.Fatalf("got %s", response)
+	}
+	response, _ = json.Marshal(map[string]any{"peers": peerList([]Peer{}, false)})
+	if string(response) != `{"peers":[]}` {
+		t.Fatalf("got %s", response)
+	}
+}
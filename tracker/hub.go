@@ -0,0 +1,74 @@
+package main
+
+import "sync"
+
+// The types of the pushed peer events
+const (
+	PeerJoined = "join"
+	PeerLeft   = "leave"
+)
+
+// SubscriptionBuffer is the number of events kept for a slow subscriber, the next events are dropped
+// (the subscriber still gets the peers with its regular announces)
+const SubscriptionBuffer = 256
+
+// PeerEvent is a peer that has joined or left the swarm of its info hash
+type PeerEvent struct {
+	Type string `json:"-"`
+	Peer
+	Seed bool `json:"seed"`
+}
+
+// Subscription receives the events of the peers of its info hashes
+type Subscription struct {
+	Events     chan PeerEvent
+	infoHashes []string
+}
+
+// Hub delivers the peer events to the subscribers of their info hashes
+type Hub struct {
+	mu          sync.RWMutex
+	subscribers map[string]map[*Subscription]struct{} // info hash -> subscriptions
+}
+
+func NewHub() *Hub {
+	return &Hub{subscribers: make(map[string]map[*Subscription]struct{})}
+}
+
+func (hub *Hub) Subscribe(infoHashes []string) *Subscription {
+	subscription := &Subscription{Events: make(chan PeerEvent, SubscriptionBuffer), infoHashes: infoHashes}
+	hub.mu.Lock()
+	defer hub.mu.Unlock()
+	for _, infoHash := range infoHashes {
+		subscriptions, ok := hub.subscribers[infoHash]
+		if !ok {
+			subscriptions = make(map[*Subscription]struct{})
+			hub.subscribers[infoHash] = subscriptions
+		}
+		subscriptions[subscription] = struct{}{}
+	}
+	return subscription
+}
+
+func (hub *Hub) Unsubscribe(subscription *Subscription) {
+	hub.mu.Lock()
+	defer hub.mu.Unlock()
+	for _, infoHash := range subscription.infoHashes {
+		delete(hub.subscribers[infoHash], subscription)
+		if len(hub.subscribers[infoHash]) == 0 {
+			delete(hub.subscribers, infoHash)
+		}
+	}
+}
+
+// Publish passes the event to the subscribers of its info hash without ever blocking
+func (hub *Hub) Publish(event PeerEvent) {
+	hub.mu.RLock()
+	defer hub.mu.RUnlock()
+	for subscription := range hub.subscribers[event.InfoHash] {
+		select {
+		case subscription.Events <- event:
+		default:
+		}
+	}
+}
@@ -0,0 +1,36 @@
+package main
+
+import "testing"
+
+func TestHubPublishesJoinsAndLeaves(t *testing.T) {
+	hub := NewHub()
+	store := NewPeerStore()
+	store.Notify = hub.Publish
+	subscription := hub.Subscribe([]string{"a", "b"})
+
+	store.Announce(Peer{PeerId: "1", InfoHash: "a"}, stats(true, ""), 5, 5)
+	store.Announce(Peer{PeerId: "1", InfoHash: "a"}, stats(true, ""), 5, 5) // A refresh is not an event
+	store.Announce(Peer{PeerId: "2", InfoHash: "c"}, stats(true, ""), 5, 5) // Not subscribed
+	store.Announce(Peer{PeerId: "3", InfoHash: "b"}, stats(false, ""), 5, 5)
+	store.Announce(Peer{PeerId: "3", InfoHash: "b"}, stats(false, EventStopped), 5, 5)
+	store.Expire(10)
+	hub.Unsubscribe(subscription)
+	store.Announce(Peer{PeerId: "4", InfoHash: "b"}, stats(false, ""), 5, 5)
+
+	want := []string{PeerJoined + "1", PeerJoined + "3", PeerLeft + "3", PeerLeft + "1"}
+	for _, expected := range want {
+		select {
+		case event := <-subscription.Events:
+			if event.Type+event.Peer.PeerId != expected {
+				t.Fatalf("got %s %s, want %s", event.Type, event.Peer.PeerId, expected)
+			}
+		default:
+			t.Fatalf("missing event %s", expected)
+		}
+	}
+	select {
+	case event := <-subscription.Events:
+		t.Fatalf("unexpected event %+v", event)
+	default:
+	}
+}
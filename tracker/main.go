@@ -3,8 +3,9 @@ package main
 import (
 	"fmt"
 	"github.com/gin-gonic/gin"
+	"io"
 	"net/http"
-	"sync"
+	"strconv"
 	"time"
 )
 
@@ -18,24 +19,95 @@ type Peer struct {
 
 const PeerLifespan = 35
 
-type Peers struct {
-	mu sync.Mutex
-	v  map[string]map[string]Peer
+// AnnounceInterval is how often (in seconds) the peers are expected to announce
+const AnnounceInterval = 30
+
+// MinAnnounceInterval is the shortest interval (in seconds) the peers may announce at, the peers short of other peers
+// announce at it
+const MinAnnounceInterval = 10
+
+// Intervals are the announce intervals returned with every HTTP announce
+type Intervals struct {
+	Interval    int `json:"interval"`
+	MinInterval int `json:"minInterval"`
+}
+
+var announceIntervals = Intervals{Interval: AnnounceInterval, MinInterval: MinAnnounceInterval}
+
+// DefaultNumWant is the number of peers returned if the announce does not ask for another number
+const DefaultNumWant = 50
+
+// MaxNumWant limits the number of peers returned for one info hash
+const MaxNumWant = 200
+
+func normalizeNumWant(numWant int) int {
+	if numWant <= 0 {
+		return DefaultNumWant
+	}
+	return min(numWant, MaxNumWant)
+}
+
+// The events of the announce, the regular announces have no event
+const (
+	EventStarted   = "started"
+	EventCompleted = "completed"
+	EventStopped   = "stopped"
+)
+
+// TransferStats is what the peer reports about the resource with each announce
+type TransferStats struct {
+	Uploaded   int64  `json:"uploaded"`
+	Downloaded int64  `json:"downloaded"`
+	Left       *int64 `json:"left"` // the number of bytes the peer still needs, 0 for the seeds
+	Event      string `json:"event"`
+}
+
+// isSeed tells whether the peer has the whole resource (the peers not reporting `left` are leechers)
+func (stats *TransferStats) isSeed() bool {
+	return stats.Left != nil && *stats.Left == 0
+}
+
+// Announce is the announce of a peer for one resource
+type Announce struct {
+	Peer
+	TransferStats
+	NumWant int  `json:"numwant"`
+	Compact bool `json:"compact"`
 }
 
-var peers = Peers{v: make(map[string]map[string]Peer)}
+// ScrapeSummary is the state of the swarm of one resource
+type ScrapeSummary struct {
+	Complete   int `json:"complete"`   // the number of seeds
+	Incomplete int `json:"incomplete"` // the number of leechers
+	Downloaded int `json:"downloaded"` // the number of the completed downloads
+}
+
+var peers = NewPeerStore()
+
+var hub = NewHub()
+
+// PushKeepAliveInterval is how often an idle event stream gets a comment line, so that the proxies keep it open
+const PushKeepAliveInterval = 15 * time.Second
 
 func main() {
 
 	//start peers cleaning task
 	go tick(1)
 
+	peers.Notify = hub.Publish
+
+	// The same port number serves the UDP announces
+	go serveUDP(":8080")
+
 	router := gin.New()
 	router.Use(
 		gin.Recovery(),
 	)
 	router.GET("/peers", getPeers)
 	router.POST("/peers", updatePeer)
+	router.POST("/peers/batch", updatePeersBatch)
+	router.GET("/scrape", scrape)
+	router.GET("/peers/events", subscribePeers)
 	s := &http.Server{
 		Addr:           ":8080",
 		Handler:        router,
@@ -53,53 +125,162 @@ func main() {
 }
 
 func updatePeer(context *gin.Context) {
-	peers.mu.Lock()
-	defer peers.mu.Unlock()
-	var updatedPeer Peer
-	if err := context.BindJSON(&updatedPeer); err != nil {
+	var announce Announce
+	if err := context.BindJSON(&announce); err != nil {
 		fmt.Println(err)
 		err = context.AbortWithError(http.StatusBadRequest, err)
 		return
 	}
 
+	updatedPeer := announce.Peer
 	updatedPeer.UpdatedAt = time.Now().Unix()
-	if _, ok := peers.v[updatedPeer.InfoHash]; !ok {
-		peers.v[updatedPeer.InfoHash] = make(map[string]Peer)
-	}
-	peers.v[updatedPeer.InfoHash][updatedPeer.PeerId] = updatedPeer
+	sample := peers.Announce(
+		updatedPeer,
+		announce.TransferStats,
+		updatedPeer.UpdatedAt+PeerLifespan,
+		normalizeNumWant(announce.NumWant),
+	)
 
 	type Response struct {
 		InfoHash string `json:"infoHash"`
-		Peers    []Peer `json:"peers"`
+		Peers    any    `json:"peers"`
+		Intervals
 	}
 
-	var response Response
+	response := Response{Intervals: announceIntervals}
 	response.InfoHash = updatedPeer.InfoHash
-	for _, peer := range peers.v[updatedPeer.InfoHash] {
-		response.Peers = append(response.Peers, peer)
+	response.Peers = peerList(sample, announce.Compact)
+
+	context.JSON(http.StatusOK, response)
+}
+
+// ResourceAnnounce is the part of the batch announce about one resource
+type ResourceAnnounce struct {
+	InfoHash string `json:"infoHash"`
+	TransferStats
+}
+
+// BatchAnnounce is one announce of a peer for all of its resources
+type BatchAnnounce struct {
+	PeerId     string             `json:"peerId"`
+	PublicIp   string             `json:"publicIp"`
+	PublicPort string             `json:"publicPort"`
+	Resources  []ResourceAnnounce `json:"resources"`
+	InfoHashes []string           `json:"infoHashes"` // the resources without the transfer statistics
+	NumWant    int                `json:"numwant"`
+	Compact    bool               `json:"compact"`
+}
+
+// MaxBatchSize limits the number of info hashes in one batch announce
+const MaxBatchSize = 1000
+
+func updatePeersBatch(context *gin.Context) {
+	var announce BatchAnnounce
+	if err := context.BindJSON(&announce); err != nil {
+		fmt.Println(err)
+		err = context.AbortWithError(http.StatusBadRequest, err)
+		return
+	}
+	for _, infoHash := range announce.InfoHashes {
+		announce.Resources = append(announce.Resources, ResourceAnnounce{InfoHash: infoHash})
+	}
+	if len(announce.Resources) > MaxBatchSize {
+		context.AbortWithStatus(http.StatusRequestEntityTooLarge)
+		return
+	}
+
+	type Response struct {
+		Peers map[string]any `json:"peers"`
+		Intervals
+	}
+	response := Response{Peers: make(map[string]any, len(announce.Resources)), Intervals: announceIntervals}
+
+	updatedAt := time.Now().Unix()
+	numWant := normalizeNumWant(announce.NumWant)
+	for _, resource := range announce.Resources {
+		sample := peers.Announce(Peer{
+			PeerId:     announce.PeerId,
+			InfoHash:   resource.InfoHash,
+			PublicIp:   announce.PublicIp,
+			PublicPort: announce.PublicPort,
+			UpdatedAt:  updatedAt,
+		}, resource.TransferStats, updatedAt+PeerLifespan, numWant)
+		response.Peers[resource.InfoHash] = peerList(sample, announce.Compact)
 	}
 
 	context.JSON(http.StatusOK, response)
 }
 
+// getPeers returns a sample of the peers of the `infoHash` query parameter (`numwant` and `compact` work
+// as in the announce), or all registered peers if the parameter is absent
 func getPeers(context *gin.Context) {
-	peers.mu.Lock()
-	defer peers.mu.Unlock()
-	context.JSON(http.StatusOK, peers.v)
+	infoHash := context.Query("infoHash")
+	if infoHash == "" {
+		context.JSON(http.StatusOK, peers.All())
+		return
+	}
+
+	numWant, _ := strconv.Atoi(context.Query("numwant"))
+	compact, _ := strconv.ParseBool(context.Query("compact"))
+	sample := peers.Peers(infoHash, normalizeNumWant(numWant))
+	context.JSON(http.StatusOK, gin.H{"infoHash": infoHash, "peers": peerList(sample, compact)})
+}
+
+// scrape returns the summary of the swarm of every `infoHash` query parameter
+func scrape(context *gin.Context) {
+	infoHashes := context.QueryArray("infoHash")
+	if len(infoHashes) > MaxBatchSize {
+		context.AbortWithStatus(http.StatusRequestEntityTooLarge)
+		return
+	}
+	context.JSON(http.StatusOK, gin.H{"files": peers.Scrape(infoHashes)})
+}
+
+// subscribePeers streams the peers joining and leaving the swarms of the `infoHash` query parameters
+// as server-sent events (`join` and `leave` events with the peer as JSON data)
+func subscribePeers(context *gin.Context) {
+	infoHashes := context.QueryArray("infoHash")
+	if len(infoHashes) == 0 {
+		context.AbortWithStatus(http.StatusBadRequest)
+		return
+	}
+	if len(infoHashes) > MaxBatchSize {
+		context.AbortWithStatus(http.StatusRequestEntityTooLarge)
+		return
+	}
+
+	// The stream outlives the write timeout of the server, without lifting it the stream would be cut silently
+	if err := http.NewResponseController(context.Writer).SetWriteDeadline(time.Time{}); err != nil {
+		fmt.Println(err)
+		err = context.AbortWithError(http.StatusInternalServerError, err)
+		return
+	}
+
+	subscription := hub.Subscribe(infoHashes)
+	defer hub.Unsubscribe(subscription)
+	keepAlive := time.NewTicker(PushKeepAliveInterval)
+	defer keepAlive.Stop()
+
+	context.Header("Content-Type", "text/event-stream")
+	context.Header("Cache-Control", "no-cache")
+	context.Stream(func(w io.Writer) bool {
+		select {
+		case event := <-subscription.Events:
+			context.SSEvent(event.Type, event)
+		case <-keepAlive.C:
+			_, _ = io.WriteString(w, ": keep-alive\n\n")
+		case <-context.Request.Context().Done():
+			return false
+		}
+		return true
+	})
 }
 
 func tick(n time.Duration) {
 	for range time.Tick(n * time.Second) {
-		peers.mu.Lock()
-		currentTime := time.Now().Unix()
-		for hash, friends := range peers.v {
-			for peerId, peer := range friends {
-				if peer.UpdatedAt+PeerLifespan < currentTime {
-					fmt.Printf("Peer %s seems to death. Removing..", peerId)
-					delete(peers.v[hash], peerId)
-				}
-			}
+		// Only the peers that have actually expired are visited, one shard lock at a time
+		for _, peer := range peers.Expire(time.Now().Unix()) {
+			fmt.Printf("Peer %s seems to death. Removing..", peer.PeerId)
 		}
-		peers.mu.Unlock()
 	}
 }
@@ -0,0 +1,290 @@
+package main
+
+import (
+	"container/heap"
+	"hash/fnv"
+	"math/rand"
+	"sync"
+)
+
+// ShardCount is the number of independently locked parts of the peer store
+const ShardCount = 256
+
+// peerEntry is a registered peer together with its position in the expiry heap of the shard
+// and in the seeds or leechers list of its swarm
+type peerEntry struct {
+	peer      Peer
+	seed      bool
+	expiresAt int64
+	index     int
+	slot      int
+}
+
+// swarm is the peers of one info hash. The seeds and leechers are also kept in lists,
+// so that a random sample is taken without walking the whole swarm.
+type swarm struct {
+	peers      map[string]*peerEntry
+	seeds      []*peerEntry
+	leechers   []*peerEntry
+	downloaded int // the number of the completed downloads
+}
+
+func (sw *swarm) list(seed bool) *[]*peerEntry {
+	if seed {
+		return &sw.seeds
+	}
+	return &sw.leechers
+}
+
+func (sw *swarm) add(entry *peerEntry) {
+	list := sw.list(entry.seed)
+	entry.slot = len(*list)
+	*list = append(*list, entry)
+}
+
+func (sw *swarm) remove(entry *peerEntry) {
+	list := sw.list(entry.seed)
+	last := (*list)[len(*list)-1]
+	(*list)[entry.slot] = last
+	last.slot = entry.slot
+	(*list)[len(*list)-1] = nil
+	*list = (*list)[:len(*list)-1]
+}
+
+// expiryHeap orders the peers of a shard by their expiration time, the first one expires first
+type expiryHeap []*peerEntry
+
+func (h expiryHeap) Len() int           { return len(h) }
+func (h expiryHeap) Less(i, j int) bool { return h[i].expiresAt < h[j].expiresAt }
+func (h expiryHeap) Swap(i, j int) {
+	h[i], h[j] = h[j], h[i]
+	h[i].index = i
+	h[j].index = j
+}
+
+func (h *expiryHeap) Push(x any) {
+	entry := x.(*peerEntry)
+	entry.index = len(*h)
+	*h = append(*h, entry)
+}
+
+func (h *expiryHeap) Pop() any {
+	old := *h
+	entry := old[len(old)-1]
+	old[len(old)-1] = nil
+	*h = old[:len(old)-1]
+	return entry
+}
+
+type shard struct {
+	mu     sync.RWMutex
+	swarms map[string]*swarm // info hash -> swarm
+	expiry expiryHeap
+}
+
+// PeerStore keeps the peers of every info hash. The info hashes are spread over the shards, so the announces
+// for different resources rarely wait for each other, and the expiration touches only the expired peers.
+type PeerStore struct {
+	shards [ShardCount]shard
+	// Notify receives the peers joining and leaving the swarms, it is called under the lock of the shard
+	// and therefore must not block
+	Notify func(event PeerEvent)
+}
+
+func NewPeerStore() *PeerStore {
+	store := &PeerStore{}
+	for i := range store.shards {
+		store.shards[i].swarms = make(map[string]*swarm)
+	}
+	return store
+}
+
+func (store *PeerStore) shard(infoHash string) *shard {
+	hash := fnv.New32a()
+	_, _ = hash.Write([]byte(infoHash))
+	return &store.shards[hash.Sum32()%ShardCount]
+}
+
+// Announce registers or refreshes the peer until `expiresAt` and returns a random sample of at most `numWant`
+// other peers of its info hash: the seeds and then the leechers for a leecher, only the leechers for a seed.
+// The peer announcing the "stopped" event is removed and gets no peers.
+func (store *PeerStore) Announce(peer Peer, stats TransferStats, expiresAt int64, numWant int) []Peer {
+	s := store.shard(peer.InfoHash)
+	s.mu.Lock()
+	defer s.mu.Unlock()
+
+	sw, ok := s.swarms[peer.InfoHash]
+	if stats.Event == EventStopped {
+		if ok {
+			if entry, ok := sw.peers[peer.PeerId]; ok {
+				s.remove(sw, entry)
+				store.notify(PeerLeft, entry)
+			}
+		}
+		return []Peer{}
+	}
+	if !ok {
+		sw = &swarm{peers: make(map[string]*peerEntry)}
+		s.swarms[peer.InfoHash] = sw
+	}
+	if stats.Event == EventCompleted {
+		sw.downloaded++
+	}
+
+	seed := stats.isSeed()
+	if entry, ok := sw.peers[peer.PeerId]; ok {
+		if entry.seed != seed {
+			sw.remove(entry)
+			entry.seed = seed
+			sw.add(entry)
+		}
+		entry.peer = peer
+		entry.expiresAt = expiresAt
+		heap.Fix(&s.expiry, entry.index)
+	} else {
+		entry = &peerEntry{peer: peer, seed: seed, expiresAt: expiresAt}
+		sw.peers[peer.PeerId] = entry
+		sw.add(entry)
+		heap.Push(&s.expiry, entry)
+		store.notify(PeerJoined, entry)
+	}
+	return sw.sample(peer.PeerId, numWant, seed)
+}
+
+// Peers returns a random sample of at most `numWant` peers of the info hash
+func (store *PeerStore) Peers(infoHash string, numWant int) []Peer {
+	s := store.shard(infoHash)
+	s.mu.RLock()
+	defer s.mu.RUnlock()
+	sw, ok := s.swarms[infoHash]
+	if !ok {
+		return []Peer{}
+	}
+	return sw.sample("", numWant, false)
+}
+
+// Scrape returns the summary of the swarm of every given info hash
+func (store *PeerStore) Scrape(infoHashes []string) map[string]ScrapeSummary {
+	summaries := make(map[string]ScrapeSummary, len(infoHashes))
+	for _, infoHash := range infoHashes {
+		s := store.shard(infoHash)
+		s.mu.RLock()
+		if sw, ok := s.swarms[infoHash]; ok {
+			summaries[infoHash] = ScrapeSummary{
+				Complete:   len(sw.seeds),
+				Incomplete: len(sw.leechers),
+				Downloaded: sw.downloaded,
+			}
+		} else {
+			summaries[infoHash] = ScrapeSummary{}
+		}
+		s.mu.RUnlock()
+	}
+	return summaries
+}
+
+// All returns the peers of every info hash (info hash -> peer id -> peer)
+func (store *PeerStore) All() map[string]map[string]Peer {
+	all := make(map[string]map[string]Peer)
+	for i := range store.shards {
+		s := &store.shards[i]
+		s.mu.RLock()
+		for infoHash, sw := range s.swarms {
+			peers := make(map[string]Peer, len(sw.peers))
+			for peerId, entry := range sw.peers {
+				peers[peerId] = entry.peer
+			}
+			all[infoHash] = peers
+		}
+		s.mu.RUnlock()
+	}
+	return all
+}
+
+// Expire removes the peers whose expiration time is before `now` and returns them
+func (store *PeerStore) Expire(now int64) []Peer {
+	var expired []Peer
+	for i := range store.shards {
+		s := &store.shards[i]
+		s.mu.RLock()
+		due := len(s.expiry) > 0 && s.expiry[0].expiresAt < now
+		s.mu.RUnlock()
+		if !due {
+			continue
+		}
+
+		s.mu.Lock()
+		for len(s.expiry) > 0 && s.expiry[0].expiresAt < now {
+			entry := s.expiry[0]
+			s.remove(s.swarms[entry.peer.InfoHash], entry)
+			store.notify(PeerLeft, entry)
+			expired = append(expired, entry.peer)
+		}
+		s.mu.Unlock()
+	}
+	return expired
+}
+
+func (store *PeerStore) notify(eventType string, entry *peerEntry) {
+	if store.Notify != nil {
+		store.Notify(PeerEvent{Type: eventType, Peer: entry.peer, Seed: entry.seed})
+	}
+}
+
+// remove deletes the entry from the swarm and from the expiry heap, and the swarm from the shard once it is empty
+func (s *shard) remove(sw *swarm, entry *peerEntry) {
+	heap.Remove(&s.expiry, entry.index)
+	delete(sw.peers, entry.peer.PeerId)
+	sw.remove(entry)
+	if len(sw.peers) == 0 {
+		delete(s.swarms, entry.peer.InfoHash)
+	}
+}
+
+// sample returns at most `numWant` random peers except `exclude` that are worth connecting to:
+// for a seed only the leechers, otherwise the seeds first and then the leechers
+func (sw *swarm) sample(exclude string, numWant int, forSeed bool) []Peer {
+	peers := make([]Peer, 0, min(numWant, len(sw.peers)))
+	if forSeed {
+		return appendSample(peers, sw.leechers, exclude, numWant)
+	}
+	peers = appendSample(peers, sw.seeds, exclude, numWant)
+	return appendSample(peers, sw.leechers, exclude, numWant)
+}
+
+// appendSample appends random distinct entries of `list` except `exclude` until `peers` has `numWant` peers.
+// It takes O(numWant) time whatever the size of the list (Floyd's sampling algorithm).
+func appendSample(peers []Peer, list []*peerEntry, exclude string, numWant int) []Peer {
+	want := numWant - len(peers)
+	if want <= 0 {
+		return peers
+	}
+	if want >= len(list) {
+		for _, entry := range list {
+			if entry.peer.PeerId != exclude {
+				peers = append(peers, entry.peer)
+			}
+		}
+		return peers
+	}
+
+	// One more entry is taken in case the excluded peer is among them
+	want = min(want+1, len(list))
+	chosen := make(map[int]struct{}, want)
+	for j := len(list) - want; j < len(list); j++ {
+		i := rand.Intn(j + 1)
+		if _, ok := chosen[i]; ok {
+			i = j
+		}
+		chosen[i] = struct{}{}
+	}
+	for i := range chosen {
+		if len(peers) == numWant {
+			break
+		}
+		if list[i].peer.PeerId != exclude {
+			peers = append(peers, list[i].peer)
+		}
+	}
+	return peers
+}
@@ -0,0 +1,117 @@
+package main
+
+import (
+	"fmt"
+	"sync"
+	"testing"
+)
+
+func peerId(i int) string { return fmt.Sprintf("%064x", i) }
+
+func stats(seed bool, event string) TransferStats {
+	left := int64(100)
+	if seed {
+		left = 0
+	}
+	return TransferStats{Left: &left, Event: event}
+}
+
+func TestSampleHasNoRepeatsAndSeedsFirst(t *testing.T) {
+	store := NewPeerStore()
+	for i := 0; i < 1000; i++ {
+		store.Announce(Peer{PeerId: peerId(i), InfoHash: "h"}, stats(i < 10, ""), 100, 1)
+	}
+
+	for round := 0; round < 100; round++ {
+		sample := store.Announce(Peer{PeerId: peerId(5000), InfoHash: "h"}, stats(false, ""), 100, 20)
+		if len(sample) != 20 {
+			t.Fatalf("got %d peers, want 20", len(sample))
+		}
+		seen := make(map[string]bool)
+		seeds := 0
+		for _, peer := range sample {
+			if seen[peer.PeerId] {
+				t.Fatalf("peer %s is returned twice", peer.PeerId)
+			}
+			seen[peer.PeerId] = true
+			if peer.PeerId == peerId(5000) {
+				t.Fatal("the announcing peer is returned to itself")
+			}
+			var i int
+			fmt.Sscanf(peer.PeerId, "%x", &i)
+			if i < 10 {
+				seeds++
+			}
+		}
+		if seeds != 10 {
+			t.Fatalf("got %d seeds, want all 10 of them", seeds)
+		}
+	}
+
+	// A seed gets only the leechers, and the announcing peer is excluded when the whole list is returned
+	sample := store.Announce(Peer{PeerId: peerId(0), InfoHash: "h"}, stats(true, ""), 100, 2000)
+	if len(sample) != 991 {
+		t.Fatalf("got %d peers for the seed, want the 991 leechers", len(sample))
+	}
+}
+
+func TestExpiry(t *testing.T) {
+	store := NewPeerStore()
+	store.Announce(Peer{PeerId: peerId(1), InfoHash: "h"}, stats(false, ""), 10, 50)
+	store.Announce(Peer{PeerId: peerId(2), InfoHash: "h"}, stats(false, ""), 10, 50)
+	// Refreshed before it expires
+	store.Announce(Peer{PeerId: peerId(2), InfoHash: "h"}, stats(false, ""), 20, 50)
+
+	if expired := store.Expire(10); len(expired) != 0 {
+		t.Fatalf("expired %v at the expiration time itself", expired)
+	}
+	expired := store.Expire(11)
+	if len(expired) != 1 || expired[0].PeerId != peerId(1) {
+		t.Fatalf("expired %v, want only the first peer", expired)
+	}
+	if summary := store.Scrape([]string{"h"})["h"]; summary.Incomplete != 1 {
+		t.Fatalf("got %+v after the expiry", summary)
+	}
+	store.Expire(21)
+	if all := store.All(); len(all) != 0 {
+		t.Fatalf("the empty swarm is kept: %v", all)
+	}
+}
+
+func TestEventsAreCounted(t *testing.T) {
+	store := NewPeerStore()
+	for i := 0; i < 4; i++ {
+		store.Announce(Peer{PeerId: peerId(i), InfoHash: "h"}, stats(i < 2, ""), 100, 50)
+	}
+	store.Announce(Peer{PeerId: peerId(2), InfoHash: "h"}, stats(true, EventCompleted), 100, 50)
+	if sample := store.Announce(Peer{PeerId: peerId(3), InfoHash: "h"}, stats(false, EventStopped), 100, 50); len(sample) != 0 {
+		t.Fatalf("the stopped peer got %v", sample)
+	}
+
+	summary := store.Scrape([]string{"h", "unknown"})
+	if summary["h"] != (ScrapeSummary{Complete: 3, Incomplete: 0, Downloaded: 1}) {
+		t.Fatalf("got %+v", summary["h"])
+	}
+	if summary["unknown"] != (ScrapeSummary{}) {
+		t.Fatalf("got %+v for the unknown info hash", summary["unknown"])
+	}
+}
+
+func TestConcurrentAnnounces(t *testing.T) {
+	store := NewPeerStore()
+	var wg sync.WaitGroup
+	for g := 0; g < 8; g++ {
+		wg.Add(1)
+		go func(g int) {
+			defer wg.Done()
+			for i := 0; i < 1000; i++ {
+				event := []string{"", EventStopped, EventCompleted}[i%3]
+				peer := Peer{PeerId: fmt.Sprint(g, i%30), InfoHash: fmt.Sprint(i % 50)}
+				store.Announce(peer, stats(i%3 == 0, event), int64(i), 7)
+				store.Peers(fmt.Sprint(i%50), 3)
+				store.Expire(int64(i / 2))
+			}
+		}(g)
+	}
+	wg.Wait()
+}
@@ -0,0 +1,181 @@
+package main
+
+import (
+	"crypto/hmac"
+	"crypto/rand"
+	"crypto/sha256"
+	"encoding/binary"
+	"encoding/hex"
+	"errors"
+	"fmt"
+	"net"
+	"runtime"
+	"strconv"
+	"time"
+)
+
+// The UDP announce protocol (all numbers are big endian):
+//
+//	connect request:   [protocol-id 8][action 4 = 0][transaction-id 4]
+//	connect response:  [action 4 = 0][transaction-id 4][connection-id 8]
+//	announce request:  [connection-id 8][action 4 = 1][transaction-id 4][info-hash 32][peer-id 32]
+//	                   [downloaded 8][left 8][uploaded 8][event 4][IPv4 address 4][numwant 4][port 2]
+//	announce response: [action 4 = 1][transaction-id 4][interval 4][leechers 4][seeders 4][compact peer list]
+//	error response:    [action 4 = 3][transaction-id 4][message]
+//
+// The connection id proves that the sender owns its address, so that the announces cannot be sent
+// on behalf of other hosts. It is derived from the address and time, therefore the tracker keeps no state for it.
+const (
+	udpProtocolId     = 0x41727101980
+	udpActionConnect  = 0
+	udpActionAnnounce = 1
+	udpActionError    = 3
+
+	udpConnectSize  = 16
+	udpAnnounceSize = 118
+
+	// UDPConnectionIdLifetime is how long (in seconds) a connection id is accepted at least
+	UDPConnectionIdLifetime = 120
+
+	// MaxUDPNumWant keeps the announce response within a typical MTU
+	MaxUDPNumWant = 36
+
+	// udpLeftUnknown is the `left` of the peers not reporting it
+	udpLeftUnknown = ^uint64(0)
+)
+
+// The events of the UDP announce
+var udpEvents = []string{"", EventCompleted, EventStarted, EventStopped}
+
+type UDPTracker struct {
+	store  *PeerStore
+	secret []byte
+}
+
+func NewUDPTracker(store *PeerStore) *UDPTracker {
+	secret := make([]byte, 32)
+	if _, err := rand.Read(secret); err != nil {
+		panic(err)
+	}
+	return &UDPTracker{store: store, secret: secret}
+}
+
+// Serve answers the packets on the address with one goroutine per CPU
+func (tracker *UDPTracker) Serve(address string) error {
+	conn, err := net.ListenPacket("udp", address)
+	if err != nil {
+		return err
+	}
+	defer conn.Close()
+
+	done := make(chan error, 1)
+	for i := 0; i < runtime.NumCPU(); i++ {
+		go func() {
+			buffer := make([]byte, 2048)
+			for {
+				n, addr, err := conn.ReadFrom(buffer)
+				if err != nil {
+					if errors.Is(err, net.ErrClosed) {
+						done <- err
+						return
+					}
+					continue
+				}
+				udpAddr, ok := addr.(*net.UDPAddr)
+				if !ok {
+					continue
+				}
+				if response := tracker.Handle(buffer[:n], udpAddr.IP, time.Now().Unix()); response != nil {
+					_, _ = conn.WriteTo(response, addr)
+				}
+			}
+		}()
+	}
+	return <-done
+}
+
+// Handle returns the response to the packet from the address, or nil if the packet is not worth an answer
+func (tracker *UDPTracker) Handle(packet []byte, ip net.IP, now int64) []byte {
+	if len(packet) < udpConnectSize {
+		return nil
+	}
+	action := binary.BigEndian.Uint32(packet[8:])
+	transactionId := binary.BigEndian.Uint32(packet[12:])
+
+	switch {
+	case action == udpActionConnect && binary.BigEndian.Uint64(packet) == udpProtocolId:
+		response := binary.BigEndian.AppendUint32(make([]byte, 0, 16), udpActionConnect)
+		response = binary.BigEndian.AppendUint32(response, transactionId)
+		return binary.BigEndian.AppendUint64(response, tracker.connectionId(ip, now/UDPConnectionIdLifetime))
+	case action == udpActionAnnounce:
+		if len(packet) < udpAnnounceSize {
+			return udpError(transactionId, "The announce is too short")
+		}
+		connectionId := binary.BigEndian.Uint64(packet)
+		bucket := now / UDPConnectionIdLifetime
+		if connectionId != tracker.connectionId(ip, bucket) && connectionId != tracker.connectionId(ip, bucket-1) {
+			return udpError(transactionId, "The connection id has expired")
+		}
+		return tracker.announce(packet, transactionId, ip, now)
+	default:
+		return nil
+	}
+}
+
+func (tracker *UDPTracker) announce(packet []byte, transactionId uint32, ip net.IP, now int64) []byte {
+	event := binary.BigEndian.Uint32(packet[104:])
+	if int(event) >= len(udpEvents) {
+		return udpError(transactionId, "Unknown event")
+	}
+	stats := TransferStats{
+		Downloaded: int64(binary.BigEndian.Uint64(packet[80:])),
+		Uploaded:   int64(binary.BigEndian.Uint64(packet[96:])),
+		Event:      udpEvents[event],
+	}
+	if left := binary.BigEndian.Uint64(packet[88:]); left != udpLeftUnknown {
+		value := int64(left)
+		stats.Left = &value
+	}
+
+	// The address of the sender is stored, the reported address (packet[108:112]) is ignored, so that nobody
+	// announces other hosts
+	publicIp := ip
+	numWant := int(int32(binary.BigEndian.Uint32(packet[112:])))
+
+	infoHash := hex.EncodeToString(packet[16:48])
+	sample := tracker.store.Announce(Peer{
+		PeerId:     hex.EncodeToString(packet[48:80]),
+		InfoHash:   infoHash,
+		PublicIp:   publicIp.String(),
+		PublicPort: strconv.Itoa(int(binary.BigEndian.Uint16(packet[116:]))),
+		UpdatedAt:  now,
+	}, stats, now+PeerLifespan, min(normalizeNumWant(numWant), MaxUDPNumWant))
+	summary := tracker.store.Scrape([]string{infoHash})[infoHash]
+
+	response := make([]byte, 0, 20+len(sample)*CompactPeerSize)
+	response = binary.BigEndian.AppendUint32(response, udpActionAnnounce)
+	response = binary.BigEndian.AppendUint32(response, transactionId)
+	response = binary.BigEndian.AppendUint32(response, AnnounceInterval)
+	response = binary.BigEndian.AppendUint32(response, uint32(summary.Incomplete))
+	response = binary.BigEndian.AppendUint32(response, uint32(summary.Complete))
+	return append(response, encodeCompact(sample)...)
+}
+
+func (tracker *UDPTracker) connectionId(ip net.IP, bucket int64) uint64 {
+	mac := hmac.New(sha256.New, tracker.secret)
+	mac.Write(ip.To16())
+	mac.Write(binary.BigEndian.AppendUint64(nil, uint64(bucket)))
+	return binary.BigEndian.Uint64(mac.Sum(nil))
+}
+
+func udpError(transactionId uint32, message string) []byte {
+	response := binary.BigEndian.AppendUint32(make([]byte, 0, 8+len(message)), udpActionError)
+	response = binary.BigEndian.AppendUint32(response, transactionId)
+	return append(response, message...)
+}
+
+func serveUDP(address string) {
+	if err := NewUDPTracker(peers).Serve(address); err != nil {
+		fmt.Println(err)
+	}
+}
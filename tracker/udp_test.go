@@ -0,0 +1,77 @@
+package main
+
+import (
+	"encoding/binary"
+	"encoding/hex"
+	"net"
+	"testing"
+)
+
+func connectPacket(transactionId uint32) []byte {
+	packet := binary.BigEndian.AppendUint64(nil, udpProtocolId)
+	packet = binary.BigEndian.AppendUint32(packet, udpActionConnect)
+	return binary.BigEndian.AppendUint32(packet, transactionId)
+}
+
+func announcePacket(connectionId uint64, peer int, left uint64, reportedIp net.IP, port uint16) []byte {
+	packet := binary.BigEndian.AppendUint64(nil, connectionId)
+	packet = binary.BigEndian.AppendUint32(packet, udpActionAnnounce)
+	packet = binary.BigEndian.AppendUint32(packet, 7)
+	infoHash, _ := hex.DecodeString(peerId(0xab))
+	packet = append(packet, infoHash...)
+	id, _ := hex.DecodeString(peerId(peer))
+	packet = append(packet, id...)
+	packet = binary.BigEndian.AppendUint64(packet, 0) // downloaded
+	packet = binary.BigEndian.AppendUint64(packet, left)
+	packet = binary.BigEndian.AppendUint64(packet, 0) // uploaded
+	packet = binary.BigEndian.AppendUint32(packet, 2) // started
+	packet = append(packet, reportedIp.To4()...)
+	packet = binary.BigEndian.AppendUint32(packet, ^uint32(0)) // numwant -1
+	return binary.BigEndian.AppendUint16(packet, port)
+}
+
+func TestUDPConnectAndAnnounce(t *testing.T) {
+	tracker := NewUDPTracker(NewPeerStore())
+	sender := net.IPv4(10, 0, 0, 1)
+
+	response := tracker.Handle(connectPacket(42), sender, 1000)
+	if len(response) != 16 || binary.BigEndian.Uint32(response) != udpActionConnect ||
+		binary.BigEndian.Uint32(response[4:]) != 42 {
+		t.Fatalf("bad connect response %v", response)
+	}
+	connectionId := binary.BigEndian.Uint64(response[8:])
+
+	// The reported address is ignored, the address of the sender is stored
+	response = tracker.Handle(announcePacket(connectionId, 1, 0, net.IPv4(6, 6, 6, 6), 7001), sender, 1000)
+	if binary.BigEndian.Uint32(response) != udpActionAnnounce || len(response) != 20 {
+		t.Fatalf("bad announce response %v", response)
+	}
+	response = tracker.Handle(announcePacket(connectionId, 2, 100, net.IPv4zero, 7002), sender, 1000)
+	if len(response) != 20+CompactPeerSize {
+		t.Fatalf("got %d bytes, want one peer", len(response))
+	}
+	interval, leechers, seeders := binary.BigEndian.Uint32(response[8:]), binary.BigEndian.Uint32(response[12:]),
+		binary.BigEndian.Uint32(response[16:])
+	if interval != AnnounceInterval || leechers != 1 || seeders != 1 {
+		t.Fatalf("got interval %d, %d leechers, %d seeders", interval, leechers, seeders)
+	}
+	peer := response[20:]
+	if hex.EncodeToString(peer[:32]) != peerId(1) || !net.IP(peer[32:36]).Equal(sender) ||
+		binary.BigEndian.Uint16(peer[36:]) != 7001 {
+		t.Fatalf("bad compact peer %v", peer)
+	}
+
+	// The connection id is bound to the address and expires
+	response = tracker.Handle(announcePacket(connectionId, 3, 100, net.IPv4zero, 7003), net.IPv4(10, 0, 0, 2), 1000)
+	if binary.BigEndian.Uint32(response) != udpActionError {
+		t.Fatal("the connection id of another address is accepted")
+	}
+	response = tracker.Handle(announcePacket(connectionId, 3, 100, net.IPv4zero, 7003), sender, 1000+3*UDPConnectionIdLifetime)
+	if binary.BigEndian.Uint32(response) != udpActionError {
+		t.Fatal("the expired connection id is accepted")
+	}
+
+	if tracker.Handle([]byte{1, 2, 3}, sender, 1000) != nil {
+		t.Fatal("the short packet is answered")
+	}
+}